@@ -0,0 +1,357 @@
+#!/usr/local/bin/python
+#
+#
+## This script times the parsing functions of the update scripts in isolation, on a
+# synthetic archive written by HOT_synthetic.py (or any archive with the same layout).
+# The functions timed are:
+#
+# create_formats_dict, compile_formats,
+# process_niskin, iter_niskin                   from HOT_niskin_update.py
+# process_ctd                                   from HOT_ctd_update.py
+# process_prim_prod                             from HOT_prim_prod_update.py
+# process_part_flux                             from HOT_part_flux_update.py
+# process_cruise_sum and cached_layout          from HOT_functions.py
+#
+# The parsing functions are also timed with their typed columns, the "(typed)" rows,
+# and process_ctd with --numpy. The speedup of each of those variants over the function
+# itself is printed after the times, see compare.
+#
+# The update scripts do all their work when they are run, so they can't be imported.
+# Instead their imports, functions and constants are pulled out of the source with the
+# ast module (see load_script) and run without the rest of the script.
+#
+# Every function is run --repeat times and the best time is reported, along with the
+# number of data rows and rows per second. Every value the function returns is read,
+# so functions that decode lazily are timed for the same work as the others.
+#
+# For example, to time a new archive of 20 cruises, or an existing one:
+# HOT_benchmark.py -c 20 -r 5000
+# HOT_benchmark.py -d test/
+#
+# With --check the functions aren't timed, the output of the decoders is checked
+# instead: the ctd casts decoded with --numpy have to be written the same as without it,
+# on the archive and on a cast written with mixed precision (see mixed_ctd_lines), and
+# the typed and run columns have to read the same as the lists they replace.
+#
+# created: 20261017
+# updated: 20261017
+#
+# History:
+# 20261017:
+#   - Prints the speedup of the typed and numpy variants over the functions they
+#     replace, see compare.
+#   - Times create_formats_dict again, next to compile_formats and cached_layout, so the
+#     readme parse they build on stays comparable with earlier runs.
+#   - Added the --check option, which checks that the ctd casts decoded with numpy are
+#     written the same as the text columns, see check_numpy, and that the typed and run
+#     columns and their slices read the same as lists, see check_columns.
+#   - Times the typed columns of the parsing functions too, see the --typed option of
+#     the update scripts.
+#   - load_script also loads the column tables of the scripts, see is_constant.
+#   - Times compile_formats and cached_layout instead of create_formats_dict.
+#   - The scripts are loaded with changed_files, the module level set of the --changed
+#     option their parse functions use.
+#   - Initialized the script
+import os # operating system
+import sys # for the exit status of the checks
+import ast # to read the functions out of the update scripts
+import time # to time the functions
+import fnmatch # to find the data files
+import shutil # to remove the generated archive
+import tempfile # to write the generated archive
+import optparse # create options for script
+import HOT_functions # processing the data files functions
+import HOT_synthetic # to write a synthetic archive
+
+## The directory of the update scripts
+script_dir=os.path.dirname(os.path.abspath(__file__))
+
+## The data lines of a ctd cast written with mixed precision, for check_numpy: a -9
+# before the decimals of its column, -9.0 in a column of 4 decimals, an exponent, a
+# blank value, a short line and a carriage return
+mixed_ctd_lines=['%8s%8s%9s%8s %7s%8s%8s%8s' % values for values in [\
+                   ('-9','22.4260','34.0312','176.5','0.0','0.606','10','2222'),\
+                   ('142.6','-9.0','35.0569','1.5e3','2.0','0.221','11','2222'),\
+                   ('181.8','6.0057','35.1967','201.7','4.0','0.649','12','2222'),\
+                   ('10.0','','34.8638','148.2','6.0','0.059','13','2222')]]+\
+                ['%8s%8s%9s%8s' % ('12.0','9.4651','35.4519','231.3'),\
+                 '%8s%8s%9s%8s %7s%8s%8s%8s\r' % ('14.0','9.7591','35.4089','211.6','8.0','0.252','14','2222')]
+
+def is_constant(node):
+  '''## True if the expression [node] is a constant: a literal, or a list or tuple of
+  # constants and calls with constant arguments, like the column tables of the scripts.
+  '''
+  try:
+    ast.literal_eval(node)
+    return True;
+  except ValueError:
+    pass
+  if isinstance(node,(ast.List,ast.Tuple)):
+    return all(is_constant(element) for element in node.elts);
+  if isinstance(node,ast.Call):
+    return node.starargs is None and node.kwargs is None and not node.keywords and \
+           all(is_constant(argument) for argument in node.args);
+  return False;
+
+def load_script(script,**names):
+  '''## Load the imports, functions, classes and constant assignments of the update script
+  # [script] into a new namespace, without running the rest of it, and return the
+  # namespace as a dictionary. [names] are added to the namespace first, for the module
+  # level variables the functions use, e.g. options.
+  '''
+  with open(os.path.join(script_dir,script)) as f:
+    tree=ast.parse(f.read(),script)
+  body=[]
+  for node in tree.body:
+    if isinstance(node,(ast.Import,ast.ImportFrom,ast.FunctionDef,ast.ClassDef)):
+      body.append(node)
+    elif isinstance(node,ast.Assign) and all(isinstance(target,ast.Name) for target in node.targets):
+      if is_constant(node.value): # only constants, like sort_keys and the column tables
+        body.append(node)
+  namespace={'__name__':os.path.splitext(script)[0]}
+  namespace.update(names)
+  exec compile(ast.Module(body=body),os.path.join(script_dir,script),'exec') in namespace
+  return namespace;
+
+def find_files(directory,pattern):
+  '''## The files under [directory] matching [pattern], relative to [directory], the
+  # same way the update scripts list them.
+  '''
+  found=[]
+  for root, subFolders, files in os.walk(directory):
+    for filename in fnmatch.filter(files,pattern):
+      found.append(os.path.relpath(os.path.join(root,filename),directory))
+  return sorted(found);
+
+def read_all(result):
+  '''## Read every value of the dictionary [result] of a process function, and return the
+  # number of data rows, the length of the longest variable of each file.
+  '''
+  rows=0
+  for file_key in result:
+    longest=0
+    for var in result[file_key]:
+      if isinstance(result[file_key][var],dict) and "data" in result[file_key][var]:
+        count=0
+        for value in result[file_key][var]["data"]:
+          count+=1
+        longest=max(longest,count)
+    rows+=longest
+  return rows;
+
+def written_columns(result):
+  '''## The text of every variable of the ctd casts [result] of process_ctd, the way the
+  # csv files are written, keyed by (file, variable).
+  '''
+  columns={}
+  for file_key in result:
+    for var in result[file_key]:
+      if isinstance(result[file_key][var],dict) and "data" in result[file_key][var]:
+        data=result[file_key][var]["data"]
+        if "Format" in result[file_key][var]: # decoded with numpy
+          data=HOT_functions.format_column_numpy(data,result[file_key][var]["Format"])
+        columns[(file_key,var)]=list(data)
+  return columns;
+
+def check_numpy(ctd,directory,files):
+  '''## Check that the ctd casts [files] in [directory] are written the same when they are
+  # decoded with numpy, the --numpy option of HOT_ctd_update.py, as without it. [ctd] is
+  # the namespace of the loaded script. Returns the (file, variable) of the columns that
+  # differ.
+  '''
+  cwd=os.getcwd()
+  os.chdir(directory)
+  try:
+    text=written_columns(ctd['process_ctd'](files))
+    decoded=written_columns(ctd['process_ctd'](files,True))
+  finally:
+    os.chdir(cwd)
+  return sorted(key for key in set(text)|set(decoded) if text.get(key)!=decoded.get(key));
+
+def check_columns():
+  '''## Check that a TypedColumn and a RunColumn, and their slices, read the same as the
+  # lists of strings they replace. Returns the descriptions of the ones that don't.
+  '''
+  texts=['  7.928','     -9','  0.085','  1.250','     -9','  3.500']
+  runs=['hot1.pp']*3+['hot2.pp']*2+['hot3.pp']
+  columns=[('TypedColumn',HOT_functions.type_column(texts),texts)]
+  run_column=HOT_functions.RunColumn()
+  for value in runs:
+    run_column.append(value)
+  columns.append(('RunColumn',run_column,runs))
+  slices=[slice(None),slice(1,None),slice(None,-1),slice(2,4),slice(3,3),slice(4,2),\
+          slice(None,None,2),slice(None,None,-1),slice(-4,-1),slice(1,100)]
+  differences=[]
+  for name,column,texts in columns:
+    if not isinstance(column,(HOT_functions.TypedColumn,HOT_functions.RunColumn)):
+      differences.append('%s was not made' % name)
+      continue
+    if list(column)!=texts or [column[i] for i in range(-len(texts),len(texts))]!=texts+texts:
+      differences.append('%s reads differently' % name)
+    for part in slices:
+      if type(column[part]) is not type(column) or list(column[part])!=texts[part]:
+        differences.append('%s[%s:%s:%s] reads differently' % (name,part.start,part.stop,part.step))
+  return differences;
+
+def check(root):
+  '''## Run the checks of the --check option on the archive in [root], and on a cast
+  # written with mixed precision. Prints the result of each check and returns True when
+  # all of them pass.
+  '''
+  checks=[('typed and run columns',check_columns())]
+  if HOT_functions.numpy is None:
+    print 'numpy is not installed, the numpy decoder is not checked'
+  else:
+    options=optparse.Values({'cache':None,'numpy':True,'typed':False,'verbose':False,'test':False})
+    ctd=load_script('HOT_ctd_update.py',options=options,changed_files=None)
+    mixed=tempfile.mkdtemp(prefix='HOT_check_')
+    try:
+      os.makedirs(os.path.join(mixed,'hot-1'))
+      HOT_synthetic.write_ctd_cast(os.path.join(mixed,'hot-1','h01a0101.ctd'),1,1,mixed_ctd_lines)
+      checks.append(('numpy ctd, mixed precision',check_numpy(ctd,mixed,['hot-1/h01a0101.ctd'])))
+      checks.append(('numpy ctd, archive',check_numpy(ctd,os.path.join(root,'ctd'),\
+                                          find_files(os.path.join(root,'ctd'),'h*.ctd'))))
+    finally:
+      shutil.rmtree(mixed)
+  for name,differences in checks:
+    print '%-28s %s' % (name,'ok' if not differences else 'FAILED')
+    for difference in differences:
+      if isinstance(difference,tuple): # (file, variable) of check_numpy
+        difference='%s %s is written differently' % (difference[0],difference[1].strip())
+      print '  %s' % difference
+  return not any(differences for name,differences in checks);
+
+def run(name,directory,function,repeat):
+  '''## Time [function] [repeat] times inside [directory], and print the best time.
+  # [function] returns the number of rows it processed.
+  '''
+  cwd=os.getcwd()
+  os.chdir(directory)
+  try:
+    times=[]
+    for i in range(repeat):
+      start=time.time()
+      rows=function()
+      times.append(time.time()-start)
+  finally:
+    os.chdir(cwd)
+  best=min(times)
+  print '%-28s %10i %10.4f %10.4f %12.0f' % (name,rows,best,sum(times)/len(times),\
+                                               rows/best if best>0 else 0)
+  return best;
+
+def benchmark(root,repeat=3,only=None):
+  '''## Time each parsing function on the archive in [root], [repeat] times each. With
+  # [only], only the functions whose name contains it are timed.
+  '''
+  options=optparse.Values({'cache':None,'numpy':False,'typed':False,'verbose':False,'test':False})
+  niskin=load_script('HOT_niskin_update.py',options=options,formats_hash='',changed_files=None)
+  ctd=load_script('HOT_ctd_update.py',options=options,changed_files=None)
+  prim_prod=load_script('HOT_prim_prod_update.py',options=options,changed_files=None)
+  part_flux=load_script('HOT_part_flux_update.py',options=options,changed_files=None)
+
+  water=os.path.join(root,'water')
+  ctd_dir=os.path.join(root,'ctd')
+  pp_dir=os.path.join(root,'primary_production')
+  flux_dir=os.path.join(root,'particle_flux')
+  sum_dir=os.path.join(root,'cruise.summaries')
+  gof_files=find_files(water,'hot*.gof')
+  ctd_files=find_files(ctd_dir,'h*.ctd')
+  pp_files=find_files(pp_dir,'hot*.pp')
+  flux_files=find_files(flux_dir,'hot*.flux')
+  sum_files=find_files(sum_dir,'hot*.sum')
+
+  def process_cruise_sum():
+    result=HOT_functions.process_cruise_sum(sum_files)
+    return len(result);
+  benchmarks=[
+    ('create_formats_dict',water,lambda: len(niskin['create_formats_dict']('Readme.water.jgofs'))),
+    ('compile_formats',water,lambda: len(niskin['compile_formats']('Readme.water.jgofs'))),
+    ('cached_layout',water,lambda: len(HOT_functions.cached_layout('Readme.water.jgofs',\
+                                   niskin['compile_formats'])[0])),
+    ('process_niskin',water,lambda: read_all(niskin['process_niskin'](gof_files,\
+                                    niskin['compile_formats']('Readme.water.jgofs')))),
+    ('iter_niskin (typed)',water,lambda: read_all(dict(niskin['iter_niskin'](gof_files,\
+                                    niskin['compile_formats']('Readme.water.jgofs'),True)))),
+    ('process_ctd',ctd_dir,lambda: read_all(ctd['process_ctd'](ctd_files))),
+    ('process_ctd (typed)',ctd_dir,lambda: read_all(ctd['process_ctd'](ctd_files,False,True))),
+    ('process_prim_prod',pp_dir,lambda: read_all(prim_prod['process_prim_prod'](pp_files))),
+    ('process_prim_prod (typed)',pp_dir,lambda: read_all(prim_prod['process_prim_prod'](pp_files,True))),
+    ('process_part_flux',flux_dir,lambda: read_all(part_flux['process_part_flux'](flux_files))),
+    ('process_part_flux (typed)',flux_dir,lambda: read_all(part_flux['process_part_flux'](flux_files,True))),
+    ('process_cruise_sum',sum_dir,process_cruise_sum)]
+  if HOT_functions.numpy is not None:
+    benchmarks.insert([entry[0] for entry in benchmarks].index('process_ctd')+1,\
+                      ('process_ctd (numpy)',ctd_dir,lambda: read_all(ctd['process_ctd'](ctd_files,True))))
+
+  print 'Archive:',root
+  print len(gof_files),'niskin,',len(ctd_files),'ctd,',len(pp_files),'primary production,',\
+        len(flux_files),'particle flux and',len(sum_files),'cruise summary files\n'
+  print '%-28s %10s %10s %10s %12s' % ('function','rows','best (s)','mean (s)','rows/s')
+  results={}
+  for name,directory,function in benchmarks:
+    if only and only not in name:
+      continue
+    results[name]=run(name,directory,function,repeat)
+  compare(results)
+  return results;
+
+def compare(results):
+  '''## Print the best time of each variant of a function, like "process_ctd (numpy)",
+  # against the function itself, from the best times of benchmark in [results]. A
+  # speedup under 1 means the variant is slower.
+  '''
+  variants=[(name,name.split(' (')[0]) for name in sorted(results) if ' (' in name]
+  variants=[(name,base) for name,base in variants if base in results and results[name]>0]
+  if not variants:
+    return;
+  print '\n%-28s %-28s %10s' % ('variant','against','speedup')
+  for name,base in variants:
+    print '%-28s %-28s %9.2fx' % (name,base,results[base]/results[name])
+
+if __name__=='__main__':
+  usage = "usage: %prog [options]"
+  version = "%prog 1.0"
+  parser = optparse.OptionParser(usage=usage,version=version)
+  parser.add_option("-d","--dir_path",
+                    dest="dir_path",metavar="DIR",
+                    help="time the archive in DIR, instead of writing a synthetic one")
+  parser.add_option("-c","--cruises",
+                    dest="cruises",metavar="N",type="int",default=12,
+                    help="number of cruises in the synthetic archive [default: %default]")
+  parser.add_option("-s","--casts",
+                    dest="casts",metavar="N",type="int",default=10,
+                    help="number of casts in each cruise [default: %default]")
+  parser.add_option("-b","--bottles",
+                    dest="bottles",metavar="N",type="int",default=24,
+                    help="number of bottles in each niskin cast [default: %default]")
+  parser.add_option("-r","--records",
+                    dest="records",metavar="N",type="int",default=1000,
+                    help="number of records in each ctd cast [default: %default]")
+  parser.add_option("-n","--repeat",
+                    dest="repeat",metavar="N",type="int",default=3,
+                    help="run every function N times [default: %default]")
+  parser.add_option("--only",
+                    dest="only",metavar="NAME",
+                    help="only time the functions whose name contains NAME")
+  parser.add_option("--check",
+                    action="store_true", dest="check",
+                    help="check the output of the decoders instead of timing them, the exit status is 1 when a check fails")
+  (options, args) = parser.parse_args()
+
+  def run_on(root):
+    if options.check:
+      return check(root);
+    benchmark(root,options.repeat,options.only)
+    return True;
+  if options.dir_path:
+    passed=run_on(options.dir_path)
+  else:
+    root=tempfile.mkdtemp(prefix='HOT_synthetic_')
+    try:
+      HOT_synthetic.generate(root,options.cruises,options.casts,options.bottles,options.records)
+      passed=run_on(root)
+    finally:
+      shutil.rmtree(root)
+  if not passed:
+    sys.exit(1)
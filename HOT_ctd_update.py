@@ -19,6 +19,49 @@ exist.'''
 # updated: mbiddle 20180524
 #
 # History:
+# 20261017:
+#   - With --numpy only the 6 header lines of each cast are split into lines, the data
+#     block is decoded by HOT_functions.decode_columns_numpy as it is.
+#   - The --cache is tagged with CTD_PARSE_VERSION, see HOT_functions.cache_tag.
+#   - --changed is only a hint, the casts that aren't listed are still checked by size
+#     and modification time instead of being trusted.
+#   - With --numpy every variable has a 'Format' entry instead of 'Decimals', and the
+#     values are written with the fixed-width padding, the same as without --numpy.
+#     Bumped CTD_MANIFEST_VERSION, so the casts written by --numpy before are redone.
+#   - The header of each cast is a HOT_functions.CtdHeader record, result[FILE]['Header'],
+#     instead of a dictionary entry per header field. The cruise summary entries are
+#     HOT_functions.CruiseSum records; the top level file is built from a copy of each
+#     entry instead of changing the entries, and the csv file names are kept apart.
+#   - The csv file of each cast is written from its columns with itertools.izip, instead
+#     of a list of every row.
+#   - Added the --typed option, which keeps the variables of each cast as
+#     HOT_functions.TypedColumns, arrays of numbers with the -9 missing values in a mask,
+#     formatted back into their text only when they are written.
+#   - Added the --changed option, the list of casts that changed since the last run
+#     (see HOT_getData.py); the other casts are taken from the manifest as they are.
+#   - Added the --profile option, which samples the running code and writes collapsed
+#     stacks for a flamegraph, see HOT_functions.Profiler.
+#   - Added the --metrics option, a JSON report of the time spent in each stage, the file
+#     and cast counts, the bytes read and written and the peak memory of the run.
+#   - process_ctd memory maps each cast with HOT_functions.MappedFile, the data variables
+#     are MappedColumns that only slice a value out of the file when it is read.
+#   - Added the --cache option, a per file cache of the parsed data files, see
+#     HOT_functions.iter_parsed.
+#   - ctd_toplevel_sorted.dat is written by HOT_functions.sort_rows, sorting on the named
+#     columns in sort_keys, instead of running the sort utility over ctd_toplevel.dat.
+#   - Added a processing manifest (see the --manifest and --refresh options). It keeps
+#     the size, modification time and hash of every cast along with the csv file written
+#     from it, so only new or modified casts are processed again. The top level file is
+#     still built from every cast, using the manifest for the casts that were skipped.
+#   - Added the --numpy option, which decodes the data block of each cast into numpy
+#     columns at once with HOT_functions.decode_columns_numpy.
+#   - Added the --jobs option. The casts are processed, joined and written in chunks by
+#     process_ctd_casts, across a process pool when --jobs is more than 1.
+#   - The casts are joined with the cruise summaries through HOT_functions.join_cruise_sum,
+#     one dictionary lookup per cast instead of a scan of the summary keys.
+#   - The cruise summaries are loaded with HOT_functions.load_cruise_sum, which keeps an
+#     index of the processed summary files (see the --sum_index option).
+#
 # 20180524:
 #   - Moved the function process_ctd from HOT_data_extract to this script.
 #
@@ -41,7 +84,7 @@ import HOT_functions # processing the data files functions
 import collections # to keep dictionaries organized
 import re # regular expressions
 import os # operating system
-import subprocess # to make bash calls
+import itertools # to write the rows from the columns
 ## The data OSPREY page can be found at https://www.bco-dmo.org/dataset/3773.
 
 ## Create optional flags for execution: 
@@ -55,20 +98,80 @@ parser.add_option("-t", "--test",
 parser.add_option("-d","--dir_path",
                   dest="dir_path",metavar="DIR",
                   help="write data to DIR path")
+parser.add_option("--sum_index",
+                  dest="sum_index",metavar="FILE",
+                  default="../cruise.summaries/cruise_sum.index",
+                  help="keep the processed cruise summaries in index FILE, only summary files that changed since the last run are processed again [default: %default]")
+parser.add_option("-j","--jobs",
+                  dest="jobs",metavar="N",type="int",default=1,
+                  help="process and write the casts across N processes [default: %default]")
+parser.add_option("--numpy",
+                  action="store_true", dest="numpy",
+                  help="decode the data block of each cast into numpy columns at once, faster for casts of more than a few hundred records; the values are written the same as without it (requires numpy)")
+parser.add_option("--typed",
+                  action="store_true", dest="typed",
+                  help="keep the variables as arrays of numbers, with the -9 missing values in a mask, and only format them when they are written, which keeps the --cache smaller; the output is the same")
+parser.add_option("--manifest",
+                  dest="manifest",metavar="FILE",
+                  help="keep the size, modification time and hash of every processed cast in manifest FILE, casts that didn't change since the last run are not processed again [default: ctd.manifest in the -d directory]")
+parser.add_option("--refresh",
+                  action="store_true", dest="refresh",
+                  help="process every cast again, ignoring the manifest")
+parser.add_option("--cache",
+                  dest="cache",metavar="DIR",
+                  help="keep the parsed data files in DIR, files that didn't change since the last run are not parsed again")
+parser.add_option("--metrics",
+                  dest="metrics",metavar="FILE",
+                  help="write a JSON report of the time spent in each stage, the file and cast counts, the bytes read and written and the peak memory to FILE")
+parser.add_option("--changed",
+                  dest="changed",metavar="FILE",
+                  help="the casts listed in FILE, e.g. the fetch.changed of HOT_getData.py, are hashed again even if their size and time match the manifest, the other casts are checked by size and time")
+parser.add_option("--profile",
+                  dest="profile",metavar="FILE",
+                  help="sample the running code and write the samples to FILE as collapsed stacks, the input of flamegraph renderers")
 (options, args) = parser.parse_args()
+metrics = HOT_functions.Metrics('HOT_ctd_update.py') # see the --metrics option
+if options.profile:
+  profiler = HOT_functions.Profiler(label=metrics.stage) # see the --profile option
+  profiler.start()
+changed_files = None # the files listed by the --changed option
+if options.changed:
+  changed_files = HOT_functions.read_changed(options.changed)
+if options.dir_path and not options.manifest:
+  options.manifest=options.dir_path+'ctd.manifest'
+if options.numpy and HOT_functions.numpy is None:
+  parser.error("--numpy requires the numpy package")
+if options.numpy and options.typed:
+  parser.error("--numpy and --typed can't be used together")
+
+chunk_size=25 # number of casts in each unit of work, see process_ctd_casts
+## The order of the sorted top level file for jgofs: (column, type) as described in
+# HOT_functions.sort_rows. The two header lines stay on top.
+sort_keys=[('cruise_name','n'),('station','n'),('cast','n')]
+## Bump this when the csv files or the manifest entries change, so every cast is redone
+CTD_MANIFEST_VERSION=2
+
+## Bump this when process_ctd returns something else, so the --cache is parsed again
+CTD_PARSE_VERSION=1
 
 def reorder_ordereddict(od, new_key_order):
     new_od = collections.OrderedDict([(k, None) for k in new_key_order if k in od])
     new_od.update(od)
     return new_od
 
-def process_ctd(data_files):
+def process_ctd(data_files,use_numpy=False,typed=False):
   '''## Create a dictionary for the ctd data files using the formats as described in Readme.format 
   # Accepts a list variable containing file names (relative paths are okay).
   #
   # explicitly parses line by line based on how the records are identified in Readme.format
   # No special processing, outputs a dictionary per file, per variable, with data as strings. All 
-  # information is retained and transferred via the dictionary.
+  # information is retained and transferred via the dictionary. The data of each variable
+  # is a HOT_functions.MappedColumn, which reads like a list of strings.
+  #
+  # With [use_numpy] the data block of each file is decoded at once with
+  # HOT_functions.decode_columns_numpy instead, so 'data' is a numpy array and every
+  # variable gets a 'Format' entry to write it back out, None for text. With
+  # [typed] 'data' is a HOT_functions.TypedColumn, see HOT_functions.type_column.
   '''
 #  import collections
   result={}
@@ -79,34 +182,31 @@ def process_ctd(data_files):
   data_rec5={}
   data_rec6={}
   for data_key in data_files:
-    datafile = open(data_key,'r') # open the file
+    mapped = HOT_functions.MappedFile(data_key,6 if use_numpy else None) # with numpy only the header
     filename = data_key
     data_key=data_key.split("/")[1] # make the key more readable
     ## Process the header of the file
-    data_rec1[data_key]=datafile.readline().replace("\n","") # line 1
-    data_rec2[data_key]=datafile.readline().replace("\n","") # line 2
-    data_rec3[data_key]=datafile.readline().replace("\n","") # line 3
-    data_rec4[data_key]=datafile.readline().replace("\n","")
-    data_rec5[data_key]=datafile.readline().replace("\n","")
-    data_rec6[data_key]=datafile.readline().replace("\n","")
+    data_rec1[data_key]=mapped.line(0) # line 1
+    data_rec2[data_key]=mapped.line(1) # line 2
+    data_rec3[data_key]=mapped.line(2) # line 3
+    data_rec4[data_key]=mapped.line(3)
+    data_rec5[data_key]=mapped.line(4)
+    data_rec6[data_key]=mapped.line(5)
     result[data_key]={}
-    result[data_key]['CTD filename']=filename
 
-    ## Data record 1
-    result[data_key]['EXPOCODE']=data_rec1[data_key][8:22]
-    result[data_key]['WHP station identification']=data_rec1[data_key][30:34]
-    result[data_key]['Month']=data_rec1[data_key][40:42]
-    result[data_key]['Day']=data_rec1[data_key][42:44]
-    result[data_key]['Year']=data_rec1[data_key][44:46]
-  
-    ## Data record 2
-    result[data_key]['Station number']=data_rec2[data_key][6:12]
-    result[data_key]['Cast number']=data_rec2[data_key][19:22]
-    result[data_key]['Number of data records in the file']=data_rec2[data_key][35:40]
-
-    ## Data record 3
-    result[data_key]['Instrument number']=data_rec3[data_key][15:21]
-    result[data_key]['Sampling rate']=data_rec3[data_key][36:41]
+    ## Data records 1 to 3, the header of the cast; the fields that repeat from cast to
+    # cast are interned, so the casts share them
+    result[data_key]['Header']=HOT_functions.CtdHeader(filename=filename,\
+      expocode=intern(data_rec1[data_key][8:22]),\
+      whp_id=intern(data_rec1[data_key][30:34]),\
+      month=intern(data_rec1[data_key][40:42]),\
+      day=intern(data_rec1[data_key][42:44]),\
+      year=intern(data_rec1[data_key][44:46]),\
+      station=intern(data_rec2[data_key][6:12]),\
+      cast=intern(data_rec2[data_key][19:22]),\
+      records=data_rec2[data_key][35:40],\
+      instrument=intern(data_rec3[data_key][15:21]),\
+      sampling_rate=intern(data_rec3[data_key][36:41]))
 
     ## Data record 4, Data header
     #result[data_key]['Header']=data_rec4[data_key]
@@ -145,28 +245,90 @@ def process_ctd(data_files):
     result[data_key][data_rec4[data_key][49:57]]['Quality byte']=data_rec6[data_key][49:57]
     result[data_key][data_rec4[data_key][57:65]]['Quality byte']=data_rec6[data_key][57:65]
 
-    # initialize the 'data' dictionaries
-    for item in vars:
-       result[data_key][item]['data']=[]
-
-    ## Now go get all the data for each file
-    for line in datafile: # iterate through each data line and parse on position
-      result[data_key][data_rec4[data_key][0:8]]['data'].append(line[0:8].replace("\n",""))
-      result[data_key][data_rec4[data_key][8:16]]['data'].append(line[8:16].replace("\n",""))
-      result[data_key][data_rec4[data_key][16:25]]['data'].append(line[16:25].replace("\n",""))
-      result[data_key][data_rec4[data_key][25:33]]['data'].append(line[25:33].replace("\n",""))
-      result[data_key][data_rec4[data_key][34:41]]['data'].append(line[34:41].replace("\n",""))
-      result[data_key][data_rec4[data_key][41:49]]['data'].append(line[41:49].replace("\n",""))
-      result[data_key][data_rec4[data_key][49:57]]['data'].append(line[49:57].replace("\n",""))
-      result[data_key][data_rec4[data_key][57:65]]['data'].append(line[57:65].replace("\n",""))
+    ## Now go get all the data for each file, every variable is one field of the data lines
+    fields=[(0,8),(8,16),(16,25),(25,33),(34,41),(41,49),(49,57),(57,65)]
+    if use_numpy: # decode the whole data block into typed columns at once
+      block=mapped.rest()
+      columns=HOT_functions.decode_columns_numpy(block,fields)
+      for item,(values,format) in zip(vars,columns):
+        result[data_key][item]['data']=values
+        result[data_key][item]['Format']=format
+      continue
+    for item,(start,end) in zip(vars,fields): # the values are sliced out when they are read
+      result[data_key][item]['data']=mapped.column(start,end,6)
+      if typed:
+        result[data_key][item]['data']=HOT_functions.type_column(list(result[data_key][item]['data']))
 
   return result;
 
+def process_ctd_casts(data_files):
+  '''## Process a chunk of ctd casts [data_files], join them with the cruise summaries and,
+  # if -d is given, write each cast that was found to its csv file. This is the unit of
+  # work handed to the process pool with --jobs, so it uses the module level options and
+  # cruise_sum and only returns a small summary of each cast:
+  #
+  # [(data file path, ident, csv filename or None if not found, variable names written), ...]
+  '''
+  data_result = dict(HOT_functions.iter_parsed(data_files,\
+                lambda files: process_ctd(files,options.numpy,options.typed),\
+                options.cache,HOT_functions.cache_tag('ctd-numpy' if options.numpy else 'ctd-typed' if options.typed else 'ctd',\
+                CTD_PARSE_VERSION),changed_files))
+  ## Checking for the cruise summary info, all the casts are joined at once
+  files=data_result.keys()
+  headers=[data_result[file]['Header'] for file in files]
+  idents=[header.expocode.strip()+"."+header.station.strip()+"."+header.cast.strip()\
+          for header in headers]
+  matched,missing=HOT_functions.join_cruise_sum(idents,cruise_sum)
+  casts=[]
+  for file,header,ident,cruise_sum_entry in zip(files,headers,idents,matched): # for each data file
+    data_combined={}
+    if cruise_sum_entry is None: # checking expocode
+      print ident,"from file",file,"not found in cruise summary"
+      casts.append((header.filename,ident,None,[]))
+      continue
+#    print cruise_sum[ident] # get all cruise summary information
+    for var in data_result[file]: # iterate through data file variables
+      if "data" in data_result[file][var]: # look for dictionaries with data (variables and identity)
+        data_combined[var.strip()]=data_result[file][var]['data'] # create final directory for writing
+        if 'Format' in data_result[file][var]: # numpy columns are formatted for writing
+          data_combined[var.strip()]=HOT_functions.format_column_numpy(\
+            data_result[file][var]['data'],data_result[file][var]['Format'])
+    if options.dir_path: # if you want to write the data
+      out_file = options.dir_path+header.filename.replace('.ctd','.csv')
+      try: # create directory
+        os.makedirs(options.dir_path+header.filename.split("/")[0])
+      except OSError:
+        pass
+      ## write out the data to ../../working/ctd
+      import csv
+      with open(out_file, 'wb') as f:
+        writer = csv.writer(f, delimiter=',',lineterminator='\n')
+        writer.writerow(data_combined.keys())
+        writer.writerows(itertools.izip(*data_combined.values())) #will not write data if the row numbers don't match, should add a check
+      casts.append((header.filename,ident,header.filename.replace('.ctd','.csv'),data_combined.keys()))
+    else:
+      casts.append((header.filename,ident,header.filename.replace('.ctd','.csv'),[]))
+  return casts;
+
+def process_ctd_casts_profiled(data_files):
+  '''## process_ctd_casts for the workers of the process pool with --profile. The timer of
+  # the profiler doesn't carry over to the workers, so each chunk is sampled by its own
+  # profiler and the samples are returned along with the casts, as (casts, samples).
+  '''
+  profiler=HOT_functions.Profiler(label=lambda: 'parse_join_write')
+  profiler.start()
+  try:
+    casts=process_ctd_casts(data_files)
+  finally:
+    profiler.stop()
+  return casts,dict(profiler.counts);
+
 ## Print current working directory
 print "Current working directory:",os.getcwd()
 
 ## Get the files to be processed:
 #---------------------------------------------------------#
+metrics.start('discovery')
 if options.test: # subset of the data files
   data_files = ['hot-1/h01a0201.ctd','hot-178/h178a0101.ctd']
   readme='Readme.format'
@@ -196,48 +358,97 @@ else:
     print "total data file count:",len(data_files)
 #---------------------------------------------------------#
 
+metrics.count('data_files',len(data_files))
+metrics.count('summary_files',len(sum_files))
+metrics.count('bytes_read',HOT_functions.file_bytes(data_files+sum_files))
+
 ## Pull out all the data using the functions defined above
-cruise_sum = HOT_functions.process_cruise_sum(sum_files)
-data_result = process_ctd(data_files)
+metrics.start('summary_load')
+cruise_sum = HOT_functions.load_cruise_sum(sum_files,options.sum_index)
+metrics.count('summaries',len(cruise_sum))
+
+## Check the casts against the manifest, only the new or modified ones are processed.
+# A cast is also redone if its csv file is gone, it was written with or without
+# --numpy, or it is no longer in the cruise summaries.
+manifest={}
+signatures={}
+process_files=data_files
+casts=[]
+if options.dir_path:
+  metrics.start('manifest')
+  if not options.refresh:
+    manifest=HOT_functions.read_index(options.manifest,CTD_MANIFEST_VERSION)
+  process_files=[]
+  skipped=[]
+  for file in data_files:
+    entry=manifest.get(file)
+    if changed_files is not None and os.path.abspath(file) in changed_files:
+      signatures[file]=HOT_functions.file_signature(file) # listed as changed, hash it again
+    else:
+      signatures[file]=HOT_functions.file_signature(file,entry)
+    if entry is not None and entry['hash']==signatures[file]['hash'] and \
+       entry['numpy']==bool(options.numpy) and entry['ident'] in cruise_sum and \
+       os.path.exists(options.dir_path+entry['csv_filename']):
+      skipped.append((file,entry['ident'],entry['csv_filename'],entry['fields']))
+    else:
+      process_files.append(file)
+  casts.append(skipped)
+  if options.verbose:
+    print len(skipped),"casts unchanged since the last run,",len(process_files),"to process\n"
+
+## Process, join and write the casts in chunks, across a process pool with --jobs
+metrics.start('parse_join_write') # all at once, one cast at a time
+metrics.count('casts_processed',len(process_files))
+metrics.count('casts_unchanged',len(data_files)-len(process_files))
+chunks=[process_files[i:i+chunk_size] for i in range(0,len(process_files),chunk_size)]
+if options.jobs>1:
+  import multiprocessing
+  if options.verbose:
+    print "Processing",len(chunks),"chunks of casts with",options.jobs,"processes\n"
+  pool=multiprocessing.Pool(options.jobs)
+  if options.profile: # sample the workers too
+    for chunk_casts,samples in pool.map(process_ctd_casts_profiled,chunks,1):
+      casts.append(chunk_casts)
+      profiler.merge(samples)
+  else:
+    casts.extend(pool.map(process_ctd_casts,chunks,1))
+  pool.close()
+  pool.join()
+else:
+  casts.extend(map(process_ctd_casts,chunks))
+
+## Record the casts that were written in the manifest for the next run
+if options.dir_path:
+  metrics.start('manifest_write')
+  files={}
+  for chunk in casts:
+    for file,ident,csv_filename,fields in chunk:
+      if csv_filename is not None:
+        files[file]=dict(signatures[file],ident=ident,csv_filename=csv_filename,\
+                         fields=fields,numpy=bool(options.numpy))
+  if files!=manifest:
+    HOT_functions.write_index(options.manifest,CTD_MANIFEST_VERSION,files)
 
 ## Now do some post processing
 #---------------------------------------------------------#
 if options.verbose:
   print "Data successfully ingested, now processing...\n"
 
+metrics.start('join')
 import os
-#data_combined={}
 found_ident=[]
+csv_filenames={} # the csv file of each ident that was found
 data_fields=[]
-for file in data_result: # for each data file
-  data_combined={}
-  ## Checking for the cruise summary info
-  ident = data_result[file]['EXPOCODE'].strip()+\
-          "."+data_result[file]['Station number'].strip()+\
-          "."+data_result[file]['Cast number'].strip()
-  if ident not in cruise_sum.keys(): # checking expocode
-    print ident,"from file",file,"not found in cruise summary"
-  else:
+cast_files={}
+for chunk in casts:
+  for cast in chunk:
+    cast_files[cast[0]]=cast
+for data_file in data_files: # gather the casts that were found, in the order of the files
+  file,ident,csv_filename,fields=cast_files[data_file]
+  if csv_filename is not None:
     found_ident.append(ident)
-    cruise_sum[ident]['CTD_filename']=data_result[file]['CTD filename'].replace('.ctd','.csv')
-#    print cruise_sum[ident] # get all cruise summary information
-    for var in data_result[file]: # iterate through data file variables
-      if "data" in data_result[file][var]: # look for dictionaries with data (variables and identity)
-        data_combined[var.strip()]=data_result[file][var]['data'] # create final directory for writing
-    if options.dir_path: # if you want to write the data
-      out_file = options.dir_path+data_result[file]['CTD filename'].replace('.ctd','.csv')
-      try: # create directory
-        os.makedirs(options.dir_path+data_result[file]['CTD filename'].split("/")[0])
-      except OSError:
-        pass
-      ## write out the data to ../../working/ctd
-      data_fields.extend(data_combined.keys())
-      import csv
-      zd = zip(*data_combined.values())
-      with open(out_file, 'wb') as f:
-        writer = csv.writer(f, delimiter=',',lineterminator='\n')
-        writer.writerow(data_combined.keys())
-        writer.writerows(zd) #will not write data if the row numbers don't match, should add a check
+    csv_filenames[ident]=csv_filename
+    data_fields.extend(fields)
 
 ## provide the desired order of items for top level file
 desired_order_list=["cruise_name","station","cast","depth_max","timecode","HOT_summary_file_name","parameters","num_bottles","section","lon","comments","Date","Day","EXPOCODE","lat","nav_code","pres_max","depth_hgt","Month","timeutc","Year","Ship","CTD_filename"]
@@ -250,55 +461,63 @@ if options.dir_path:
     pass
 
   if len(found_ident)>0:
+    metrics.start('write')
     import csv
     count=0
     cruise_sum2={}
+    toplevel_rows=[]
     with open(options.dir_path+'ctd_toplevel.dat','a') as ftop: # write out top level file
       writer = csv.writer(ftop, delimiter=',',lineterminator='\n')
       for item in found_ident:
-        cruise_sum[item]['station']=item.split('.')[1]
-        cruise_sum[item]['cast']=item.split('.')[-1]
-        cruise_sum[item]['comments']=' ' if not \
-                 re.match('[A-Za-z]','%s'%(cruise_sum[item]['comments'].strip())) else\
-                 '%s'%(cruise_sum[item]['comments'].replace(',',';').strip())
+        summary=cruise_sum[item]._asdict() # a copy of the entry to format for the file
+        summary['CTD_filename']=csv_filenames[item]
+        summary['station']=item.split('.')[1]
+        summary['cast']=item.split('.')[-1]
+        summary['comments']=' ' if not \
+                 re.match('[A-Za-z]','%s'%(summary['comments'].strip())) else\
+                 '%s'%(summary['comments'].replace(',',';').strip())
         # convert lat from DD MM.MMM H to (+-)DD.DDDD
         # # [0:4] degrees, [4:10] decimal minutes, [10:12] Hemisphere.
-        cruise_sum[item]['lat']='%s%6.4f'\
-               %('-' if 'S' in cruise_sum[item]['lat'][10:12] else '',\
-               float(cruise_sum[item]['lat'][0:4])+\
-               float(cruise_sum[item]['lat'][4:10])/60) # writing and converting
+        summary['lat']='%s%6.4f'\
+               %('-' if 'S' in summary['lat'][10:12] else '',\
+               float(summary['lat'][0:4])+\
+               float(summary['lat'][4:10])/60) # writing and converting
         # convert lon from DDD MM.MM H to (+-)DDD.DDDD
         # [0:5] degrees, [5:11] decimal minutes, [11:13] Hemisphere.
-        cruise_sum[item]['lon']='%s%6.4f'\
-               %('-' if 'W' in cruise_sum[item]['lon'][11:13] else '',\
-               float(cruise_sum[item]['lon'][0:5])+\
-               float(cruise_sum[item]['lon'][5:11])/60)    
-        cruise_sum[item]["cruise_name"]='%s'\
-              %(cruise_sum[item]['Ship'][4:].split("/")[0])
-        cruise_sum[item]["EXPOCODE"]='%s'\
-              %(cruise_sum[item]['Ship'].replace("/","_"))
-        cruise_sum[item]["parameters"]='%s'\
-              %(cruise_sum[item]['parameters'].replace(',',';'))
-        # reorder the dictionary 
-        cruise_sum2[item]=reorder_ordereddict(cruise_sum[item],desired_order_list)
-        del cruise_sum2[item]['bcodmo_comment'] # remove this item
+        summary['lon']='%s%6.4f'\
+               %('-' if 'W' in summary['lon'][11:13] else '',\
+               float(summary['lon'][0:5])+\
+               float(summary['lon'][5:11])/60)    
+        summary["cruise_name"]='%s'\
+              %(summary['Ship'][4:].split("/")[0])
+        summary["EXPOCODE"]='%s'\
+              %(summary['Ship'].replace("/","_"))
+        summary["parameters"]='%s'\
+              %(summary['parameters'].replace(',',';'))
+        # reorder the dictionary, the bcodmo_comment of the cruise summaries is left out
+        cruise_sum2[item]=reorder_ordereddict(summary,desired_order_list)
         first_line=cruise_sum2[item].keys() # get first header line
         first_line[-1:]=[">"] # replace last element with > for top level file
         if count==0: # write two line header and first data line
-          writer.writerow(first_line)
+          header_rows=[first_line,sorted(set(data_fields),reverse=True)] # reverse for sorting
+          writer.writerows(header_rows)
           #writer.writerow(data_combined.keys())
-          writer.writerow(sorted(set(data_fields),reverse=True)) # reverse for sorting
           writer.writerow(cruise_sum2[item].values())
         else:
           writer.writerow(cruise_sum2[item].values())
+        toplevel_rows.append(cruise_sum2[item].values())
         count=count+1
+    metrics.count('toplevel_rows',len(toplevel_rows))
     print '\nSorting the top level file for jgofs...'
-    f = open(options.dir_path+'ctd_toplevel_sorted.dat',"w")
-    #sort -k1,1n -k2,2n -k3,3n -b -t, ctd_toplevel.dat > ctd_toplevel2.dat
-    subprocess.call(["sort","-k1,1n","-k2,2n","-k3,3n","-b","-t,",options.dir_path+'ctd_toplevel.dat'], stdout=f)
+    metrics.start('sort')
+    with open(options.dir_path+'ctd_toplevel_sorted.dat','wb') as f:
+      writer = csv.writer(f, delimiter=',',lineterminator='\n')
+      writer.writerows(HOT_functions.sort_rows(first_line,header_rows,sort_keys))
+      writer.writerows(HOT_functions.sort_rows(first_line,toplevel_rows,sort_keys))
     print "\nWrote",options.dir_path+'ctd_toplevel_sorted.dat'
 
   print "\nUpdating",options.dir_path+'ctd.datacomments'
+  metrics.start('datacomments')
   ## Update the datacomments file
   import datetime
   now = datetime.datetime.now()
@@ -310,5 +529,21 @@ if options.dir_path:
   f.writelines(lines)
   # do the remaining operations on the file
   f.close()
+  metrics.stop()
+  metrics.count('bytes_written',HOT_functions.file_bytes(\
+                [options.dir_path+cast_files[file][2] for file in process_files\
+                 if cast_files[file][2] is not None]+\
+                [options.dir_path+'ctd_toplevel.dat',options.dir_path+'ctd_toplevel_sorted.dat',\
+                 options.dir_path+'ctd.datacomments']))
+metrics.stop()
+metrics.count('casts_written',len(found_ident))
+
+if options.metrics:
+  metrics.write(options.metrics)
+  print '\nWrote the metrics to',options.metrics
+if options.profile:
+  profiler.stop()
+  profiler.write(options.profile)
+  print '\nWrote the profile to',options.profile
 
 print "\nCompleted HOT_ctd_update.py." 
@@ -0,0 +1,308 @@
+#!/usr/local/bin/python
+#
+#
+## This module transfers the HOT data sets over ftp inside the python process, for
+# HOT_getData.py. It does the same as the recursive wget transfers of HOT_getData.py:
+#
+# wget -np -N -r -nH --cut-dirs=2 -A "h*.ctd" -Ipub/hot/ctd/hot-* ftp://.../pub/hot/ctd/
+#
+# but every worker thread keeps its ftp connection open between files, instead of
+# logging in again for each file, and the files of all the data sets are transferred
+# at the same time by --jobs threads.
+#
+# Files are only transferred when they are new, or their size or modification time on
+# the server changed (the -N of wget); a transferred file gets the modification time of
+# the server. Each file is written to a temporary file first and renamed when complete.
+#
+# The size and time of every file in the directory listings are kept in a manifest
+# between runs. A file whose listing didn't change since the last run is not checked
+# on the server again, so an up to date data set costs one listing per directory
+# instead of a round trip per file. Without an entry in the manifest, the modification
+# time of the file is asked from the server (MDTM), like wget does.
+#
+# For example, from another script:
+# fetcher = HOT_fetch.Fetcher(jobs=4)
+# results = fetcher.fetch([('ctd','ftp://mananui.soest.hawaii.edu/pub/hot/ctd/',['h*.ctd'],['pub/hot/ctd/hot-*'])],\
+#                         HOT_functions.read_index('fetch.manifest',HOT_fetch.FETCH_MANIFEST_VERSION))
+# HOT_functions.write_index('fetch.manifest',HOT_fetch.FETCH_MANIFEST_VERSION,fetcher.manifest)
+#
+# created: 20261017
+# updated: 20261017
+#
+# History:
+# 20261017:
+#   - Added file_stats, to find the files a wget transfer changed.
+#   - Added the fetch manifest, the listed size and time of every file, so files whose
+#     listing didn't change are not checked on the server again. The files that were
+#     transferred are returned as the 'changed' files of each data set.
+#   - Initialized the module
+import os # operating system
+import ftplib # to talk to the ftp servers
+import socket # for the connection errors
+import threading # for the worker threads
+import Queue # to hand out the work to the threads
+import fnmatch # to match the accepted files and included directories
+import posixpath # for the paths on the server
+import urlparse # to split the urls
+import calendar # to convert the server times
+
+## The errors after which a connection is opened again and the command retried once,
+# a server that refuses the command (ftplib.error_perm) is not asked again
+retry_errors=(ftplib.error_temp,ftplib.error_reply,ftplib.error_proto,socket.error,EOFError,IOError)
+
+## Bump this when the entries of the fetch manifest change, so old manifests are ignored
+FETCH_MANIFEST_VERSION=1
+
+def split_url(url):
+  '''## The (host, port, path) of the ftp [url].'''
+  parts=urlparse.urlparse(url)
+  return parts.hostname,parts.port or ftplib.FTP_PORT,parts.path or '/';
+
+def local_path(path,cut_dirs):
+  '''## The local path of the file [path] on the server, without the leading [cut_dirs]
+  # directories, the same as --cut-dirs of wget. For example with 2 cut directories
+  # /pub/hot/ctd/hot-1/h01a0201.ctd is written to ctd/hot-1/h01a0201.ctd.
+  '''
+  parts=[part for part in path.split('/') if part]
+  return os.path.join(*parts[cut_dirs:]);
+
+def file_stats(directory):
+  '''## The (size, modification time) of every file below the local [directory], keyed by
+  # path. Comparing them before and after a wget transfer gives the files it changed.
+  '''
+  stats={}
+  for root,directories,files in os.walk(directory):
+    for name in files:
+      path=os.path.join(root,name)
+      stat=os.stat(path)
+      stats[path]=(stat.st_size,stat.st_mtime)
+  return stats;
+
+def parse_list_line(line):
+  '''## The (name, is directory, size, time) of one [line] of a unix style LIST of a
+  # directory:
+  #
+  # drwxr-xr-x   2 ftp  ftp      4096 Apr 23  2018 hot-1
+  # -rw-r--r--   1 ftp  ftp     51130 Apr 23 10:10 h01a0201.ctd
+  #
+  # The time is kept as it is listed, e.g. "Apr 23 10:10", since it is only compared
+  # with the time of an earlier listing. Returns None for the lines that aren't files or
+  # directories, like links and totals.
+  '''
+  fields=line.split(None,8)
+  if len(fields)<9 or fields[0][0] not in 'd-':
+    return None;
+  name=fields[8]
+  if name in ('.','..'):
+    return None;
+  try:
+    size=int(fields[4])
+  except ValueError:
+    return None;
+  return name,fields[0][0]=='d',size,' '.join(fields[5:8]);
+
+class Fetcher(object):
+  '''## Transfers data sets from ftp servers with [jobs] worker threads. Each thread keeps
+  # one open connection to each server it used, for all the files it transfers.
+  #
+  # [cut_dirs] leading directories of the server paths are left out of the local paths,
+  # [depth] is the deepest level of directories below each url that is visited and
+  # [server] is an optional "host:port" every url is sent to instead of its own host,
+  # e.g. a local stand-in server for testing. Files are written below [root].
+  '''
+  def __init__(self,jobs=4,cut_dirs=2,depth=5,server=None,root='.',timeout=60,\
+               user='anonymous',passwd='anonymous@'):
+    self.jobs=max(1,jobs)
+    self.cut_dirs=cut_dirs
+    self.depth=depth
+    self.server=server
+    self.root=root
+    self.timeout=timeout
+    self.user=user
+    self.passwd=passwd
+    self.local=threading.local() # the connections of each thread
+    self.lock=threading.Lock()
+
+  def address(self,url):
+    '''## The (host, port, path) to transfer [url] from.'''
+    host,port,path=split_url(url)
+    if self.server:
+      host,sep,server_port=self.server.partition(':')
+      port=int(server_port) if server_port else ftplib.FTP_PORT
+    return host,port,path;
+
+  def connection(self,host,port,fresh=False):
+    '''## The open connection of this thread to [host]:[port], logged in once. With [fresh]
+    # the old connection is dropped and a new one opened.
+    '''
+    if not hasattr(self.local,'connections'):
+      self.local.connections={}
+    ftp=self.local.connections.get((host,port))
+    if ftp is not None and fresh:
+      self.close(ftp)
+      ftp=None
+    if ftp is None:
+      ftp=ftplib.FTP()
+      ftp.connect(host,port,self.timeout)
+      ftp.login(self.user,self.passwd)
+      ftp.voidcmd('TYPE I') # binary, for the sizes and transfers
+      self.local.connections[(host,port)]=ftp
+    return ftp;
+
+  def close(self,ftp):
+    '''## Close the connection [ftp], ignoring a connection that is already gone.'''
+    try:
+      ftp.quit()
+    except (ftplib.all_errors+(AttributeError,)):
+      ftp.close()
+
+  def call(self,host,port,command):
+    '''## Run command(ftp) on this thread's connection to [host]:[port]. A connection that
+    # broke, e.g. timed out while the thread was busy elsewhere, is opened again and the
+    # command retried once.
+    '''
+    try:
+      return command(self.connection(host,port));
+    except retry_errors:
+      return command(self.connection(host,port,fresh=True));
+
+  def fetch(self,datasets,manifest=None):
+    '''## Transfer the [datasets], a list of (name, url, accepted files, included
+    # directories). The accepted files and included directories are lists of patterns
+    # like the -A and -I of wget, an empty list accepts everything; the included
+    # directories are matched against the server path without the leading "/".
+    #
+    # [manifest] is the manifest of the last run, a dictionary keyed by local path of
+    # the listed size and time of each file. The manifest of this run is left in
+    # self.manifest, for the next run.
+    #
+    # Returns a dictionary keyed by name, with the 'transferred', 'unchanged' and
+    # 'failed' file counts, the 'bytes' transferred, the local paths of the files that
+    # were transferred ('changed') and the 'log' lines of each data set.
+    '''
+    self.previous=manifest or {}
+    self.manifest=dict(self.previous) # files that aren't listed this time are kept
+    self.results={}
+    self.queue=Queue.Queue()
+    for name,url,accept,include in datasets:
+      self.results[name]={'transferred':0,'unchanged':0,'failed':0,'bytes':0,'changed':[],'log':[]}
+      host,port,path=self.address(url)
+      self.queue.put(('list',name,host,port,path.rstrip('/') or '/',0,accept,include))
+    threads=[threading.Thread(target=self.work) for i in range(self.jobs)]
+    for thread in threads:
+      thread.daemon=True # don't hang on to an interrupted transfer
+      thread.start()
+    self.queue.join() # listing a directory adds its files before it is done
+    for thread in threads:
+      self.queue.put(None)
+    for thread in threads:
+      thread.join()
+    return self.results;
+
+  def work(self):
+    '''## The loop of each worker thread: take the next listing or file off the queue.'''
+    try:
+      while True:
+        task=self.queue.get()
+        if task is None:
+          self.queue.task_done()
+          break
+        try:
+          if task[0]=='list':
+            self.list_directory(*task[1:])
+          else:
+            self.get_file(*task[1:])
+        except Exception as error: # keep the thread going for the other files
+          self.log(task[1],'failed %s: %s' % (task[4],error),failed=1)
+        finally:
+          self.queue.task_done()
+    finally:
+      for ftp in getattr(self.local,'connections',{}).values():
+        self.close(ftp)
+
+  def log(self,name,line,**counts):
+    '''## Add [line] to the log of data set [name] and the [counts] to its results.'''
+    with self.lock:
+      self.results[name]['log'].append(line)
+      for key,value in counts.items():
+        self.results[name][key]+=value
+
+  def list_directory(self,name,host,port,path,level,accept,include):
+    '''## List the directory [path] and queue its accepted files and included directories.'''
+    lines=[]
+    def listing(ftp):
+      del lines[:] # start over when retried
+      ftp.retrlines('LIST '+path,lines.append)
+    self.call(host,port,listing)
+    for line in lines:
+      entry=parse_list_line(line)
+      if entry is None:
+        continue
+      entry_name,is_directory,size,listed=entry
+      entry_path=posixpath.join(path,entry_name)
+      if is_directory:
+        if level<self.depth and (not include or \
+           any(fnmatch.fnmatch(entry_path.lstrip('/'),pattern) for pattern in include)):
+          self.queue.put(('list',name,host,port,entry_path,level+1,accept,include))
+      elif not accept or any(fnmatch.fnmatch(entry_name,pattern) for pattern in accept):
+        self.queue.put(('get',name,host,port,entry_path,size,listed))
+
+  def remote_time(self,host,port,path):
+    '''## The modification time of [path] on the server, in seconds since the epoch, or
+    # None if the server doesn't say.
+    '''
+    try:
+      reply=self.call(host,port,lambda ftp: ftp.sendcmd('MDTM '+path))
+    except ftplib.error_perm:
+      return None;
+    try: # YYYYMMDDHHMMSS, sliced by hand since time.strptime isn't safe in threads
+      stamp=reply.split()[1]
+      return calendar.timegm((int(stamp[0:4]),int(stamp[4:6]),int(stamp[6:8]),\
+                              int(stamp[8:10]),int(stamp[10:12]),int(stamp[12:14]),0,0,0));
+    except (IndexError,ValueError):
+      return None;
+
+  def get_file(self,name,host,port,path,size,listed):
+    '''## Transfer the file [path] of [size] bytes, listed with the time [listed], unless
+    # the local copy is up to date.
+    '''
+    relative=local_path(path,self.cut_dirs)
+    local=os.path.join(self.root,relative)
+    entry=self.previous.get(relative)
+    mtime=None
+    if os.path.isfile(local) and os.path.getsize(local)==size:
+      if entry is not None: # the listing tells if it changed
+        up_to_date=entry['size']==size and entry['listed']==listed
+      else: # ask the server
+        mtime=self.remote_time(host,port,path)
+        up_to_date=mtime is None or int(os.path.getmtime(local))>=mtime
+      if up_to_date:
+        with self.lock:
+          self.manifest[relative]={'size':size,'listed':listed}
+        self.log(name,'unchanged %s' % relative,unchanged=1)
+        return;
+    if mtime is None:
+      mtime=self.remote_time(host,port,path)
+    directory=os.path.dirname(local)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError: # another thread made it first
+        if not os.path.isdir(directory):
+          raise
+    def transfer(ftp):
+      with open(local+'.part','wb') as f:
+        ftp.retrbinary('RETR '+path,f.write)
+    try:
+      self.call(host,port,transfer)
+    except:
+      if os.path.exists(local+'.part'):
+        os.remove(local+'.part')
+      raise
+    os.rename(local+'.part',local)
+    if mtime is not None:
+      os.utime(local,(mtime,mtime))
+    with self.lock:
+      self.manifest[relative]={'size':size,'listed':listed}
+      self.results[name]['changed'].append(relative)
+    self.log(name,'transferred %s (%i bytes)' % (relative,size),transferred=1,bytes=size)
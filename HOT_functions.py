@@ -12,6 +12,89 @@
 # updated: mbiddle 20180524
 #
 # History:
+# 20261017:
+#   - decode_columns_numpy checks and converts all the fields of fixed point numbers at
+#     once, see fixed_point_numpy, instead of reading the digits position by position and
+#     formatting every value back to compare. format_column_numpy writes the digits of
+#     all the values at once instead of formatting them one by one. MappedFile can stop
+#     after the first lines, see rest.
+#   - write_changed writes the paths relative to the directory of the list, the way
+#     read_changed reads them, the earlier entries too, so the list can be kept anywhere.
+#   - Added cache_tag, the tag of a parse cache with the hash of what the parse depends
+#     on, like the column table and the version of the parse function. Bumped
+#     PARSE_CACHE_VERSION.
+#   - The list of changed files is only a hint: cached_parse checks the size and
+#     modification time of every file and hashes the listed files again, instead of
+#     trusting the files that aren't listed. Added write_changed, which adds to the
+#     list instead of replacing it.
+#   - MappedFile reads the files smaller than MAPPED_FILE_MIN_SIZE into a string instead
+#     of mapping them, so the columns of thousands of casts don't each keep a file
+#     descriptor open.
+#   - The layout and parse caches and the indexes are written through write_pickle, to a
+#     temporary file of their own from tempfile.mkstemp instead of a fixed '.tmp' name,
+#     so runs writing the same file at the same time don't clobber each other.
+#   - Added csv_runs, the runs of a written csv file for merge_rows, read back in blocks
+#     from the offset of each run instead of loading the file. merge_rows takes a spill
+#     file for the runs that are out of order, sorted one at a time and merged back from
+#     there.
+#   - The keys of sort_key are only the sort columns, remembered per distinct value, and
+#     the whole line only orders the rows of equal keys, see order_ties. merge_rows takes
+#     the runs as functions, see column_runs, and merges them lazily with heapq.merge
+#     instead of building every keyed row first.
+#   - TypedColumn and RunColumn can be sliced, a slice is a column of the same type.
+#   - decode_columns_numpy returns the format of each numeric column, checked against the
+#     text of every value, and keeps the text of the columns written with mixed
+#     precision, so --numpy writes the values as they were read. Bumped
+#     PARSE_CACHE_VERSION.
+#   - The cruise summary entries are CruiseSum records instead of dictionaries, with the
+#     repeating text fields interned and the bcodmo_comment kept once on the class.
+#     Added CtdHeader and NiskinHeader, the records of the file headers of the update
+#     scripts. Bumped CRUISE_SUM_INDEX_VERSION and PARSE_CACHE_VERSION.
+#   - Added RunColumn, a column of repeated values kept as runs, for the constant
+#     columns and the cruise summary columns of the update scripts, expanded only when
+#     the column is written. extend_column and compress_column keep it a RunColumn.
+#   - Added TypedColumn and type_column, the opt-in typed numeric columns behind the
+#     --typed option of the update scripts: the values are kept in an array of doubles
+#     with the -9 missing values in a mask, and formatted back into their text only
+#     when they are written. Added extend_column and compress_column, which keep the
+#     typed columns typed while the scripts combine and filter them. read_table types
+#     the 'i' and 'f' columns of a table with [typed].
+#   - Added normalize_date_times and iso_date_time, which turn columns of yymmdd dates and
+#     hhmm times into ISO 8601 date times, rolling times past 2400 into the next day by
+#     the calendar and keeping the -9 missing value.
+#   - Added Column, compile_struct and read_table, the declarative column tables of the
+#     primary production and particle flux files and the decoder they share, which
+#     unpacks each data line with a single struct call.
+#   - Added Field and cached_layout, a fixed-width layout compiled once from a format file
+#     into a tuple of immutable fields, and kept next to the format file keyed by its
+#     hash. Bumped PARSE_CACHE_VERSION, the niskin variables are built from the layout.
+#   - Added read_changed, the files listed by the --changed option of the update scripts.
+#     Files that aren't listed are taken from the parse cache without checking them.
+#   - Added Profiler, a sampling profiler that writes collapsed stacks for flamegraphs,
+#     behind the --profile option of the update scripts. Added Metrics.stage.
+#   - Added Metrics, peak_memory and file_bytes, the stage timings, counts and peak
+#     memory behind the --metrics report of the update scripts.
+#   - Added MappedFile and MappedColumn, a reader that memory maps a fixed-width data file
+#     and only slices a field out of the mapped file when its value is read.
+#   - Added iter_parsed and cached_parse, a per file cache of the parsed data files, kept
+#     in a directory and checked against the hash of each file.
+#   - Added merge_rows, which merges the already sorted runs of rows from each data file
+#     with a heap, and sort_key, the single key function behind sort_rows and merge_rows.
+#   - Added sort_rows, the in-process sort of the output rows by named columns that
+#     replaces the calls to the GNU sort utility in the update scripts.
+#   - Added read_index, write_index and file_signature, the pieces of load_cruise_sum
+#     that the CTD processing manifest shares.
+#   - Added decode_columns_numpy and format_column_numpy, an optional numpy decoder that
+#     turns a whole block of fixed-width data lines into typed columns at once.
+#   - Added join_cruise_sum, the hash join of identifiers against the cruise summaries
+#     shared by the niskin and CTD update scripts.
+#   - Added load_cruise_sum, which keeps a persistent index of the processed cruise
+#     summary files and only processes the summary files that changed since the last run.
+#   - process_cruise_sum now processes each file with process_cruise_sum_file and checks
+#     for duplicate identity codes with a dictionary lookup.
+#   - Added compile_layout, which turns a list of fixed-width field positions into a
+#     single decoder so a whole line is sliced in one pass.
+#
 # 20180524:
 #   - removed functions and incorporated them into individual scripts
 #   - renamed to HOT_functions.py
@@ -62,6 +145,623 @@
 #   - Started working through the file.
 #
 import sys # for testing
+import operator # to build the fixed-width decoders
+import os # operating system
+import cPickle # to store the cruise summary index
+import hashlib # to fingerprint the contents of input files
+import re # regular expressions
+import heapq # to merge sorted runs
+import itertools # to walk the runs of rows
+import collections # to keep the order of the cached variables
+import mmap # to map the data files into memory
+import array # to keep the line offsets of mapped files
+import time # to time the stages of the update scripts
+import json # to write the metrics report
+import resource # for the peak memory
+import signal # for the sampling profiler
+import struct # to unpack whole fixed-width lines at once
+import datetime # to roll the date times over by the calendar
+import bisect # to find the run of a row
+import csv # to read the runs of written files back
+import tempfile # to write the caches and indexes in one step
+try:
+  import numpy # optional, only needed for the numpy decoders
+except ImportError:
+  numpy=None
+
+## Bump this when the cruise summary entries change, so old indexes are rebuilt
+CRUISE_SUM_INDEX_VERSION=2
+
+## Bump this when the structure of the cached parse results changes
+PARSE_CACHE_VERSION=5
+
+## Bump this when Field or the layouts change, so old layout caches are compiled again
+LAYOUT_CACHE_VERSION=1
+
+## One field of a fixed-width layout: the [name] from the format file, the [start] and
+# [end] positions, using python indexing, and the [format] (e.g. "6i")
+Field=collections.namedtuple('Field',['name','start','end','format'])
+
+## One column of the table of a fixed-width data file, see read_table
+Column=collections.namedtuple('Column',['name','start','end','units','type'])
+
+class CruiseSum(collections.namedtuple('CruiseSum',['Ship','Date','Month','Day','Year','section',\
+      'timeutc','timecode','lat','lon','nav_code','depth_max','depth_hgt','pres_max',\
+      'num_bottles','parameters','comments','HOT_summary_file_name'])):
+  '''## One cast of the cruise summaries, see process_cruise_sum_file. The fields are read as
+  # attributes, e.g. entry.Ship; CRUISE_SUM_KEYS are the names of all of them. The
+  # bcodmo_comment is the same for every cast, so it is kept once, on the class.
+  '''
+  __slots__=()
+  bcodmo_comment='key built as expocode.station.cast'
+
+## The names of the fields of a CruiseSum, with the bcodmo_comment
+CRUISE_SUM_KEYS=CruiseSum._fields+('bcodmo_comment',)
+
+## The header of a ctd data file, see process_ctd of HOT_ctd_update.py
+CtdHeader=collections.namedtuple('CtdHeader',['filename','expocode','whp_id','month','day','year',\
+                                 'station','cast','records','instrument','sampling_rate'])
+
+## The header of a niskin data file, see iter_niskin of HOT_niskin_update.py
+NiskinHeader=collections.namedtuple('NiskinHeader',['expo_code','whp_id','cruise_start','cruise_end'])
+
+## The leading number of a value, the part sort -n compares
+sort_number_pattern=re.compile(r'\s*(-?(?:\d+\.?\d*|\.\d+))')
+
+def compile_layout(fields):
+  '''## Compile a fixed-width layout into a decoder that slices a whole line in one pass.
+  # [fields] is a list of (start,end) positions, using python indexing. For example
+  # the Readme.water.jgofs entry "1-  8   i6    Station Number" is (0,8).
+  #
+  # The returned function accepts a line and returns a tuple with one string per field,
+  # in the same order as [fields]:
+  #
+  # decode = compile_layout([(0,8),(8,16)])
+  # station,cast = decode(line)
+  #
+  '''
+  slices=[slice(int(start),int(end)) for start,end in fields]
+  if len(slices)==1: # itemgetter returns a bare value for a single item
+    only=slices[0]
+    return lambda line: (line[only],)
+  return operator.itemgetter(*slices);
+
+def compile_struct(fields):
+  '''## Compile a fixed-width layout into a struct.Struct that unpacks all the fields of a
+  # line in one call. [fields] is a list of (start,end) positions, as in compile_layout.
+  # Returns None when the fields overlap or aren't in order, since struct can't go back.
+  #
+  # unpack = compile_struct([(0,5),(6,10)])
+  # cruise,incubation = unpack.unpack_from(line)
+  '''
+  parts=[]
+  position=0
+  for start,end in fields:
+    if start<position or end<start:
+      return None;
+    if start>position: # skip the gap
+      parts.append('%ix' % (start-position))
+    parts.append('%is' % (end-start))
+    position=end
+  return struct.Struct('='+''.join(parts));
+
+def read_table(mapped,table,first,typed=False):
+  '''## Decode the data lines of the MappedFile [mapped], from line [first] on, with the
+  # column [table], a list of Columns, each one:
+  #
+  # name       the variable name
+  # start,end  the position of the values in each data line, using python indexing, or
+  #            None for a column the script fills in itself, like the file name
+  # units      the units as a string, a (header line, start, end) slice of the units out
+  #            of a header line of the file, or None for no units
+  # type       the type of the values, 'i' integer, 'f' float or 's' text; the values are
+  #            returned as text, or with [typed] the 'i' and 'f' columns as TypedColumns
+  #            (see type_column)
+  #
+  # Returns an ordered dictionary of {'Units':units,'data':values} per column, in the
+  # order of [table]; columns without units have no 'Units' and columns without a
+  # position no 'data'. Every data line is unpacked in one call of a struct compiled from
+  # the table (see compile_struct), lines shorter than the table are sliced field by field.
+  '''
+  sliced=[column for column in table if column.start is not None]
+  fields=[(column.start,column.end) for column in sliced]
+  unpack=compile_struct(fields)
+  decode=compile_layout(fields)
+  buffer=mapped.buffer
+  if unpack is None:
+    rows=[decode(buffer[start:end]) for start,end in itertools.izip(mapped.starts[first:],mapped.ends[first:])]
+  else:
+    size=unpack.size
+    unpack_from=unpack.unpack_from
+    rows=[unpack_from(buffer,start) if end-start>=size else decode(buffer[start:end])\
+          for start,end in itertools.izip(mapped.starts[first:],mapped.ends[first:])]
+  columns=dict(zip([column.name for column in sliced],zip(*rows) if rows else [()]*len(sliced)))
+  del rows # the typed columns below replace their strings one column at a time
+  result=collections.OrderedDict()
+  for column in table:
+    result[column.name]={}
+    if isinstance(column.units,tuple): # from a header line
+      record,start,end=column.units
+      result[column.name]['Units']=mapped.line(record)[start:end]
+    elif column.units is not None:
+      result[column.name]['Units']=column.units
+    if column.name in columns:
+      result[column.name]['data']=columns[column.name]
+      if typed and column.type in ('i','f'):
+        result[column.name]['data']=type_column(columns[column.name])
+  return result;
+
+def cached_layout(format_file,parse):
+  '''## The layout parse([format_file]), a tuple of Fields, kept in the cache file
+  # format_file.layout next to the format file. The cache is keyed by the md5 hash of
+  # the format file, so the format file is only parsed again when it changed. The
+  # layout is immutable, so it can be shared by every data file without copies.
+  #
+  # Returns (layout, hash of the format file).
+  '''
+  digest=file_signature(format_file)['hash']
+  cache_file=format_file+'.layout'
+  try:
+    with open(cache_file,'rb') as f:
+      entry=cPickle.load(f)
+    if entry.get('version')==LAYOUT_CACHE_VERSION and entry.get('hash')==digest:
+      return entry['layout'],digest;
+  except (IOError,EOFError,cPickle.UnpicklingError,AttributeError,ValueError,ImportError):
+    pass # not cached yet, or a cache file we can't read
+  layout=tuple(parse(format_file))
+  try:
+    write_pickle(cache_file,{'version':LAYOUT_CACHE_VERSION,'hash':digest,'layout':layout})
+  except (IOError,OSError):
+    print "Could not write the layout cache",cache_file
+  return layout,digest;
+
+## Data files smaller than this are read into memory by MappedFile instead of mapped
+MAPPED_FILE_MIN_SIZE=1<<20
+
+class MappedFile(object):
+  '''## A data file [path], memory mapped instead of read line by line. Only the offsets
+  # of the lines are kept; the text stays in the mapped file, which the operating system
+  # shares with its page cache. A map keeps a file descriptor open for as long as any
+  # column of the file is used, so files smaller than MAPPED_FILE_MIN_SIZE, like the
+  # casts, are read into one string instead, and thousands of them can be kept. For
+  # example, the header and the first field of the data lines after a 6 line header:
+  #
+  # mapped=MappedFile('hot-1/h01a0201.ctd')
+  # first_line=mapped.line(0)
+  # pressure=mapped.column(0,8,6)
+  #
+  # With [lines] only the first [lines] lines are found, e.g. the header of a file whose
+  # data block is decoded at once, and the text after them is rest().
+  '''
+  def __init__(self,path,lines=None):
+    with open(path,'rb') as f:
+      size=os.fstat(f.fileno()).st_size
+      if size<MAPPED_FILE_MIN_SIZE: # an empty file can't be mapped either
+        self.buffer=f.read()
+      else:
+        self.buffer=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    ## the start and end of every line, without the newline
+    self.starts=array.array('l')
+    self.ends=array.array('l')
+    start=0
+    find=self.buffer.find
+    while start<size and (lines is None or len(self.starts)<lines):
+      end=find('\n',start)
+      if end<0: # no newline after the last line
+        end=size
+      self.starts.append(start)
+      self.ends.append(end)
+      start=end+1
+
+  def __len__(self):
+    return len(self.starts);
+
+  def rest(self):
+    '''## The text of the file after the lines that were found, '' when there is none.
+    '''
+    return self.buffer[self.ends[-1]+1 if self.starts else 0:];
+
+  def line(self,index):
+    '''## Line [index] of the file without the newline, or '' past the end of the file.
+    '''
+    if index>=len(self.starts):
+      return '';
+    return self.buffer[self.starts[index]:self.ends[index]];
+
+  def column(self,start,end,first=0):
+    '''## The field [start:end] of every line from line [first] on, see MappedColumn.
+    '''
+    return MappedColumn(self.buffer,self.starts[first:],self.ends[first:],start,end);
+
+class MappedColumn(object):
+  '''## One fixed-width field [start:end] of a range of lines of a MappedFile. It behaves
+  # like the list of strings line[start:end] of those lines, with the newline left out,
+  # but each value is only sliced out of the mapped file when it is read. Pickling a
+  # MappedColumn, like the parse cache does, stores it as a plain list.
+  '''
+  __slots__=('buffer','starts','ends','start','end')
+  def __init__(self,buffer,starts,ends,start,end):
+    self.buffer=buffer
+    self.starts=starts
+    self.ends=ends
+    self.start=start
+    self.end=end
+
+  def __len__(self):
+    return len(self.starts);
+
+  def __getitem__(self,index):
+    if isinstance(index,slice):
+      return [self[i] for i in xrange(*index.indices(len(self)))];
+    line_start=self.starts[index]
+    line_end=self.ends[index]
+    return self.buffer[min(line_start+self.start,line_end):min(line_start+self.end,line_end)];
+
+  def __iter__(self):
+    buffer=self.buffer
+    start=self.start
+    end=self.end
+    for line_start,line_end in itertools.izip(self.starts,self.ends):
+      yield buffer[min(line_start+start,line_end):min(line_start+end,line_end)]
+
+  def __reduce__(self):
+    return (list,(list(self),));
+
+class TypedColumn(object):
+  '''## A numeric column of a data file, kept as numbers instead of one string per value:
+  # the [values] in an array('d') and a [mask], a bytearray with 1 for every missing
+  # value (-9 in the HOT files), whose value is nan. Reading the column gives back the
+  # text the values were read from, formatted with [format], e.g. '%7.3f', and the text
+  # of the missing values [missing], so a TypedColumn reads like the list of strings it
+  # replaces; the values are only formatted when they are read. Made by type_column.
+  #
+  # column=type_column(['  7.928','     -9','  0.085'])
+  # column.values -> array('d', [7.928, nan, 0.085]), column.mask -> bytearray(b'\x00\x01\x00')
+  # list(column) -> ['  7.928','     -9','  0.085']
+  #
+  # A slice of the column, e.g. column[1:], is a TypedColumn of those values.
+  '''
+  def __init__(self,values,mask,format,missing):
+    self.values=values
+    self.mask=mask
+    self.format=format # None when every value is missing
+    self.missing=missing # None when no value is missing
+
+  def __len__(self):
+    return len(self.values);
+
+  def __getitem__(self,index):
+    if isinstance(index,slice):
+      return TypedColumn(self.values[index],self.mask[index],self.format,self.missing);
+    if self.mask[index]:
+      return self.missing;
+    return self.format % self.values[index];
+
+  def __iter__(self):
+    format=self.format
+    missing=self.missing
+    for value,masked in itertools.izip(self.values,self.mask):
+      yield missing if masked else format % value
+
+  def __getstate__(self): # the arrays as bytes, much smaller than a list of floats
+    return (self.values.tostring(),str(self.mask),self.format,self.missing);
+
+  def __setstate__(self,state):
+    values,mask,self.format,self.missing=state
+    self.values=array.array('d')
+    self.values.fromstring(values)
+    self.mask=bytearray(mask)
+
+  def copy(self):
+    '''## A copy of the column, with its own arrays.'''
+    return TypedColumn(array.array('d',self.values),bytearray(self.mask),self.format,self.missing);
+
+  def extend(self,other):
+    '''## Append the values of the TypedColumn [other], if it is written the same way, and
+    # return True; otherwise leave the column as it is and return False.
+    '''
+    if None not in (self.format,other.format) and self.format!=other.format or \
+       None not in (self.missing,other.missing) and self.missing!=other.missing:
+      return False;
+    self.values.extend(other.values)
+    self.mask.extend(other.mask)
+    self.format=self.format or other.format
+    self.missing=self.missing or other.missing
+    return True;
+
+  def compress(self,selectors):
+    '''## A new TypedColumn of the values whose [selectors] are true, as itertools.compress.'''
+    return TypedColumn(array.array('d',itertools.compress(self.values,selectors)),\
+                       bytearray(itertools.compress(self.mask,selectors)),self.format,self.missing);
+
+def type_column(texts,missing=-9):
+  '''## The column of fixed-width numbers [texts] as a TypedColumn, with the values equal to
+  # [missing] in its mask. The format is taken from the first value that isn't missing:
+  # its width and the digits after its decimal point, e.g. '%7.3f' for '  7.928'.
+  #
+  # A column is only typed when every value reads back as the same text, so typing never
+  # changes the output: when a value isn't a number, isn't written the same way as the
+  # first one (e.g. padded differently or with an exponent) or the missing values aren't
+  # all written the same way, [texts] is returned as it is. So is an empty column. The
+  # whole column is converted and checked at once, with one format of all its values.
+  '''
+  try:
+    numbers=map(float,texts)
+  except ValueError: # not a number
+    return texts;
+  if not numbers:
+    return texts;
+  if missing in numbers:
+    mask=bytearray(number==missing for number in numbers)
+    missing_texts=set(itertools.compress(texts,mask))
+    if len(missing_texts)>1: # not all written the same way
+      return texts;
+    missing_text=missing_texts.pop()
+    present=[not masked for masked in mask]
+    present_texts=list(itertools.compress(texts,present))
+    present_numbers=list(itertools.compress(numbers,present))
+    nan=float('nan')
+    numbers=[nan if masked else number for number,masked in itertools.izip(numbers,mask)]
+  else:
+    mask=bytearray(len(numbers))
+    missing_text=None
+    present_texts=texts
+    present_numbers=numbers
+  format=None
+  if present_texts:
+    number=present_texts[0].strip()
+    point=number.find('.')
+    format='%%%i.%if' % (len(present_texts[0]),len(number)-point-1 if point>=0 else 0)
+    # all the same width, so each formatted value has to match its own text
+    if len(set(map(len,present_texts)))!=1 or \
+       (format*len(present_texts)) % tuple(present_numbers)!=''.join(present_texts):
+      return texts;
+  return TypedColumn(array.array('d',numbers),mask,format,missing_text);
+
+class RunColumn(object):
+  '''## A column of repeated values, kept as runs: each value once, with the row the run
+  # ends before, instead of one entry per row. A constant column, like the latitude of
+  # every row, is a single run. It reads like the list it replaces; the runs are only
+  # expanded when the column is iterated, e.g. by the csv writer.
+  #
+  # column=RunColumn('hot1-12.pp',84) # the file name of 84 rows
+  # column.append('hot13-14.pp',42)
+  # len(column) -> 126, column[100] -> 'hot13-14.pp'
+  #
+  # A slice of the column, e.g. column[1:], is a RunColumn of those rows.
+  '''
+  def __init__(self,value=None,length=0):
+    self.values=[]
+    self.ends=[]
+    self.append(value,length)
+
+  def __len__(self):
+    return self.ends[-1] if self.ends else 0;
+
+  def __getitem__(self,index):
+    if isinstance(index,slice):
+      start,stop,step=index.indices(len(self))
+      column=RunColumn()
+      if step!=1: # row by row
+        for row in xrange(start,stop,step):
+          column.append(self[row])
+      elif start<stop: # the part of each run between start and stop
+        for run in xrange(bisect.bisect_right(self.ends,start),bisect.bisect_right(self.ends,stop-1)+1):
+          run_start=self.ends[run-1] if run else 0
+          column.append(self.values[run],min(self.ends[run],stop)-max(run_start,start))
+      return column;
+    if index<0:
+      index+=len(self)
+    if not 0<=index<len(self):
+      raise IndexError('RunColumn index out of range')
+    return self.values[bisect.bisect_right(self.ends,index)];
+
+  def __iter__(self):
+    return itertools.chain.from_iterable(itertools.imap(itertools.repeat,self.values,self.lengths()));
+
+  def lengths(self):
+    '''## The number of rows of each run.'''
+    return [end-start for start,end in itertools.izip([0]+self.ends,self.ends)];
+
+  def append(self,value,length=1):
+    '''## Append [length] rows of [value], continuing the last run if it has the same value.'''
+    if length<=0:
+      return;
+    if self.values and self.values[-1]==value:
+      self.ends[-1]+=length
+    else:
+      self.ends.append(len(self)+length)
+      self.values.append(value)
+
+  def extend(self,other):
+    '''## Append the rows of [other], run by run if it is a RunColumn.'''
+    if isinstance(other,RunColumn):
+      for value,length in itertools.izip(other.values,other.lengths()):
+        self.append(value,length)
+    else:
+      for value in other:
+        self.append(value)
+
+  def copy(self):
+    '''## A copy of the column, with its own runs.'''
+    column=RunColumn()
+    column.values=list(self.values)
+    column.ends=list(self.ends)
+    return column;
+
+  def compress(self,selectors):
+    '''## A new RunColumn of the rows whose [selectors] are true, as itertools.compress.'''
+    column=RunColumn()
+    for value in itertools.compress(self,selectors):
+      column.append(value)
+    return column;
+
+def extend_column(column,data):
+  '''## Append the values of [data] to [column], a list of strings, a TypedColumn or a
+  # RunColumn, and return the column; with [column] None a new column is started from a
+  # copy of [data]. Typed columns stay typed as long as they are written the same way
+  # and RunColumns stay runs, otherwise the column becomes a list.
+  '''
+  if isinstance(data,(TypedColumn,RunColumn)):
+    if column is None:
+      return data.copy();
+    if isinstance(column,TypedColumn) and isinstance(data,TypedColumn) and column.extend(data):
+      return column;
+    if isinstance(column,RunColumn) and isinstance(data,RunColumn):
+      column.extend(data)
+      return column;
+  elif column is None:
+    return list(data);
+  if not isinstance(column,list):
+    column=list(column)
+  column.extend(data)
+  return column;
+
+def compress_column(data,selectors):
+  '''## The values of the column [data] whose [selectors] are true, as itertools.compress,
+  # keeping a TypedColumn typed and a RunColumn in runs.
+  '''
+  if isinstance(data,(TypedColumn,RunColumn)):
+    return data.compress(selectors);
+  return list(itertools.compress(data,selectors));
+
+def decode_columns_numpy(block,fields):
+  '''## Decode a block of fixed-width data lines [block], read from the file as one string,
+  # into one numpy array per field in [fields]. [fields] is a list of (start,end)
+  # positions, the same as compile_layout. The block is viewed as one row of characters
+  # per line and every field of every line is checked and converted at once, see
+  # fixed_point_numpy, instead of slicing every field of every line.
+  #
+  # Numeric fields become float arrays with nan for blank values. The output is a list
+  # with one (array, format) per field, where format is the '%8.4f' style format that
+  # gives back the text of every value of the field, with the blanks written as spaces of
+  # the field width; see format_column_numpy. A field is only numeric when every value is
+  # a plain decimal number right aligned in the field, with the point in the same place.
+  # Any other field, e.g. -9 in a column of 142.6, or 1.5e3, is returned as an array of
+  # its text, as it is in the lines, with the format None, so the values are never
+  # rounded or reformatted.
+  '''
+  if numpy is None:
+    raise ImportError("decode_columns_numpy requires the numpy package")
+  width=max(end for start,end in fields)
+  size=block.find('\n')+1 # the length of the lines, with the newline
+  if block and not block.endswith('\n'):
+    block+='\n'
+  regular=size>width and len(block)%size==0
+  if regular: # every line has the same length, view the block as it is
+    chars=numpy.frombuffer(block,dtype=numpy.uint8).reshape(len(block)//size,size)
+    regular=(chars[:,-1]==10).all() and not (chars[:,:-1]==10).any()
+  if not regular: # lines of different lengths, short lines are padded with zero bytes
+    lines=block.split('\n')
+    lines.pop() # the block ends with a newline
+    if len(lines)==0:
+      return [(numpy.array([]),None) for field in fields]
+    block=numpy.array(lines,dtype='S%i'%width).tostring()
+    size=width
+    chars=numpy.frombuffer(block,dtype=numpy.uint8).reshape(len(lines),size)
+  values,formats=fixed_point_numpy(chars,fields)
+  columns=[]
+  for i,(start,end) in enumerate(fields):
+    if formats[i] is None: # not written as the same fixed point number, keep the text
+      text=numpy.ascontiguousarray(chars[:,start:end]).view('S%i'%(end-start)).ravel()
+      columns.append((text,None))
+    else:
+      columns.append((values[:,i].copy(),formats[i]))
+  return columns;
+
+def fixed_point_numpy(chars,fields):
+  '''## The values of the [fields], (start,end) positions, of the lines given as [chars], one
+  # row of uint8 characters per line, as fixed point numbers. Every value of a field that
+  # isn't all spaces has to be what '%w.df' writes, w the field width and d the decimals:
+  # right aligned, an optional minus sign, the digits of the integer part without leading
+  # zeros, and d digits after the point, the point in the same place in every line. The
+  # fields are lined up right aligned and checked and converted all at once: a value is
+  # the integer of its digits divided by 10 to the d, which is the float its text reads as.
+  #
+  # Returns (values, formats): a float array of a column per field, nan for the blank
+  # values, and the format of each field, '%w.df', or None when the field isn't like that.
+  '''
+  lines=len(chars)
+  count=len(fields)
+  widths=numpy.array([end-start for start,end in fields])
+  length=widths.max()
+  ## field_chars[line,field,position], right aligned, padded on the left with spaces
+  spaces=numpy.zeros((lines,1),dtype=numpy.uint8)+32
+  chars=numpy.hstack([chars,spaces])
+  position=numpy.zeros((count,length),dtype=numpy.intp)+(chars.shape[1]-1) # the spaces
+  for i,(start,end) in enumerate(fields):
+    position[i,length-(end-start):]=numpy.arange(start,end)
+  field_chars=chars[:,position]
+  space=(field_chars==32)
+  digit=(field_chars>=48)&(field_chars<=57)
+  blank=space.all(axis=2)
+  ## the decimals of each field, from the point of its first value that isn't blank
+  first=numpy.argmax(~blank,axis=0)
+  sample=field_chars[first,numpy.arange(count)]
+  has_point=(sample==46).any(axis=1)
+  decimals=numpy.where(has_point,length-1-numpy.argmax(sample==46,axis=1),0)
+  decimals=numpy.where(decimals<widths,decimals,0) # a point in the padding can't be
+  column=numpy.arange(length)
+  point=numpy.where(decimals>0,length-1-decimals,length) # past the end without a point
+  units=point-1 # the last digit of the integer part
+  after=column[None,:]>point[:,None] # the digits after the point
+  whole=column[None,:]<point[:,None]
+  ## the integer part: spaces, an optional minus sign, then digits up to the point
+  leading=numpy.logical_and.accumulate(space&whole,axis=2)
+  start=whole&~leading&numpy.concatenate([numpy.ones((lines,count,1),dtype=bool),leading[:,:,:-1]],axis=2)
+  minus=start&(field_chars==45)
+  first_digit=digit&(start|numpy.concatenate([numpy.zeros((lines,count,1),dtype=bool),minus[:,:,:-1]],axis=2))
+  good=numpy.where(after,digit,True).all(axis=2)&\
+       numpy.where(column[None,:]==point[:,None],field_chars==46,True).all(axis=2)&\
+       numpy.where(whole,digit|leading|minus,True).all(axis=2)&\
+       digit[:,numpy.arange(count),units]&\
+       ~(first_digit&(field_chars==48)&(column[None,:]<units[:,None])).any(axis=2)
+  numeric=(good|blank).all(axis=0)&(units>=length-widths)
+  ## the integer of the digits, each digit times its place, the point has none
+  place=numpy.zeros((count,length),dtype=numpy.int64)
+  for i in range(count):
+    places=numpy.flatnonzero((column<point[i])|(column>point[i]))
+    place[i,places]=10**numpy.arange(len(places)-1,-1,-1,dtype=numpy.int64)
+  number=(numpy.where(digit,field_chars-48,0).astype(numpy.int64)*place).sum(axis=2)
+  values=number/10.0**decimals
+  values[minus.any(axis=2)]*=-1
+  values[blank]=numpy.nan
+  formats=[('%%%i.%if' % (width,places)) if ok else None \
+           for width,places,ok in zip(widths,decimals,numeric)]
+  return values,formats;
+
+def format_column_numpy(values,format,as_list=True):
+  '''## Format a column decoded by decode_columns_numpy back into the text it was read
+  # from, with the [format] of the column, e.g. '%8.4f'. Blank (nan) values are written
+  # as spaces of the field width. A text column, [format] None, is returned as it is.
+  # Returns a list of strings, or with [as_list] False the numpy array of them.
+  #
+  # The digits of all the values are written at once, from the values rounded to
+  # integers of the last decimal. That is the text of format % value for the values
+  # decode_columns_numpy reads, which fit their field.
+  '''
+  if format is None: # text field
+    return values.tolist() if as_list else values;
+  width,decimals=[int(part) for part in format[1:-1].split('.')]
+  blank=numpy.isnan(values)
+  negative=numpy.signbit(values)&~blank
+  number=numpy.rint(numpy.abs(numpy.where(blank,0,values))*10**decimals).astype(numpy.int64)
+  point=width-decimals-1 if decimals else width
+  slots=[position for position in range(width) if position!=point] # right to left below
+  powers=10**numpy.arange(len(slots),dtype=numpy.int64)
+  ## digit k of each value, the units and the decimals always, the others while there are any
+  written=(number[:,None]>=powers)|(numpy.arange(len(slots))<=decimals)
+  digits=numpy.where(written,48+number[:,None]//powers%10,32).astype(numpy.uint8)
+  sign=written.sum(axis=1) # the slot left of the digits
+  rows=numpy.flatnonzero(negative&(sign<len(slots)))
+  digits[rows,sign[rows]]=45
+  chars=numpy.empty((len(values),width),dtype=numpy.uint8)
+  chars[:,slots[::-1]]=digits
+  if decimals:
+    chars[:,point]=46
+  chars[blank]=32
+  text=chars.view('S%i'%width).ravel()
+  return text.tolist() if as_list else text;
 
 def process_cruise_sum(sum_files):
   '''
@@ -76,53 +776,683 @@ def process_cruise_sum(sum_files):
   # '../cruise.summaries/hot2.sum'
   #
   # The output is a dictionary with keys identified from the expo code, station number and
-  # cast number.
+  # cast number, and one CruiseSum record per cast.
   # 
   #
   '''
-  sum_title={}
-  sum_head={}
-  sum_unit={}
   result={}
   for sum_key in sum_files:
-    sumfile = open(sum_key,'r') # open the file
-    sum_key=sum_key.replace("../","") # make the key more readable
-    ## Process the header of the file
-    sum_title[sum_key]=sumfile.readline() # line 1
-    sum_head[sum_key]=sumfile.readline() # line 2
-    sum_unit[sum_key]=sumfile.readline() # line 3
-    sumfile.readline() ## skip the --- line 4
-    
-    for line in sumfile: # iterate through each data line and parse on position
-      ## Error checking to see if identity code already exists
-      if line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip() in result.keys(): 
-        print line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip(),"is already defined in the dictionary."
-        print "Exiting!"
-        sys.exit()
-      else: # write the summary and do year converstions <-- add station and cast no to this
-        result[line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip()]=\
-          {'Ship':line[0:9].strip(),\
-          'Date':line[30:37].strip(),\
-          'Month':int(line[31:33]),\
-          'Day':line[33:35].strip(),\
-          'Year':int(line[35:37])+2000 if int(line[35:37])<80 else int(line[35:37])+1900,\
-          'section':line[9:15].strip(),\
-          'timeutc':line[37:42].strip(),\
-          'timecode':line[42:46].strip(),\
-          'lat':line[46:58],\
-          'lon':line[58:71],\
-          'nav_code':line[71:76].strip(),\
-          'depth_max':line[76:82].strip(),\
-          'depth_hgt':line[82:87].strip(),\
-          'pres_max':line[87:92].strip(),\
-          'num_bottles':line[92:99].strip(),\
-          'parameters':line[99:112].strip(),\
-          'comments':line[112:].strip(),\
-          'bcodmo_comment':'key built as expocode.station.cast',\
-          'HOT_summary_file_name':sum_key}
-        # simplifying to just save the entire line
-#        result[line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip()]=[line]
-        # create the dictionary, the key is result[EXPOCODE.STATION.CAST] then all
-        # the attributes are pulled from the summary file  If year is less than 80 make it a 2000
+    merge_cruise_sum(result,process_cruise_sum_file(sum_key))
+  return result;
+
+def process_cruise_sum_file(sum_key):
+  '''## Process a single cruise.summaries/*.sum file [sum_key] into a dictionary with keys
+  # identified from the expo code, station number and cast number, of CruiseSum records.
+  # See process_cruise_sum.
+  '''
+  result={}
+  sumfile = open(sum_key,'r') # open the file
+  sum_key=sum_key.replace("../","") # make the key more readable
+  ## Process the header of the file
+  sum_title=sumfile.readline() # line 1
+  sum_head=sumfile.readline() # line 2
+  sum_unit=sumfile.readline() # line 3
+  sumfile.readline() ## skip the --- line 4
+
+  for line in sumfile: # iterate through each data line and parse on position
+    ## Error checking to see if identity code already exists
+    if line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip() in result: 
+      print line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip(),"is already defined in the dictionary."
+      print "Exiting!"
+      sys.exit()
+    else: # write the summary and do year converstions <-- add station and cast no to this
+      # the fields that repeat from cast to cast are interned, so the casts share them
+      result[line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip()]=CruiseSum(\
+        Ship=intern(line[0:9].strip()),\
+        Date=intern(line[30:37].strip()),\
+        Month=int(line[31:33]),\
+        Day=intern(line[33:35].strip()),\
+        Year=int(line[35:37])+2000 if int(line[35:37])<80 else int(line[35:37])+1900,\
+        section=intern(line[9:15].strip()),\
+        timeutc=line[37:42].strip(),\
+        timecode=intern(line[42:46].strip()),\
+        lat=line[46:58],\
+        lon=line[58:71],\
+        nav_code=intern(line[71:76].strip()),\
+        depth_max=line[76:82].strip(),\
+        depth_hgt=line[82:87].strip(),\
+        pres_max=line[87:92].strip(),\
+        num_bottles=intern(line[92:99].strip()),\
+        parameters=intern(line[99:112].strip()),\
+        comments=intern(line[112:].strip()),\
+        HOT_summary_file_name=sum_key)
+      # simplifying to just save the entire line
+#      result[line[0:9].strip()+'.'+line[15:20].strip()+'.'+line[20:24].strip()]=[line]
+      # create the record, the key is result[EXPOCODE.STATION.CAST] then all
+      # the attributes are pulled from the summary file  If year is less than 80 make it a 2000
   sumfile.close()
   return result;
+
+def merge_cruise_sum(result,file_result):
+  '''## Add the entries of one processed summary file [file_result] to [result], exiting if
+  # an identity code is already defined by another summary file.
+  '''
+  for key in file_result:
+    if key in result:
+      print key,"is already defined in the dictionary."
+      print "Exiting!"
+      sys.exit()
+  result.update(file_result)
+  return result;
+
+def join_cruise_sum(idents,cruise_sum):
+  '''## Join a list of identifiers [idents], built as expocode.station.cast, against the
+  # cruise summaries [cruise_sum] from process_cruise_sum or load_cruise_sum. Every
+  # identifier is a single dictionary lookup, so the join costs time proportional to the
+  # number of identifiers.
+  #
+  # Returns (matched,missing) where,
+  # matched is a list with one entry per identifier, the cruise summary entry or None if
+  # the identifier is not in the cruise summaries.
+  # missing is the list of identifiers that are not in the cruise summaries, in the order
+  # they were first seen, without repeats.
+  '''
+  matched=[cruise_sum.get(ident) for ident in idents]
+  missing=[]
+  seen=set()
+  for ident,cruise_sum_entry in zip(idents,matched):
+    if cruise_sum_entry is None and ident not in seen:
+      seen.add(ident)
+      missing.append(ident)
+  return matched,missing;
+
+def iso_date_time(date,time,missing='-9'):
+  '''## The ISO 8601 date time YYYY-MM-DDTHH:MM:00 of a [date] yymmdd, with the leading
+  # zeros left out, and a [time] hhmm. Years 30 to 99 are 19xx, the others 20xx. A time
+  # of 2400 or more is carried into the following days by the calendar, e.g. 891231 and
+  # 2530 is 1990-01-01T01:30:00. If either one is [missing], or empty, so is the result.
+  # A date that isn't on the calendar is written out as it is, without carrying.
+  '''
+  date=date.strip()
+  time=time.strip()
+  if date in (missing,'') or time in (missing,''):
+    return missing;
+  date='%06i' % int(date)
+  year=int(date[0:2])
+  year+=1900 if year>=30 else 2000
+  hours,minutes=divmod(int(time),100)
+  try:
+    stamp=datetime.datetime(year,int(date[2:4]),int(date[4:6]))+\
+          datetime.timedelta(hours=hours,minutes=minutes)
+  except ValueError: # not a date on the calendar
+    return '%04i-%s-%sT%02i:%02i:00' % (year,date[2:4],date[4:6],hours,minutes);
+  return '%04i-%02i-%02iT%02i:%02i:00' % (stamp.year,stamp.month,stamp.day,stamp.hour,stamp.minute);
+
+def normalize_date_times(dates,times,missing='-9'):
+  '''## The columns of [dates] and [times] as one column of ISO 8601 date times, see
+  # iso_date_time. Every distinct pair of date and time is converted once, the rows of a
+  # cruise mostly repeat the same few dates and times.
+  '''
+  converted={}
+  result=[]
+  for pair in itertools.izip(dates,times):
+    value=converted.get(pair)
+    if value is None:
+      value=converted[pair]=iso_date_time(pair[0],pair[1],missing)
+    result.append(value)
+  return result;
+
+def read_index(index_file,version):
+  '''## Read the dictionary of files kept in the pickled index [index_file]. An index that
+  # doesn't exist, can't be read or was written with another [version] is empty.
+  '''
+  try:
+    with open(index_file,'rb') as f:
+      index=cPickle.load(f)
+  except (IOError,EOFError,cPickle.UnpicklingError,AttributeError,ValueError):
+    return {} # no index yet, or one we can't read, start over
+  if not isinstance(index,dict) or index.get('version')!=version:
+    return {}
+  return index.get('files',{});
+
+def write_index(index_file,version,files):
+  '''## Write the dictionary of [files] to the pickled index [index_file]. The index is
+  # written to a temporary file first and replaces the old one in one step, see
+  # write_pickle, so an interrupted run never leaves half an index behind.
+  '''
+  try:
+    write_pickle(index_file,{'version':version,'files':files})
+  except (IOError,OSError):
+    print "Could not write the index",index_file
+
+def write_pickle(path,entry):
+  '''## Pickle [entry] to [path] through a temporary file of its own in the same
+  # directory, renamed over [path] in one step. Runs writing the same cache or index
+  # at the same time each write their own file, and the last rename wins.
+  '''
+  directory,name=os.path.split(os.path.abspath(path))
+  handle,temporary=tempfile.mkstemp(prefix=name+'.',suffix='.tmp',dir=directory)
+  try:
+    umask=os.umask(0)
+    os.umask(umask)
+    os.chmod(temporary,0666&~umask) # mkstemp makes it owner only, open would follow the umask
+    with os.fdopen(handle,'wb') as f:
+      cPickle.dump(entry,f,cPickle.HIGHEST_PROTOCOL)
+    os.rename(temporary,path)
+  except:
+    if os.path.exists(temporary):
+      os.remove(temporary)
+    raise
+
+def file_signature(path,entry=None):
+  '''## The size, modification time and md5 hash of the contents of the file [path]. If
+  # [entry] is the signature from a previous run and the size and modification time
+  # still match, its hash is reused instead of reading the file again.
+  '''
+  stat=os.stat(path)
+  if entry is not None and entry.get('size')==stat.st_size and entry.get('mtime')==stat.st_mtime:
+    return {'size':stat.st_size,'mtime':stat.st_mtime,'hash':entry['hash']};
+  digest=hashlib.md5()
+  with open(path,'rb') as f:
+    for block in iter(lambda: f.read(1<<20),''):
+      digest.update(block)
+  return {'size':stat.st_size,'mtime':stat.st_mtime,'hash':digest.hexdigest()};
+
+def cached_parse(data_file,parse,cache_dir,tag,listed=False):
+  '''## The result of parse([data_file]), kept in a cache file in [cache_dir]. [parse] is
+  # one of the process functions of the update scripts, it takes a list of files and
+  # returns a dictionary keyed by file. The cache file is named after [tag] and the path
+  # of the file, and holds the signature of the file (see file_signature) next to the
+  # result. The file is only parsed again when its hash changed; [tag] should change
+  # whenever anything else the result depends on changes, like a format file.
+  #
+  # The hash of the file is only computed again when its size or modification time
+  # changed, unless the file is [listed] as changed, e.g. by the --changed option.
+  '''
+  cache_file=os.path.join(cache_dir,'%s.%s.parse' % (tag,hashlib.md5(data_file).hexdigest()))
+  try:
+    with open(cache_file,'rb') as f:
+      entry=cPickle.load(f)
+    if entry.get('version')!=PARSE_CACHE_VERSION:
+      entry=None
+  except (IOError,EOFError,cPickle.UnpicklingError,AttributeError,ValueError,ImportError):
+    entry=None # not cached yet, or a cache file we can't read
+  signature=file_signature(data_file,None if entry is None or listed else entry['signature'])
+  if entry is not None and entry['signature']['hash']==signature['hash']:
+    return entry['data'];
+  # keep the order of each file's variables, the scripts write the columns in that order
+  data=dict((key,collections.OrderedDict(value.items()) if isinstance(value,dict) else value)\
+            for key,value in dict(parse([data_file])).items())
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    write_pickle(cache_file,{'version':PARSE_CACHE_VERSION,'signature':signature,'data':data})
+  except (IOError,OSError):
+    print "Could not write the parse cache",cache_file
+  return data;
+
+def cache_tag(name,*parts):
+  '''## The [name] of a parse cache, see cached_parse, tagged with the md5 hash of [parts],
+  # e.g. the version of the parse function and its column table, so the cached results
+  # are parsed again when any of them changes:
+  #
+  # HOT_functions.cache_tag('pp',PP_PARSE_VERSION,pp_table)
+  '''
+  return '%s-%s' % (name,hashlib.md5(repr(parts)).hexdigest());
+
+def iter_parsed(data_files,parse,cache_dir=None,tag='parse',changed=None):
+  '''## Parse [data_files] one file at a time with [parse], see cached_parse, and yield
+  # (FILE,result[FILE]) for each file. With a [cache_dir] the results come from the
+  # parse cache when the file didn't change. [changed] is the set of files that changed,
+  # see read_changed. It is only a hint: the files in it are hashed again, the others
+  # are still checked by size and modification time, so a stale list costs no more than
+  # the hashing.
+  '''
+  for data_file in data_files:
+    if cache_dir is None:
+      parsed=parse([data_file])
+    else:
+      listed=changed is not None and os.path.abspath(data_file) in changed
+      parsed=cached_parse(data_file,parse,cache_dir,tag,listed)
+    for item in dict(parsed).items():
+      yield item
+
+def read_changed(changed_file):
+  '''## The set of files listed in [changed_file], e.g. the fetch.changed file HOT_getData.py
+  # writes, as absolute paths. Each line is a path relative to the directory of
+  # [changed_file], so the update scripts can compare it with their own data files:
+  #
+  # os.path.abspath(data_file) in HOT_functions.read_changed('../fetch.changed')
+  '''
+  base=os.path.dirname(os.path.abspath(changed_file))
+  with open(changed_file) as f:
+    return set(os.path.normpath(os.path.join(base,line.strip())) for line in f if line.strip());
+
+def write_changed(changed_file,paths):
+  '''## Add [paths] to the list of changed files [changed_file], see read_changed. The files
+  # already listed are kept, so the files of an earlier fetch the update scripts haven't
+  # seen yet are still listed. The list is only a hint to hash those files again, see
+  # iter_parsed, so it can be deleted to start over once the update scripts have run.
+  #
+  # [paths] are relative to the working directory, like the files of HOT_fetch.Fetcher.
+  # They are written relative to the directory of [changed_file], the way read_changed
+  # reads them, wherever the list is kept. Returns the number of files listed.
+  '''
+  base=os.path.dirname(os.path.abspath(changed_file))
+  listed=set(os.path.abspath(path) for path in paths)
+  if os.path.exists(changed_file):
+    listed.update(read_changed(changed_file))
+  with open(changed_file,'w') as f:
+    f.writelines([os.path.relpath(path,base)+'\n' for path in sorted(listed)])
+  return len(listed);
+
+def load_cruise_sum(sum_files,index_file):
+  '''## Same as process_cruise_sum, but keeps a persistent index of the processed summary
+  # files in [index_file]. The index holds the entries of every summary file along with
+  # the size and modification time of the file when it was processed. Only the summary
+  # files that are new, or whose size or modification time changed, are processed again;
+  # the rest come straight from the index. The index is rewritten when anything changed.
+  #
+  # The output is the same dictionary as process_cruise_sum, keyed by
+  # expocode.station.cast.
+  '''
+  cached=read_index(index_file,CRUISE_SUM_INDEX_VERSION)
+  files={}
+  changed=False
+  result={}
+  for sum_key in sum_files:
+    stat=os.stat(sum_key)
+    entry=cached.get(sum_key)
+    if entry is None or entry['mtime']!=stat.st_mtime or entry['size']!=stat.st_size:
+      entry={'mtime':stat.st_mtime,'size':stat.st_size,'data':process_cruise_sum_file(sum_key)}
+      changed=True
+    files[sum_key]=entry
+    merge_cruise_sum(result,entry['data'])
+  if changed or len(files)!=len(cached): # something was added, changed or removed
+    write_index(index_file,CRUISE_SUM_INDEX_VERSION,files)
+  return result;
+
+def sort_text(value):
+  '''## [value] as the text the csv module writes for it.
+  '''
+  if isinstance(value,str):
+    return value;
+  if isinstance(value,float):
+    return repr(value);
+  return str(value);
+
+def sort_number(value):
+  '''## The numeric value of [value] the way sort -n reads it: leading blanks are skipped
+  # and the longest leading number is used, so '  12.5' is 12.5 and a value that doesn't
+  # start with a number, like a header or a blank, is 0.
+  '''
+  match=sort_number_pattern.match(sort_text(value))
+  if match is None:
+    return 0.0;
+  return float(match.group(1));
+
+class reverse_text(str):
+  '''## Text that sorts in reverse, for the text keys of sort_key with a leading 'r'.
+  '''
+  __slots__=()
+  def __lt__(self,other):
+    return str.__gt__(self,other);
+  def __gt__(self,other):
+    return str.__lt__(self,other);
+  def __le__(self,other):
+    return str.__ge__(self,other);
+  def __ge__(self,other):
+    return str.__le__(self,other);
+
+## The number of converted values sort_key remembers for each key, before starting over
+SORT_KEY_CACHE_SIZE=10000
+
+def sort_key(header,keys):
+  '''## Build the key function for sorting rows with [header] on [keys], see sort_rows.
+  # The key of a row is a tuple of the value of each key, numbers negated and text wrapped
+  # in reverse_text for reversed keys. The rows with equal keys are put in the order of
+  # their whole line afterwards, see order_ties, so the line isn't part of every key.
+  # The key values repeat from row to row, e.g. the cruise and station of every bottle,
+  # so each key converts a value once and remembers it.
+  '''
+  converters=[]
+  for name,type in keys:
+    if name not in header:
+      raise ValueError("Can't sort on %s, there is no such column" % name)
+    if 'n' in type and 'r' in type:
+      convert=lambda value: -sort_number(value)
+    elif 'n' in type:
+      convert=sort_number
+    elif 'r' in type:
+      convert=lambda value: reverse_text(sort_text(value).lstrip())
+    else:
+      convert=lambda value: sort_text(value).lstrip()
+    converters.append((header.index(name),remember(convert)))
+  def key(row):
+    return tuple([convert(row[column]) for column,convert in converters]);
+  return key;
+
+def remember(convert):
+  '''## The function [convert] of one value, remembering the results of the last
+  # SORT_KEY_CACHE_SIZE distinct values.
+  '''
+  cache={}
+  def converted(value):
+    try:
+      return cache[value];
+    except KeyError:
+      if len(cache)>=SORT_KEY_CACHE_SIZE:
+        cache.clear()
+      result=cache[value]=convert(value)
+      return result;
+  return converted;
+
+def sort_line(row):
+  '''## The whole line of [row], the last resort of sort for rows with equal keys.'''
+  return ','.join([value if type(value) is str else sort_text(value) for value in row]);
+
+def order_ties(keyed):
+  '''## The rows of [keyed], (key, ..., row) tuples sorted on key, with the rows of equal
+  # keys put in the order of their whole line. Only the rows of one key are held at a time.
+  '''
+  for key,group in itertools.groupby(keyed,operator.itemgetter(0)):
+    rows=[entry[-1] for entry in group]
+    if len(rows)>1:
+      rows.sort(key=sort_line)
+    for row in rows:
+      yield row
+
+def sort_rows(header,rows,keys):
+  '''## Sort the [rows] of an output file, in memory, the same way as
+  # sort -b -t, -k... would sort the written file. [header] is the list of column names
+  # and [keys] is a list of (column name, type) to sort on, in order of precedence. The
+  # type uses the letters of sort: 'n' compares the values as numbers (see sort_number),
+  # '' compares them as text and a leading 'r' reverses that key. For example:
+  #
+  # sort_rows(header,rows,[('cruise_name','n'),('ROSETTE','rn')])
+  #
+  # Rows that are equal on every key are in the order of the whole line, like sort.
+  # Returns a new sorted list of the rows.
+  '''
+  key=sort_key(header,keys)
+  return list(order_ties(sorted([(key(row),row) for row in rows],key=operator.itemgetter(0))));
+
+def merge_rows(header,runs,keys,spill=None):
+  '''## Same order as sort_rows, for rows that come in [runs] which are mostly sorted
+  # already, like the rows of each data file one after the other. Each run is a function
+  # that returns a new iterator over the rows of the run, e.g. the runs of column_runs;
+  # called with a list of column indexes it returns only those columns of each row.
+  #
+  # Every run is checked in one pass over its key columns, and only sorted, on its own,
+  # when it is out of order. The runs are then merged lazily by heapq.merge, one row of
+  # each run at a time, so rows that come in order cost close to linear time and the
+  # keys in memory don't grow with the output.
+  #
+  # The runs that are out of order are all held at once, sorted, while merging. For the
+  # runs of text rows of csv_runs, give a temporary [spill] file instead: each of those
+  # runs is then sorted on its own, written to [spill] and merged back from there.
+  #
+  # Returns an iterator over the sorted rows, ready for csv writerows.
+  '''
+  key=sort_key(header,keys)
+  names=[name for name,type in keys]
+  check_key=sort_key(names,keys) # the key of the key columns alone
+  indexes=[header.index(name) for name in names]
+  merging=[]
+  for number,run in enumerate(runs):
+    previous=None
+    in_order=True
+    for row in run(indexes):
+      row_key=check_key(row)
+      if previous is not None and previous>row_key:
+        in_order=False
+        break
+      previous=row_key
+    if not in_order and spill is not None:
+      run=spill_run(spill,run,key,max(4096,CSV_RUN_BYTES//max(1,len(runs))))
+      in_order=True
+    merging.append(merge_run(run,key,number,in_order))
+  return order_ties(heapq.merge(*merging));
+
+def merge_run(run,key,number,in_order):
+  '''## The (key, [number], row) of every row of [run] for merge_rows, in the order of
+  # [key]. A run that isn't [in_order] is sorted in memory first. The number tells the
+  # runs apart, so heapq.merge doesn't compare the rows of equal keys.
+  '''
+  if not in_order:
+    keyed=[(key(row),number,row) for row in run()]
+    keyed.sort(key=operator.itemgetter(0))
+    for entry in keyed:
+      yield entry
+    return;
+  for row in run():
+    yield (key(row),number,row)
+
+def spill_run(spill,run,key,block):
+  '''## Sort [run] on [key] and write it at the end of the csv file [spill], for merge_rows.
+  # Returns the sorted run, read back from [spill] about [block] bytes at a time.
+  '''
+  rows=sorted(run(),key=key)
+  spill.seek(0,2)
+  start=spill.tell()
+  csv.writer(spill,lineterminator='\n').writerows(rows)
+  return csv_run(spill,start,len(rows),block);
+
+def column_runs(columns,run_lengths):
+  '''## The runs of the rows of a table kept as [columns], lists or the columns of this
+  # module, [run_lengths] rows each, for merge_rows. Rows past the runs are one more run.
+  # A run is only read when it is merged, through slices of the columns, so only the runs
+  # being merged are copied out of the columns at a time.
+  '''
+  starts=[0]
+  for length in run_lengths:
+    starts.append(starts[-1]+length)
+  rows=len(columns[0]) if columns else 0
+  if rows>starts[-1]:
+    starts.append(rows)
+  return [column_run(columns,start,end) for start,end in zip(starts,starts[1:]) if end>start];
+
+def column_run(columns,start,end):
+  '''## One run of column_runs, the rows [start:end] of [columns].'''
+  def run(indexes=None):
+    selected=columns if indexes is None else [columns[index] for index in indexes]
+    yield tuple([column[start] for column in selected]) # the first row without slicing
+    for row in itertools.izip(*[column[start+1:end] for column in selected]):
+      yield row
+  return run;
+
+## The bytes of text csv_runs reads at a time, shared by the runs being merged
+CSV_RUN_BYTES=1024*1024
+
+def csv_runs(f,run_lengths):
+  '''## The header and the runs of the rows of the csv file [f], open for reading, [run_lengths]
+  # rows each, for merge_rows. Rows past the runs are one more run. Only the offset where
+  # each run starts is kept; a run is read back a block of lines at a time when it is
+  # merged, CSV_RUN_BYTES over all the runs, so the file isn't loaded into memory. The
+  # runs share [f], keep it open while merging:
+  #
+  # with open('niskin.csv','rb') as f:
+  #   header,runs=HOT_functions.csv_runs(f,run_lengths)
+  #   rows=HOT_functions.merge_rows(header,runs,keys)
+  #   ...
+  '''
+  f.seek(0)
+  offset=[0]
+  reader=csv.reader(counted_lines(f,offset))
+  header=reader.next()
+  starts=[offset[0]]
+  lengths=[]
+  for length in run_lengths:
+    for row in itertools.islice(reader,length):
+      pass
+    starts.append(offset[0])
+    lengths.append(length)
+  rest=sum(1 for row in reader)
+  if rest:
+    starts.append(offset[0])
+    lengths.append(rest)
+  block=max(4096,CSV_RUN_BYTES//max(1,len(lengths)))
+  return header,[csv_run(f,start,length,block) for start,length in zip(starts,lengths) if length];
+
+def counted_lines(f,offset):
+  '''## The lines of [f] from where it is, adding the bytes read to [offset][0].'''
+  for line in iter(f.readline,''):
+    offset[0]+=len(line)
+    yield line
+
+def csv_run(f,start,length,block):
+  '''## One run of csv_runs, [length] rows of [f] from the byte [start], read about
+  # [block] bytes at a time.
+  '''
+  def run(indexes=None):
+    offset=[start]
+    left=length
+    while left:
+      f.seek(offset[0])
+      end=offset[0]+block
+      reader=csv.reader(counted_lines(f,offset))
+      rows=[]
+      while left and (not rows or offset[0]<end):
+        try:
+          rows.append(reader.next())
+        except StopIteration:
+          raise ValueError('%s ends before its runs, it has changed since they were found' % f.name)
+        left-=1
+      for row in rows:
+        yield tuple(row) if indexes is None else tuple([row[index] for index in indexes])
+  return run;
+
+class Metrics(object):
+  '''## Timings and counts of one run of an update script, for the --metrics report. Each
+  # stage of the run is timed between start(name) and stop(); starting a stage stops the
+  # one before it. Counts, like files, rows and bytes, are kept with count and add.
+  #
+  # metrics = HOT_functions.Metrics('HOT_niskin_update.py')
+  # metrics.start('parse')
+  # ...
+  # metrics.stop()
+  # metrics.add('rows_written',len(rows))
+  # metrics.write('niskin.metrics.json')
+  #
+  # The report is a JSON object with the script, the start time, the total time, each
+  # stage with its duration and the peak memory of the script when the stage ended, the
+  # counts, and the peak memory of the script and of its child processes.
+  '''
+  def __init__(self,script):
+    self.script=script
+    self.started=time.time()
+    self.stages=[]
+    self.counts=collections.OrderedDict()
+    self.current=None
+
+  def start(self,name):
+    '''## Start timing the stage [name], stopping the current stage first.'''
+    self.stop()
+    self.current=(name,time.time())
+
+  def stage(self):
+    '''## The name of the current stage, or None.'''
+    if self.current is None:
+      return None;
+    return self.current[0];
+
+  def stop(self):
+    '''## Stop timing the current stage, if any.'''
+    if self.current is None:
+      return;
+    name,started=self.current
+    self.current=None
+    self.stages.append(collections.OrderedDict([('name',name),\
+                                                ('seconds',round(time.time()-started,6)),\
+                                                ('peak_memory_kb',peak_memory())]))
+
+  def count(self,name,value):
+    '''## Set the count [name] to [value].'''
+    self.counts[name]=value
+
+  def add(self,name,value):
+    '''## Add [value] to the count [name].'''
+    self.counts[name]=self.counts.get(name,0)+value
+
+  def report(self):
+    '''## The report, as an ordered dictionary ready for json.'''
+    self.stop()
+    return collections.OrderedDict([('script',self.script),\
+                                    ('started',time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(self.started))),\
+                                    ('seconds',round(time.time()-self.started,6)),\
+                                    ('stages',self.stages),\
+                                    ('counts',self.counts),\
+                                    ('peak_memory_kb',peak_memory()),\
+                                    ('peak_memory_children_kb',peak_memory(resource.RUSAGE_CHILDREN))]);
+
+  def write(self,path):
+    '''## Write the report to the JSON file [path].'''
+    with open(path,'w') as f:
+      json.dump(self.report(),f,indent=2)
+      f.write('\n')
+
+def peak_memory(who=resource.RUSAGE_SELF):
+  '''## The peak resident memory in KB of this process, or of its finished child processes
+  # with resource.RUSAGE_CHILDREN.
+  '''
+  return resource.getrusage(who).ru_maxrss;
+
+def file_bytes(paths):
+  '''## The total size in bytes of the files in [paths] that exist.'''
+  return sum(os.path.getsize(path) for path in paths if os.path.isfile(path));
+
+## The number of seconds of processor time between two samples of the --profile option
+PROFILE_INTERVAL=0.002
+
+class Profiler(object):
+  '''## A sampling profiler for the --profile option of the update scripts. Every
+  # [interval] seconds of processor time the stack of the running code is recorded, and
+  # write saves the samples as collapsed stacks, one line per distinct stack:
+  #
+  # join;HOT_niskin_update.py:<module>;HOT_functions.py:join_cruise_sum 12
+  #
+  # which is the input of flamegraph renderers like flamegraph.pl or speedscope. [label]
+  # is a function returning the name of the stage the script is in, e.g. Metrics.stage;
+  # the name becomes the root of each stack so the stages are kept apart.
+  #
+  # The samples come from the SIGPROF timer of signal.setitimer, so only the process
+  # that started the profiler is sampled, not its child processes.
+  '''
+  def __init__(self,interval=PROFILE_INTERVAL,label=None):
+    self.interval=interval
+    self.label=label
+    self.counts=collections.defaultdict(int)
+
+  def start(self):
+    '''## Start sampling.'''
+    signal.signal(signal.SIGPROF,self.sample)
+    signal.siginterrupt(signal.SIGPROF,False) # restart the reads the samples interrupt
+    signal.setitimer(signal.ITIMER_PROF,self.interval,self.interval)
+
+  def stop(self):
+    '''## Stop sampling.'''
+    signal.setitimer(signal.ITIMER_PROF,0,0)
+    signal.signal(signal.SIGPROF,signal.SIG_IGN)
+
+  def sample(self,signum,frame):
+    '''## The SIGPROF handler, records the stack of [frame].'''
+    stack=[]
+    while frame is not None:
+      code=frame.f_code
+      stack.append('%s:%s' % (os.path.basename(code.co_filename),code.co_name))
+      frame=frame.f_back
+    if self.label is not None:
+      stack.append(self.label() or 'start')
+    stack.reverse()
+    self.counts[';'.join(stack)]+=1
+
+  def merge(self,counts):
+    '''## Add the sample [counts] of another profiler, e.g. from a worker process.'''
+    for stack,count in counts.items():
+      self.counts[stack]+=count
+
+  def write(self,path):
+    '''## Write the samples to [path] as collapsed stacks.'''
+    with open(path,'w') as f:
+      for stack,count in sorted(self.counts.items()):
+        f.write('%s %i\n' % (stack,count))
@@ -18,10 +18,35 @@
 # test/ctd/
 #
 #
+# By default the files are transferred inside the script with HOT_fetch.py, over a few
+# ftp connections that stay open, and all the data sets at the same time:
+# HOT_getData.py -s -c -n -j 8
+#
+# With --wget they are transferred with wget, one data set after the other, as before.
+#
+# The size and time of every file on the server is kept in the --manifest file, so the
+# next run only transfers the new and changed files without asking the server about
+# each file. The files transferred by the run, with wget too, are added to the --changed
+# file, one path per line, which the update scripts take with their own --changed option
+# to hash those files again, for example:
+# HOT_getData.py -c -s
+# cd ctd; HOT_ctd_update.py -d ../working/ctd/ --changed ../fetch.changed
+#
 # created: mbiddle 20180309
 # updated: mbiddle 20180423
 #
 # History:
+# 20261017:
+#   - The paths in the --changed file are relative to its directory, so it can be written
+#     outside the working directory.
+#   - The transferred files are added to the --changed file instead of replacing it, see
+#     HOT_functions.write_changed, and the --wget transfers list the files they changed.
+#   - Added the --manifest and --changed options, the fetch manifest of the files on the
+#     server and the list of the files the run transferred.
+#   - The data sets are transferred by HOT_fetch.Fetcher, which keeps --jobs ftp
+#     connections open and transfers the data sets concurrently. The wget transfers are
+#     kept behind the --wget option. Added --server, to transfer from a stand-in server.
+#
 # 20180423:
 #   - Updated to include getting particle flux and primary production data
 #
@@ -40,6 +65,8 @@
 import subprocess
 from optparse import OptionParser
 import sys
+import HOT_fetch # to transfer the files over ftp
+import HOT_functions # to keep the fetch manifest
 
 usage = "usage: %prog [options]\n\nNote: [options] are inclusive, you can identify one or all."
 version = "%prog 1.0"
@@ -59,30 +86,57 @@ parser.add_option("-f","--particle_flux",
 parser.add_option("-p","--primary_prod", 
                   action="store_true", dest="primary_prod",
                   help="To transfer the primary productivity data")
+parser.add_option("-j","--jobs",
+                  dest="jobs",metavar="N",type="int",default=4,
+                  help="transfer up to N files at the same time, over N ftp connections [default: %default]")
+parser.add_option("--wget",
+                  action="store_true", dest="wget",
+                  help="transfer each data set with wget, one after the other")
+parser.add_option("--server",
+                  dest="server",metavar="HOST[:PORT]",
+                  help="transfer from the ftp server HOST instead, e.g. a local stand-in server for testing")
+parser.add_option("--manifest",
+                  dest="manifest",metavar="FILE",default="fetch.manifest",
+                  help="keep the size and time of the files on the server in manifest FILE, only files that changed since the last run are transferred [default: %default]")
+parser.add_option("--changed",
+                  dest="changed",metavar="FILE",default="fetch.changed",
+                  help="add the files transferred by this run to FILE, one path per line, for the --changed option of the update scripts [default: %default]")
 (options, args) = parser.parse_args()
 
 url={}
-optional={}
+optional={} # the wget arguments
+accept={} # the files to transfer, the -A of wget
+include={} # the directories to visit, the -I of wget
 if options.ctd:
   url['ctd'] ='ftp://mananui.soest.hawaii.edu/pub/hot/ctd/'
   optional['ctd'] = ['-A','"h*.ctd"','-Ipub/hot/ctd/hot-*']
+  accept['ctd'] = ['h*.ctd']
+  include['ctd'] = ['pub/hot/ctd/hot-*']
   # wget -np -N -r -nH --cut-dirs=2 -A "h*.ctd" -Ipub/hot/ctd/hot-* ftp://mananui.soest.hawaii.edu/pub/hot/ctd/
 if options.niskin:
   url['niskin']='ftp://ftp.soest.hawaii.edu/dkarl/hot/water/'
   optional['niskin'] = []
+  accept['niskin'] = []
+  include['niskin'] = []
   
 if options.summary:
   #print "Summary option not available yet."
   url['cruise_sum']='ftp://mananui.soest.hawaii.edu/pub/hot/cruise.summaries/'
   optional['cruise_sum'] = ['-A','"hot*.sum"']
+  accept['cruise_sum'] = ['hot*.sum']
+  include['cruise_sum'] = []
 
 if options.particle_flux:
   url['particle_flux']='ftp://ftp.soest.hawaii.edu/dkarl/hot/particle_flux/'
   optional['particle_flux'] = ['-A','"*.flux"']  
+  accept['particle_flux'] = ['*.flux']
+  include['particle_flux'] = []
 
 if options.primary_prod:
   url['primary_prod']='ftp://ftp.soest.hawaii.edu/dkarl/hot/primary_production/'
   optional['primary_prod'] = ['-A','"*.pp"']  
+  accept['primary_prod'] = ['*.pp']
+  include['primary_prod'] = []
 
 print "Transferring:"
 for item in url:
@@ -92,10 +146,35 @@ response = raw_input('Would you like to continue? (yes/no)\n')
 if response.lower() == "no":
   print "Exiting"
   sys.exit()
+elif response.lower() == "yes" and not options.wget:
+  print "Transferring with",options.jobs,"connections\nThis may take a bit..."
+  fetcher = HOT_fetch.Fetcher(jobs=options.jobs,server=options.server)
+  results = fetcher.fetch([(item,url[item],accept[item],include[item]) for item in url],\
+                          HOT_functions.read_index(options.manifest,HOT_fetch.FETCH_MANIFEST_VERSION))
+  HOT_functions.write_index(options.manifest,HOT_fetch.FETCH_MANIFEST_VERSION,fetcher.manifest)
+  changed = [path for item in url for path in results[item]['changed']]
+  listed = HOT_functions.write_changed(options.changed,changed)
+  print len(changed),"files changed,",listed,"listed in",options.changed
+  for item in url:
+    logfile = "transfer_"+item+".log"
+    with open(logfile,'w') as f:
+      f.writelines([line+'\n' for line in sorted(results[item]['log'])])
+    print item+":",results[item]['transferred'],"files transferred ("+str(results[item]['bytes']),\
+          "bytes),",results[item]['unchanged'],"unchanged,",results[item]['failed'],"failed"
+    print "Check",logfile,"for details on the transfer."
 elif response.lower() == "yes":
+  changed = []
   for item in url:
     print "Transferring",item,"from",url[item],'\nThis may take a bit...'
     logfile = "transfer_"+item+".log"
-    #print ' '.join(["wget","-np","-N","-r","-nH","--cut-dirs=2","-o"]+[logfile]+optional[item]+[url[item]])
-    subprocess.call(' '.join(["wget","-np","-N","-r","-nH","--cut-dirs=2","-o"]+[logfile]+optional[item]+[url[item]]),shell=True)
+    source = url[item]
+    if options.server: # same path on the other server
+      source = 'ftp://'+options.server+HOT_fetch.split_url(url[item])[2]
+    local = HOT_fetch.local_path(HOT_fetch.split_url(url[item])[2],2) # where wget writes
+    before = HOT_fetch.file_stats(local)
+    #print ' '.join(["wget","-np","-N","-r","-nH","--cut-dirs=2","-o"]+[logfile]+optional[item]+[source])
+    subprocess.call(' '.join(["wget","-np","-N","-r","-nH","--cut-dirs=2","-o"]+[logfile]+optional[item]+[source]),shell=True)
+    changed.extend(path for path,stat in HOT_fetch.file_stats(local).items() if before.get(path)!=stat)
     print "Check",logfile,"for details on the transfer."
+  listed = HOT_functions.write_changed(options.changed,changed)
+  print len(changed),"files changed,",listed,"listed in",options.changed
@@ -19,6 +19,55 @@ find to the terminal window.'''
 # updated: mbiddle 20180524
 #
 # History:
+# 20261017:
+#   - The --cache is tagged with NISKIN_PARSE_VERSION next to the hash of the format file,
+#     see HOT_functions.cache_tag.
+#   - --changed is only a hint, the data files that aren't listed are still checked by
+#     size and modification time instead of being trusted.
+#   - With --stream the sorted file is merged from the runs of the written csv file,
+#     read back in blocks by HOT_functions.csv_runs, instead of loading the file. The
+#     data files out of order are sorted one at a time through a temporary file.
+#   - The runs of the sorted output are read from the columns by HOT_functions.column_runs.
+#   - The in-memory join skips the data files without station and cast numbers, like
+#     --stream does, so data files without bottles give header only csv files.
+#   - The cruise summary entries are HOT_functions.CruiseSum records, read as attributes;
+#     cruise_sum_keys are HOT_functions.CRUISE_SUM_KEYS. The header of each data file is
+#     a HOT_functions.NiskinHeader record under result[FILE]['header'].
+#   - The cruise summary columns of the in-memory join are HOT_functions.RunColumns, one
+#     run per cast instead of one value per bottle, and the csv files are written from
+#     the columns with itertools.izip instead of a list of every row.
+#   - Added the --typed option, which keeps the integer and float variables of the
+#     layout as HOT_functions.TypedColumns, arrays of numbers with the -9 missing values
+#     in a mask, formatted back into their text only when they are written.
+#   - The cruise summary of each cast is formatted once, see summary_fragments, and the
+#     formatted values are shared by all the bottles of the cast.
+#   - The formats are compiled once into an immutable layout, a tuple of
+#     HOT_functions.Field (see compile_formats), cached next to the readme by
+#     HOT_functions.cached_layout. iter_niskin maps the short names of each file onto
+#     the shared fields instead of copying and changing the format dictionaries.
+#   - Added the --changed option, the list of data files that changed since the last run
+#     (see HOT_getData.py); with --cache the other files are not checked for changes.
+#   - Added the --profile option, which samples the running code and writes collapsed
+#     stacks for a flamegraph, see HOT_functions.Profiler.
+#   - Added the --metrics option, a JSON report of the time spent in each stage, the file
+#     and row counts, the bytes read and written and the peak memory of the run.
+#   - Added the --cache option, a per file cache of the parsed data files, see
+#     parse_niskin and HOT_functions.iter_parsed.
+#   - The sorted output is merged from the rows of each data file, which are mostly in
+#     order already, with HOT_functions.merge_rows instead of a full sort.
+#   - Bottles without cruise summary information are dropped during the join, with a mask
+#     over each file's data, instead of deleting them one index at a time afterwards.
+#   - The sorted output file is written by HOT_functions.sort_rows, sorting on the named
+#     columns in sort_keys, instead of running the sort utility over the written file.
+#   - The data is joined with the cruise summaries through HOT_functions.join_cruise_sum,
+#     one dictionary lookup per bottle instead of a scan of the summary keys.
+#   - The cruise summaries are loaded with HOT_functions.load_cruise_sum, which keeps an
+#     index of the processed summary files (see the --sum_index option).
+#   - Added the --stream option, which writes the joined rows straight into the csv file
+#     one data file at a time instead of combining all the data in memory first.
+#   - process_niskin compiles the formats into a slice plan once per file and decodes
+#     each line in one pass, instead of looking up every field of every line.
+#
 # 20180524:
 #   - Updated to move the process_niskin function from HOT_data_extract to this script.
 #
@@ -58,7 +107,8 @@ import HOT_functions # processing the data files functions
 import collections # to keep dictionaries organized
 import re # regular expressions
 import os # operating system
-import subprocess # to make bash calls
+import itertools # to write the rows from the columns
+import tempfile # to sort the streamed rows out of order
 ## The data OSPREY page can be found at https://www.bco-dmo.org/dataset/3773.
 
 ## Create optional flags for execution: 
@@ -72,7 +122,42 @@ parser.add_option("-t", "--test",
 parser.add_option("-o","--out_file",
                   dest="out_file",metavar="FILE",
                   help="write data to FILE")
+parser.add_option("--sum_index",
+                  dest="sum_index",metavar="FILE",
+                  default="../cruise.summaries/cruise_sum.index",
+                  help="keep the processed cruise summaries in index FILE, only summary files that changed since the last run are processed again [default: %default]")
+parser.add_option("--stream",
+                  action="store_true", dest="stream",
+                  help="Stream the joined rows straight into the -o FILE one data file at a time, instead of combining all the data in memory first")
+parser.add_option("--cache",
+                  dest="cache",metavar="DIR",
+                  help="keep the parsed data files in DIR, files that didn't change since the last run are not parsed again")
+parser.add_option("--metrics",
+                  dest="metrics",metavar="FILE",
+                  help="write a JSON report of the time spent in each stage, the file and row counts, the bytes read and written and the peak memory to FILE")
+parser.add_option("--changed",
+                  dest="changed",metavar="FILE",
+                  help="the files listed in FILE, e.g. the fetch.changed of HOT_getData.py, are hashed again even if their size and time match the --cache, the other files are checked by size and time")
+parser.add_option("--typed",
+                  action="store_true", dest="typed",
+                  help="keep the numeric variables as arrays of numbers, with the -9 missing values in a mask, and only format them when they are written, which takes less memory; the output is the same")
+parser.add_option("--profile",
+                  dest="profile",metavar="FILE",
+                  help="sample the running code and write the samples to FILE as collapsed stacks, the input of flamegraph renderers")
 (options, args) = parser.parse_args()
+metrics = HOT_functions.Metrics('HOT_niskin_update.py') # see the --metrics option
+if options.profile:
+  profiler = HOT_functions.Profiler(label=metrics.stage) # see the --profile option
+  profiler.start()
+changed_files = None # the files listed by the --changed option
+if options.changed:
+  changed_files = HOT_functions.read_changed(options.changed)
+
+## The order of the sorted output for jgofs: (column, type) as described in HOT_functions.sort_rows
+sort_keys=[('cruise_name','n'),('STNNBR','n'),('CASTNO','n'),('ROSETTE','rn')]
+
+## Bump this when iter_niskin returns something else, so the --cache is parsed again
+NISKIN_PARSE_VERSION=1
 
 def create_formats_dict(format_file):
   '''## Create a dictionary that defines the data formatting from the 
@@ -114,9 +199,19 @@ def create_formats_dict(format_file):
       formats[fields]={"start":int(col_num[0])-1,"end":int(col_num[1]),"type":data_formats}
   return formats;
 
-def process_niskin(data_files,formats):
+def compile_formats(format_file):
+  '''## The formats of create_formats_dict as a layout, a tuple of HOT_functions.Field in
+  # the order of the columns. The layout can't be changed, so every data file shares it,
+  # and it is what HOT_functions.cached_layout keeps next to the readme.
+  '''
+  formats=create_formats_dict(format_file)
+  return tuple(HOT_functions.Field(name,formats[name]["start"],formats[name]["end"],formats[name]["type"])\
+               for name in sorted(formats,key=lambda name: (formats[name]["start"],name)));
+
+def process_niskin(data_files,layout):
   '''## This function process the data files provided in [data_files] according to the
-  # formats identified in [formats] and outputs the data into a dictionary structure.
+  # formats identified in [layout] (see compile_formats) and outputs the data into a
+  # dictionary structure.
   #
   ## Data is written into a dictionary under the following structure:
   # result[FILE][VAR]['data']
@@ -124,13 +219,13 @@ def process_niskin(data_files,formats):
   # FILE is the file name.
   # VAR is the short variable name provided in the data file.
   #
-  # There are also dictionaries extracted from the headers of the data files.
-  # Those are at the result[FILE] level and have the following names:
+  # There is also the header of each data file, a HOT_functions.NiskinHeader record at
+  # result[FILE]['header'] with the following fields:
   # 
-  # "expo_code"
-  # "whp_id"
-  # "cruise_start"
-  # "cruise_end"
+  # expo_code
+  # whp_id
+  # cruise_start
+  # cruise_end
   #
   # To print all the "FUCO" data from the hot1.gof data file
   # you would use the following call:
@@ -139,14 +234,33 @@ def process_niskin(data_files,formats):
   #   print data_point
   #
   '''
+  result={}
+  for df_key,file_result in parse_niskin(data_files,layout):
+    result[df_key]=file_result
+  return result;
+
+def parse_niskin(data_files,layout):
+  '''## iter_niskin, through the parse cache when the --cache option is given. The cached
+  # files are tagged with the hash of the format file and NISKIN_PARSE_VERSION, so they
+  # are parsed again when either changes, and with --typed, which caches the typed columns.
+  '''
+  return HOT_functions.iter_parsed(data_files,lambda files: iter_niskin(files,layout,options.typed),\
+                                   options.cache,HOT_functions.cache_tag('niskin-typed' if options.typed else 'niskin',\
+                                   NISKIN_PARSE_VERSION,formats_hash),changed_files);
+
+def iter_niskin(data_files,layout,typed=False):
+  '''## Generator version of process_niskin. The data files in [data_files] are processed
+  # one at a time and (FILE,result[FILE]) is yielded for each one, so only a single file
+  # is held in memory at a time. See process_niskin for the structure of result[FILE].
+  # With [typed] the data of the integer and float variables of the layout, e.g. "6i"
+  # and "7.4f", are HOT_functions.TypedColumns instead of lists of strings.
+  '''
   ## Initialize a bunch of dictionaries
   cruise_info={}
   field_names={}
   units={}
   quality_flag={}
   empty_line={}
-  long_name={}
-  short_names={}
   short_fmt={}
   flag={}
   result={}
@@ -160,82 +274,182 @@ def process_niskin(data_files,formats):
     units[df_key] = datafile.readline()
     quality_flag[df_key] = datafile.readline()
     empty_line[df_key] = datafile.readline()
-    ## exchange the dictionary keys with the short ones from the files
+    ## exchange the long names of the layout with the short ones from the files
     # this is a python remapping effort to simplify the keys
-    short_names[df_key]={}
-    long_name[df_key]={}
-    for key in formats:
-      short_names[df_key][key]=field_names[df_key][int(formats[key]["start"]):int(formats[key]["end"])].strip()
-      # extract out the short field names from the data file itself.
+    # extract out the short field names from the data file itself, each one points to
+    # its field of the shared layout [long name, start and end position and data format].
     short_fmt[df_key]={}
-    # create a new dictionary for the format with the new short names
-    # populates it with the format information from the formatfile identified above
-    # [start and end position and data format].
-    for k,v in short_names[df_key].items():
-      short_fmt[df_key][v]=formats[k]
-      # save the full string name in a long_name attribute
-      short_fmt[df_key][v]["long_name"]=str(k)
+    for field in layout:
+      short_fmt[df_key][field_names[df_key][field.start:field.end].strip()]=field
      
     flag[df_key]={}
-    for key in short_fmt[df_key]: # parse through each format descriptor in formats to get flags
+    for key in short_fmt[df_key]: # parse through each field in the layout to get flags
+      field=short_fmt[df_key][key]
       # do some special processing for the lone * at the end of the flag line
-      if quality_flag[df_key]\
-      [int(short_fmt[df_key][key]["start"]):int(short_fmt[df_key][key]["end"])].strip()\
-      is not "*":
-        flag[df_key][key]=quality_flag[df_key]\
-        [int(short_fmt[df_key][key]["start"]):int(short_fmt[df_key][key]["end"])]
+      if quality_flag[df_key][field.start:field.end].strip() is not "*":
+        flag[df_key][key]=quality_flag[df_key][field.start:field.end]
       else:
-        flag[df_key][key]=quality_flag[df_key]\
-        [int(short_fmt[df_key][key]["start"]):int(short_fmt[df_key][key]["end"])].replace("*"," ")
+        flag[df_key][key]=quality_flag[df_key][field.start:field.end].replace("*"," ")
 
     # initialize final structure with header information
-    result[df_key]={"expo_code":str(cruise_info[df_key]).split(" ")[1]}
-    result[df_key]["whp_id"]=str(cruise_info[df_key]).split(" ")[6]
-    result[df_key]["cruise_start"]=str(cruise_info[df_key]).split(" ")[12]
-    result[df_key]["cruise_end"]=str(cruise_info[df_key]).split(" ")[14]
+    header=str(cruise_info[df_key]).split(" ")
+    result[df_key]={"header":HOT_functions.NiskinHeader(expo_code=intern(header[1]),whp_id=intern(header[6]),\
+                                                       cruise_start=intern(header[12]),cruise_end=intern(header[14]))}
+
+    ## compile the formats into a slice plan once per file, so each line is decoded
+    # in one pass instead of looking up the start and end of every field.
+    keys=tuple(short_fmt[df_key].keys())
+    decode=HOT_functions.compile_layout(\
+      [(short_fmt[df_key][key].start,short_fmt[df_key][key].end) for key in keys])
 
     ## parse the data now, using the formats identified above.
-    # iterate through each line of data file
-    for line in datafile:
-      # parse through each format descriptor in formats
-      for key in short_fmt[df_key]:
-        # get the data from the line and format it as they described
-        # quick and dirty bash line: "cut -c 249-256 hot1.gof"
-        # data = eval(line[int(short_fmt[key]["start"]):int(short_fmt[key]["end"])].format(short_fmt[key]["type"]))
-        # print out raw line for error checking
-        data =\
-        line[int(short_fmt[df_key][key]["start"]):int(short_fmt[df_key][key]["end"])]
-        if key == "STNNBR" or key == "CASTNO":
-          if key == "CASTNO":
-            castno = data.strip() # pull out the cast number
-          if key == "STNNBR":
-            stnbr = data.strip() # pull out the station number
-        if "stnbr" in locals() and "castno" in locals():
-          ident.append(str(cruise_info[df_key]).split(" ")[1]+"."+stnbr+"."+castno) # create the ident key
-          result[df_key]["ident"]= {"data": ident} # write the list to the dictionary
-          del stnbr # reset the variable
-          del castno # reset the variable
-        # check if the key exists in the dictionary
-        if key not in result[df_key].keys():
-        # if not, initialize the dictionary
-          result[df_key][key]={
-            "long_name":short_fmt[df_key][key]["long_name"],
-            "data":[data],
-            "flag":flag[df_key][key],
-            "start":int(short_fmt[df_key][key]["start"]),
-            "end":int(short_fmt[df_key][key]["end"]),
-            "format":short_fmt[df_key][key]["type"]}
-        else:
-      # if the dict exists, append the data to it
-          result[df_key][key]["data"].append(data)
+    # quick and dirty bash line: "cut -c 249-256 hot1.gof"
+    rows=[decode(line) for line in datafile]
     datafile.close()
-  return result;
+    # turn the rows into one column per variable, no data lines means no variables
+    for key,data in zip(keys,zip(*rows)):
+      data=list(data)
+      if typed and short_fmt[df_key][key].format[-1:] in ('i','f'):
+        data=HOT_functions.type_column(data)
+      result[df_key][key]={
+        "long_name":short_fmt[df_key][key].name,
+        "data":data,
+        "flag":flag[df_key][key],
+        "start":short_fmt[df_key][key].start,
+        "end":short_fmt[df_key][key].end,
+        "format":short_fmt[df_key][key].format}
+    del rows
+    # create the ident key from the station and cast number of each line
+    if "STNNBR" in result[df_key] and "CASTNO" in result[df_key]:
+      ident=[result[df_key]["header"].expo_code+"."+stnbr.strip()+"."+castno.strip()\
+             for stnbr,castno in zip(result[df_key]["STNNBR"]["data"],result[df_key]["CASTNO"]["data"])]
+      result[df_key]["ident"]= {"data": ident} # write the list to the dictionary
+    yield df_key,result.pop(df_key) # hand the file over and drop our reference to it
+
+def format_cruise_sum(cruise_sum_entry):
+  '''## Format a single cruise summary entry [cruise_sum_entry], a HOT_functions.CruiseSum,
+  # to fit the jgofs reqs.
+  # Returns a dictionary with one string per cruise summary variable, plus the
+  # 'cruise_name' and 'EXPOCODE' generated from the Ship.
+  '''
+  summary={}
+  for key in HOT_functions.CRUISE_SUM_KEYS:
+    summary[key]='%s'%(getattr(cruise_sum_entry,key))
+  summary["cruise_name"]='%s'%(cruise_sum_entry.Ship[4:].split("/")[0])
+  summary["EXPOCODE"]='%s'%(cruise_sum_entry.Ship.replace("/","_"))
+  summary["parameters"]='%s'%(cruise_sum_entry.parameters.replace(',',';'))
+  ## Reformatting some of the cruise summary data
+  # if no text in comments, replace with ' '
+  summary["comments"]=' ' if not \
+     re.match('[A-Za-z]','%s'%(cruise_sum_entry.comments.strip())) else\
+     '%s'%(cruise_sum_entry.comments.replace(',',';').strip())
+  # convert lat from DD MM.MMM H to (+-)DD.DDDD
+  # # [0:4] degrees, [4:10] decimal minutes, [10:12] Hemisphere.
+  summary["lat"]='%s%6.4f'\
+     %('-' if 'S' in cruise_sum_entry.lat[10:12] else '',\
+     float(cruise_sum_entry.lat[0:4])+\
+     float(cruise_sum_entry.lat[4:10])/60) # writing and converting
+  # convert lon from DDD MM.MM H to (+-)DDD.DDDD
+  # [0:5] degrees, [5:11] decimal minutes, [11:13] Hemisphere.
+  summary["lon"]='%s%6.4f'\
+     %('-' if 'W' in cruise_sum_entry.lon[11:13] else '',\
+     float(cruise_sum_entry.lon[0:5])+\
+     float(cruise_sum_entry.lon[5:11])/60)
+  return summary;
+
+def summary_fragments(idents,matched,cruise_sum_keys,fragments):
+  '''## The formatted cruise summary values of each bottle with a cruise summary, one tuple
+  # per bottle in the order of [cruise_sum_keys]. [idents] are the identifiers of the
+  # bottles and [matched] their cruise summary entries (see HOT_functions.join_cruise_sum),
+  # bottles without an entry are left out.
+  #
+  # format_cruise_sum runs once per cast: the tuples are kept in [fragments], keyed by
+  # identifier, and every bottle of the cast shares the same tuple.
+  '''
+  rows=[]
+  for ident,cruise_sum_entry in zip(idents,matched):
+    if cruise_sum_entry is None: # no cruise summary, the bottle isn't written
+      continue
+    fragment=fragments.get(ident)
+    if fragment is None:
+      summary=format_cruise_sum(cruise_sum_entry)
+      fragment=fragments[ident]=tuple(summary[key] for key in cruise_sum_keys)
+    rows.append(fragment)
+  return rows;
+
+def check_variables(master_file,master_head,file_data,file_head):
+  '''## Compare the variable names [file_head] of [file_data] to the master variable list
+  # [master_head] taken from [master_file]. If they don't match, print the two lists
+  # side by side and exit.
+  '''
+  if cmp(master_head,file_head) != 0: # 0 means they match
+    print "Error in variable name comparison."
+    # print master_file+":\n",master_head,"\n",file_data+":\n",file_head
+    # Printing in two columns
+    print "Variables of",master_file,"!=",file_data+":"
+    fmt = '{:<20}{:<20}'
+    print(fmt.format(master_file, file_data))
+    print "================================"
+    for master, data in zip(master_head, file_head):
+      print(fmt.format(master, data))
+    print '\nProcess exiting.'
+    sys.exit() # bail out of script
+
+def stream_niskin(data_files,layout,cruise_sum,cruise_sum_keys,missing_sum,run_lengths):
+  '''## Streaming version of process_niskin and the cruise summary join. The data files in
+  # [data_files] are processed one at a time and each bottle that has cruise summary
+  # information is yielded as one row, ready for a csv writer. Only one data file is
+  # held in memory at a time.
+  #
+  # The first row yielded is the header: the data file variables and the [cruise_sum_keys]
+  # sorted alphabetically, the same as the columns of the combined output. Identifiers that
+  # can't be found in [cruise_sum] are appended to [missing_sum], and the number of rows
+  # of each data file to [run_lengths].
+  '''
+  header=None
+  fragments={} # the formatted cruise summary of each cast
+  for df_key,file_result in parse_niskin(data_files,layout):
+    if header is None: # use the first file as the master variable list
+      master_head=file_result.keys()
+      master_file=df_key
+      # (output name, variable, from the data file) for each column, without the
+      # identity and the bcodmo_comment
+      columns=[(var.replace(" ","_"),var,True) for var in file_result\
+               if "data" in file_result[var] and var != "ident"]
+      columns.extend([(key.replace(" ","_"),key,False) for key in cruise_sum_keys\
+                      if key != "bcodmo_comment"])
+      columns.sort()
+      header=[column[0] for column in columns]
+      yield header
+    else: # for the rest of the files, compare to the master
+      check_variables(master_file,master_head,df_key,file_result.keys())
+    if "ident" not in file_result: # no station and cast numbers, nothing to join
+      continue
+    data_columns=[(pos,file_result[var]["data"]) for pos,(name,var,from_file)\
+                  in enumerate(columns) if from_file]
+    sum_columns=[(pos,cruise_sum_keys.index(var)) for pos,(name,var,from_file)\
+                 in enumerate(columns) if not from_file]
+    matched,missing=HOT_functions.join_cruise_sum(file_result["ident"]["data"],cruise_sum)
+    missing_sum.extend(missing) # identifiers that can't be found
+    run_lengths.append(len(matched)-matched.count(None))
+    rows=iter(summary_fragments(file_result["ident"]["data"],matched,cruise_sum_keys,fragments))
+    for index,cruise_sum_entry in enumerate(matched):
+      if cruise_sum_entry is None: # no cruise summary, don't write the bottle
+        continue
+      fragment=next(rows)
+      row=[None]*len(header)
+      for pos,data in data_columns:
+        row[pos]=data[index]
+      for pos,key_index in sum_columns:
+        row[pos]=fragment[key_index]
+      yield row
 
 ## Print current working directory
 print "Current working directory:",os.getcwd()
 
 ## Get the files to be processed:
 #---------------------------------------------------------#
+metrics.start('discovery')
 if options.test: # subset of the data files
   data_files = ['hot1.gof','hot35.gof']
   readme='Readme.water.jgofs'
@@ -266,150 +480,124 @@ else:
     print "total data file count:",len(data_files)
 #---------------------------------------------------------#
 
+metrics.count('data_files',len(data_files))
+metrics.count('summary_files',len(sum_files))
+metrics.count('bytes_read',HOT_functions.file_bytes(data_files+sum_files+[readme]))
+
 ## Pull out all the data using the functions defined above
-formats = create_formats_dict(readme)
-cruise_sum = HOT_functions.process_cruise_sum(sum_files)
-data_result = process_niskin(data_files,formats) # requires formats dictionary
+metrics.start('summary_load')
+layout,formats_hash = HOT_functions.cached_layout(readme,compile_formats) # the hash tags the parse cache
+cruise_sum = HOT_functions.load_cruise_sum(sum_files,options.sum_index)
+metrics.count('summaries',len(cruise_sum))
 
-## Now do some post processing
-#---------------------------------------------------------#
-if options.verbose:
-  print "Data successfully ingested, now processing...\n"
 ### Performing the matching up between summary and data:
-cruise_sum_key=[]
-for value in cruise_sum.values():
-   cruise_sum_key.extend(value.keys())
-cruise_sum_keys=sorted(set(cruise_sum_key))
+cruise_sum_keys=sorted(HOT_functions.CRUISE_SUM_KEYS) # every entry has the same fields
 cruise_sum_keys.extend(['EXPOCODE','cruise_name']) # to add in additional export data
 #sys.exit()
 
-
 missing_sum=[]
-i=0 # start an iterator
-data_combined=collections.OrderedDict()
-for file_data in data_result: # iterate through data dictionary for each file
-  # Do some initial error checking for variable names
-  if i == 0: # use the first file as the master variable list
-    master_head=data_result[file_data].keys() # get variable list
-    master_file = file_data # get variable name
-  else: # for the rest of the files, compare to the master
-    if cmp(master_head,data_result[file_data].keys()) != 0: # 0 means they match
-      print "Error in variable name comparison."
-      # print master_file+":\n",master_head,"\n",file_data+":\n",data_result[file_data].keys()
-      # Printing in two columns
-      print "Variables of",master_file,"!=",file_data+":"
-      fmt = '{:<20}{:<20}'
-      print(fmt.format(master_file, file_data))
-      print "================================"
-      for i, (master, data) in enumerate(zip(master_head, data_result[file_data].keys())):
-        print(fmt.format(master, data))
-      print '\nProcess exiting.'
-      sys.exit() # bail out of script
-  i+=1 # increment iterator
-  ## starting dictionaries for cruise summary information
-  for cruise_sum_key in cruise_sum_keys:
-     data_result[file_data][cruise_sum_key]={}
-     data_result[file_data][cruise_sum_key]["data"]=[]
-  for var in data_result[file_data]: # iterate through data file variables
-    if "data" in data_result[file_data][var]: # look for dictionaries with data (variables and identity)
-      if var is "ident": # find the identity variable
-        # for each entry in that variable (this is a list)
-        for ident_data in data_result[file_data]["ident"]["data"]: 
-          if ident_data in cruise_sum.keys():
-            #only use the data that has matching identity values to output the data
-            #Shortcut to add the cruise summary information verbatim:
-            #for cruise_sum_key in cruise_sum_keys:
-            #  data_result[file_data][cruise_sum_key]["data"].append('%s'\
-            #  %(cruise_sum[ident_data][cruise_sum_key]))
-
-            #Longcut, to format and adjust cruise summary information to fit jgofs reqs
-            data_result[file_data]["Ship"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Ship']))
-            data_result[file_data]["cruise_name"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Ship'][4:].split("/")[0]))
-            data_result[file_data]["EXPOCODE"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Ship'].replace("/","_")))
-            data_result[file_data]["Date"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Date']))
-            data_result[file_data]["Month"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Month']))
-            data_result[file_data]["Day"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Day']))
-            data_result[file_data]["Year"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['Year']))
-            data_result[file_data]["timeutc"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['timeutc']))
-            data_result[file_data]["timecode"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['timecode']))
-            data_result[file_data]["section"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['section']))
-            data_result[file_data]["nav_code"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['nav_code']))
-            data_result[file_data]["depth_max"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['depth_max']))
-            data_result[file_data]["depth_hgt"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['depth_hgt']))
-            data_result[file_data]["pres_max"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['pres_max']))
-            data_result[file_data]["num_bottles"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['num_bottles']))
-            data_result[file_data]["parameters"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['parameters'].replace(',',';')))
-            data_result[file_data]["HOT_summary_file_name"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['HOT_summary_file_name']))
-            data_result[file_data]["bcodmo_comment"]["data"].append('%s'\
-            %(cruise_sum[ident_data]['bcodmo_comment']))
-            ## Reformatting some of the cruise summary data
-            # if no text in comments, replace with ' '
-            data_result[file_data]["comments"]["data"].append(\
-               ' ' if not \
-               re.match('[A-Za-z]','%s'%(cruise_sum[ident_data]['comments'].strip())) else\
-               '%s'%(cruise_sum[ident_data]['comments'].replace(',',';').strip()))
-            #data_result[file_data]["lat"]["data"].append('%s'%(cruise_sum[ident_data]['lat']))# no conversion
-            # convert lat from DD MM.MMM H to (+-)DD.DDDD
-            # # [0:4] degrees, [4:10] decimal minutes, [10:12] Hemisphere. 
-            data_result[file_data]["lat"]["data"].append(\
-             '%s%6.4f'\
-             %('-' if 'S' in cruise_sum[ident_data]['lat'][10:12] else '',\
-             float(cruise_sum[ident_data]['lat'][0:4])+\
-             float(cruise_sum[ident_data]['lat'][4:10])/60)) # writing and converting
-            #data_result[file_data]["lon"]["data"].append('%s'%(cruise_sum[ident_data]['lon']))# no conversion
-            # convert lon from DDD MM.MM H to (+-)DDD.DDDD
-            # [0:5] degrees, [5:11] decimal minutes, [11:13] Hemisphere.
-            data_result[file_data]["lon"]["data"].append(\
-             '%s%6.4f'\
-             %('-' if 'W' in cruise_sum[ident_data]['lon'][11:13] else '',\
-             float(cruise_sum[ident_data]['lon'][0:5])+\
-             float(cruise_sum[ident_data]['lon'][5:11])/60)) 
-          else:
-            for cruise_sum_key in cruise_sum_keys:
-              # stick in an identifier for cruise summaries that can't be found
-              data_result[file_data][cruise_sum_key]["data"].append('MISSING cruise.sum info')
-            missing_sum.append(ident_data) # identifiers that can't be found
-
-# Compile the data into a giant dictionary with variables as key and data as values.
-for file_data in data_result: # iterate through the files
-  for var in data_result[file_data]: # iterate through data file variables
-    if "data" in data_result[file_data][var]: # look for dictionaries with data  
-      if var.replace(" ","_") not in data_combined.keys(): # if the variable dictionary is not started replace space w/underscore
-        data_combined.update({var.replace(" ","_"):data_result[file_data][var]["data"]})
-      else: # otherwise append the data to it
-        data_combined[var.replace(" ","_")].extend(data_result[file_data][var]["data"])
-
-# remove variables we don't need
-del data_combined['ident'] 
-del data_combined['bcodmo_comment']
-
-index_to_remove=[]
-for i in range(len(data_combined['Ship'])):
-  # find location of missing cruise summary information
-  if data_combined['Ship'][i] == "MISSING cruise.sum info":
-   index_to_remove.append(i) # create a list of indexes that should be removed
-
-for var in data_combined:
-  for index in sorted(index_to_remove, reverse=True):
-    # remove the data that doesn't have cruise summary
-    del data_combined[var.replace(" ","_")][index]
+run_lengths=[] # the number of rows from each data file, in order
+if options.stream and options.out_file:
+  ## Stream the joined rows straight into the csv file, one data file at a time
+  print "\nStreaming to",options.out_file
+  metrics.start('parse_join_write') # all at once, one data file at a time
+  import csv
+  with open(options.out_file, 'wb') as f:
+    writer = csv.writer(f, delimiter=',',lineterminator='\n')
+    writer.writerows(stream_niskin(data_files,layout,cruise_sum,cruise_sum_keys,missing_sum,run_lengths))
+else:
+  metrics.start('parse')
+  data_result = process_niskin(data_files,layout) # requires the formats layout
+  metrics.start('join')
+
+  ## Now do some post processing
+  #---------------------------------------------------------#
+  if options.verbose:
+    print "Data successfully ingested, now processing...\n"
+
+  i=0 # start an iterator
+  data_combined=collections.OrderedDict()
+  fragments={} # the formatted cruise summary of each cast
+  for file_data in data_result: # iterate through data dictionary for each file
+    # Do some initial error checking for variable names
+    if i == 0: # use the first file as the master variable list
+      master_head=data_result[file_data].keys() # get variable list
+      master_file = file_data # get variable name
+    else: # for the rest of the files, compare to the master
+      check_variables(master_file,master_head,file_data,data_result[file_data].keys())
+    i+=1 # increment iterator
+    if "ident" not in data_result[file_data]: # no station and cast numbers, nothing to join
+      for var in data_result[file_data]: # none of its bottles can be written
+        if "data" in data_result[file_data][var]:
+          data_result[file_data][var]["data"]=[]
+      data_result[file_data]["ident"]={"data":[]}
+    # join each entry of the identity variable with the cruise summaries
+    idents=data_result[file_data]["ident"]["data"]
+    matched,missing=HOT_functions.join_cruise_sum(idents,cruise_sum)
+    missing_sum.extend(missing) # identifiers that can't be found
+    ## only use the data that has matching identity values to output the data
+    found=[cruise_sum_entry is not None for cruise_sum_entry in matched]
+    if not all(found):
+      for var in data_result[file_data]: # iterate through data file variables
+        if "data" in data_result[file_data][var]: # look for dictionaries with data (variables and identity)
+          data_result[file_data][var]["data"]=HOT_functions.compress_column(data_result[file_data][var]["data"],found)
+    run_lengths.append(len(data_result[file_data]["ident"]["data"]))
+    ## starting dictionaries for cruise summary information
+    for cruise_sum_key in cruise_sum_keys:
+       data_result[file_data][cruise_sum_key]={}
+       data_result[file_data][cruise_sum_key]["data"]=HOT_functions.RunColumn()
+    #Shortcut to add the cruise summary information verbatim:
+    #for cruise_sum_key in cruise_sum_keys:
+    #  data_result[file_data][cruise_sum_key]["data"].append('%s'\
+    #  %(cruise_sum[ident_data][cruise_sum_key]))
+
+    #Longcut, to format and adjust cruise summary information to fit jgofs reqs, once per cast
+    # the bottles of a cast follow each other, so each column is kept as one run per cast
+    rows=summary_fragments(idents,matched,cruise_sum_keys,fragments)
+    for fragment,bottles in itertools.groupby(rows):
+      length=sum(1 for bottle in bottles)
+      for index,cruise_sum_key in enumerate(cruise_sum_keys):
+        data_result[file_data][cruise_sum_key]["data"].append(fragment[index],length)
+
+  # Compile the data into a giant dictionary with variables as key and data as values.
+  for file_data in data_result: # iterate through the files
+    for var in data_result[file_data]: # iterate through data file variables
+      if "data" in data_result[file_data][var]: # look for dictionaries with data  
+        if var.replace(" ","_") not in data_combined.keys(): # if the variable dictionary is not started replace space w/underscore
+          data_combined.update({var.replace(" ","_"):HOT_functions.extend_column(None,data_result[file_data][var]["data"])})
+        else: # otherwise append the data to it, typed columns stay typed
+          data_combined[var.replace(" ","_")]=HOT_functions.extend_column(\
+            data_combined[var.replace(" ","_")],data_result[file_data][var]["data"])
+
+  # remove variables we don't need, there are none without data files
+  data_combined.pop('ident',None)
+  data_combined.pop('bcodmo_comment',None)
+
+  ## Do some verbose printing:
+  if options.verbose:
+    print "\nFound",len(data_combined.keys()),"variables:"
+    for var in data_combined.keys():
+      if var in cruise_sum_keys:
+        print var,'<== from cruise summary'
+      else:
+        print var
+
+  ## sort the dictionary alphabetically
+  data_combined=collections.OrderedDict(sorted(data_combined.items(), key=lambda t: t[0]))
+
+  if options.out_file:
+    ## write out the data to ../HOT_niskin.csv
+    print "\nWriting to",options.out_file
+    metrics.start('write')
+    import csv
+    with open(options.out_file, 'wb') as f:
+      writer = csv.writer(f, delimiter=',',lineterminator='\n')
+      writer.writerow(data_combined.keys())
+      writer.writerows(itertools.izip(*data_combined.values())) #will not write data if the row numbers don't match, should add a check
+
+metrics.stop()
+metrics.count('rows_written',sum(run_lengths))
+metrics.count('missing_identifiers',len(set(missing_sum)))
 
 # if there are missing summary records, print out the missing code.
 if len(sorted(set(missing_sum)))>=1:
@@ -421,36 +609,33 @@ else:
   if options.verbose:
     print 'All data file identifiers [expocode.station.cast] were found in the cruise summary files.'
 
-## Do some verbose printing:
-if options.verbose:
-  print "\nFound",len(data_combined.keys()),"variables:"
-  for var in data_combined.keys():
-    if var in cruise_sum_keys:
-      print var,'<== from cruise summary'
-    else:
-      print var
-
-## sort the dictionary alphabetically
-data_combined=collections.OrderedDict(sorted(data_combined.items(), key=lambda t: t[0]))
-
 if options.out_file:
-  ## write out the data to ../HOT_niskin.csv
-  print "\nWriting to",options.out_file
+  print '\nSorting the data file for jgofs...'
+  metrics.start('sort')
   import csv
-  zd = zip(*data_combined.values())
-  with open(options.out_file, 'wb') as f:
+  if options.stream: # the rows went straight to the file, merge the runs from it
+    data_file = open(options.out_file,'rb')
+    header,runs = HOT_functions.csv_runs(data_file,run_lengths)
+    spill = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(options.out_file)))
+  else:
+    data_file = None
+    spill = None
+    header = data_combined.keys()
+    runs = HOT_functions.column_runs(data_combined.values(),run_lengths)
+  with open(options.out_file.replace(".csv","_sorted.csv"),'wb') as f:
     writer = csv.writer(f, delimiter=',',lineterminator='\n')
-    writer.writerow(data_combined.keys())
-    writer.writerows(zd) #will not write data if the row numbers don't match, should add a check
-  print '\nSorting the data file for jgofs...'
-  f = open(options.out_file.replace(".csv","_sorted.csv"),"w")
-  #sort -k91,91 -k79,79n -k8,8n -k73,73rn -b -t, niskin.csv > niskin_sorted.csv
-  subprocess.call(["sort","-k91,91n","-k79,79n","-k8,8n","-k73,73rn","-b","-t,",options.out_file], stdout=f)
+    writer.writerow(header)
+    if sum(run_lengths): # without bottles there may be no columns to sort on
+      writer.writerows(HOT_functions.merge_rows(header,runs,sort_keys,spill))
+  if data_file is not None:
+    data_file.close()
+    spill.close()
   print "\nWrote",options.out_file.replace(".csv","_sorted.csv")
 
     ## Update the datacomments file
   dir_path = options.out_file.rsplit('/',1)[0]+'/'
   print "\nUpdating",dir_path+'niskin.datacomments'
+  metrics.start('datacomments')
   import datetime
   now = datetime.datetime.now()
   f = open(dir_path+'niskin.datacomments','r')
@@ -461,6 +646,17 @@ if options.out_file:
   f.writelines(lines)
   # do the remaining operations on the file
   f.close()
+  metrics.stop()
+  metrics.count('bytes_written',HOT_functions.file_bytes([options.out_file,\
+                options.out_file.replace(".csv","_sorted.csv"),dir_path+'niskin.datacomments']))
+
+if options.metrics:
+  metrics.write(options.metrics)
+  print '\nWrote the metrics to',options.metrics
+if options.profile:
+  profiler.stop()
+  profiler.write(options.profile)
+  print '\nWrote the profile to',options.profile
 
 print '\nHOT_niskin_update.py complete.'
 
@@ -14,6 +14,35 @@ option, if they exist.'''
 # updated: mbiddle 20180524
 #
 # History:
+# 20261017:
+#   - The --cache is tagged with FLUX_PARSE_VERSION and flux_table, see
+#     HOT_functions.cache_tag, so it is parsed again when either changes.
+#   - --changed is only a hint, the data files that aren't listed are still checked by
+#     size and modification time instead of being trusted.
+#   - The runs of the sorted output are read from the columns by HOT_functions.column_runs.
+#   - The file name, lat and lon columns are HOT_functions.RunColumns, one value per file
+#     or one for the whole output instead of one per row, and the csv files are written
+#     from the columns with itertools.izip instead of a list of every row.
+#   - Added the --typed option, which keeps the numeric variables as
+#     HOT_functions.TypedColumns, arrays of numbers with the -9 missing values in a mask,
+#     formatted back into their text only when they are written.
+#   - The variables are described by the column table flux_table and decoded by
+#     HOT_functions.read_table, which unpacks each data line in one struct call.
+#   - Added the --changed option, the list of data files that changed since the last run
+#     (see HOT_getData.py); with --cache the other files are not checked for changes.
+#   - Added the --profile option, which samples the running code and writes collapsed
+#     stacks for a flamegraph, see HOT_functions.Profiler.
+#   - Added the --metrics option, a JSON report of the time spent in each stage, the file
+#     and row counts, the bytes read and written and the peak memory of the run.
+#   - process_part_flux memory maps each file with HOT_functions.MappedFile, the data
+#     variables are MappedColumns that only slice a value out of the file when it is read.
+#   - Added the --cache option, a per file cache of the parsed data files, see
+#     HOT_functions.iter_parsed.
+#   - The sorted output is merged from the rows of each data file, which are mostly in
+#     order already, with HOT_functions.merge_rows instead of a full sort.
+#   - The sorted output file is written by HOT_functions.sort_rows, sorting on the named
+#     columns in sort_keys, instead of running the sort utility over the written file.
+#
 # 20180524:
 #   - Integrated the function 'process_part_flux' from HOT_data_extract into this script.
 #   - Sorting was fixed to sort by cruise, then depth.
@@ -32,7 +61,8 @@ from optparse import OptionParser # create options for script
 import collections # to keep dictionaries organized
 import re # regular expressions
 import os # operating system
-import subprocess # to make bash calls
+import itertools # to write the rows from the columns
+import HOT_functions # to sort the output and cache the parsed files
 ## The data OSPREY page can be found at https://www.bco-dmo.org/dataset/3773.
 
 ## Create optional flags for execution: 
@@ -46,114 +76,101 @@ parser.add_option("-t", "--test",
 parser.add_option("-o","--out_file",
                   dest="out_file",metavar="FILE",
                   help="write data to FILE")
+parser.add_option("--cache",
+                  dest="cache",metavar="DIR",
+                  help="keep the parsed data files in DIR, files that didn't change since the last run are not parsed again")
+parser.add_option("--metrics",
+                  dest="metrics",metavar="FILE",
+                  help="write a JSON report of the time spent in each stage, the file and row counts, the bytes read and written and the peak memory to FILE")
+parser.add_option("--changed",
+                  dest="changed",metavar="FILE",
+                  help="the files listed in FILE, e.g. the fetch.changed of HOT_getData.py, are hashed again even if their size and time match the --cache, the other files are checked by size and time")
+parser.add_option("--typed",
+                  action="store_true", dest="typed",
+                  help="keep the numeric variables as arrays of numbers, with the -9 missing values in a mask, and only format them when they are written, which takes less memory; the output is the same")
+parser.add_option("--profile",
+                  dest="profile",metavar="FILE",
+                  help="sample the running code and write the samples to FILE as collapsed stacks, the input of flamegraph renderers")
 (options, args) = parser.parse_args()
+metrics = HOT_functions.Metrics('HOT_part_flux_update.py') # see the --metrics option
+if options.profile:
+  profiler = HOT_functions.Profiler(label=metrics.stage) # see the --profile option
+  profiler.start()
+changed_files = None # the files listed by the --changed option
+if options.changed:
+  changed_files = HOT_functions.read_changed(options.changed)
+
+## The order of the sorted output for jgofs: (column, type) as described in HOT_functions.sort_rows
+sort_keys=[('Cruise','n'),('Depth','n')]
+
+## Bump this when process_part_flux returns something else, so the --cache is parsed again
+FLUX_PARSE_VERSION=1
+
+## The variables of the data files as described in Readme.flux, in the order of the
+# output dictionary: HOT_functions.Column(name, start, end, units, type), see
+# HOT_functions.read_table. The units come from the header line 3 (2 in python
+# indexing); the file name is filled in by process_part_flux.
+flux_table=[HOT_functions.Column('P_flux_filename',None,None,None,'s'),
+            HOT_functions.Column('Cruise',0,4,'Number','i'),
+            HOT_functions.Column('Depth',8,11,'Meters','i'),
+            HOT_functions.Column('Treatment',14,15,(2,13,16),'i'),
+            HOT_functions.Column('Carbon',18,23,(2,17,24),'f'),
+            HOT_functions.Column('Carbon_sd_diff',25,32,(2,25,32),'f'),
+            HOT_functions.Column('Carbon_n',32,35,(2,32,35),'i'),
+            HOT_functions.Column('Nitrogen',35,42,(2,35,42),'f'),
+            HOT_functions.Column('Nitrogen_sd_diff',43,50,(2,43,50),'f'),
+            HOT_functions.Column('Nitrogen_n',51,52,(2,51,52),'i'),
+            HOT_functions.Column('Phosphorus',53,60,(2,53,60),'f'),
+            HOT_functions.Column('Phosphorus_sd_diff',61,68,(2,61,68),'f'),
+            HOT_functions.Column('Phosphorus_n',68,71,(2,68,71),'i'),
+            HOT_functions.Column('Mass',71,78,(2,71,78),'f'),
+            HOT_functions.Column('Mass_sd_diff',78,86,(2,78,86),'f'),
+            HOT_functions.Column('Mass_n',86,89,(2,86,89),'i'),
+            HOT_functions.Column('Silica',89,96,(2,89,96),'f'),
+            HOT_functions.Column('Silica_sd_diff',97,104,(2,97,104),'f'),
+            HOT_functions.Column('Silica_n',104,107,(2,104,107),'i'),
+            HOT_functions.Column('Delta_15N',107,114,(2,107,114),'f'),
+            HOT_functions.Column('Delta_15N_sd_diff',115,122,(2,115,122),'f'),
+            HOT_functions.Column('Delta_15N_n',122,125,(2,122,125),'i'),
+            HOT_functions.Column('Delta_13C',125,132,(2,125,132),'f'),
+            HOT_functions.Column('Delta_13C_sd_diff',133,140,(2,133,140),'f'),
+            HOT_functions.Column('Delta_13C_n',140,143,(2,140,143),'i'),
+            HOT_functions.Column('PIC',143,150,(2,143,150),'f'),
+            HOT_functions.Column('PIC_sd_diff',151,158,(2,151,158),'f'),
+            HOT_functions.Column('PIC_n',158,161,(2,158,161),'i')]
 
 def reorder_ordereddict(od, new_key_order):
     new_od = collections.OrderedDict([(k, None) for k in new_key_order if k in od])
     new_od.update(od)
     return new_od
 
-def process_part_flux(data_files):
+def process_part_flux(data_files,typed=False):
   '''## Create a dictionary for the particle flux data files using the formats as described in Readme.flux 
   # Accepts a list variable containing file names (relative paths are okay).
   #
   # explicitly parses line by line based on how the records are identified in Readme.flux
   # No special processing, outputs a dictionary per file, per variable, with data as strings. All 
-  # information is retained and transferred via the dictionary.
+  # information is retained and transferred via the dictionary. The variables are
+  # described by flux_table and decoded by HOT_functions.read_table, their data is a
+  # tuple of strings. With [typed] the numeric variables are HOT_functions.TypedColumns.
   '''
 #  import collections
   result={}
   data_rec1={}
-  data_rec2={}
-  data_rec3={}
   for data_key in data_files:
-    datafile = open(data_key,'r') # open the file
+    mapped = HOT_functions.MappedFile(data_key) # map the file
     filename = data_key
     ## Process the header of the file
-    data_rec1[data_key]=datafile.readline().replace("\n","") # line 1
-    data_rec2[data_key]=datafile.readline().replace("\n","") # line 2
-    data_rec3[data_key]=datafile.readline().replace("\n","") # line 3
+    data_rec1[data_key]=mapped.line(0) # line 1
     result[data_key]={}
     result[data_key]['P_flux filename']=filename
     ## Data record 1
     result[data_key]['Title']=data_rec1[data_key]
-  
-    vars=['P_flux_filename','Cruise','Depth','Treatment',\
-          'Carbon','Carbon_sd_diff','Carbon_n',\
-          'Nitrogen','Nitrogen_sd_diff','Nitrogen_n',\
-          'Phosphorus','Phosphorus_sd_diff','Phosphorus_n',\
-          'Mass','Mass_sd_diff','Mass_n',\
-          'Silica','Silica_sd_diff','Silica_n',\
-          'Delta_15N','Delta_15N_sd_diff','Delta_15N_n',\
-          'Delta_13C','Delta_13C_sd_diff','Delta_13C_n',\
-          'PIC','PIC_sd_diff','PIC_n']
-    for var in vars:
-      result[data_key][var]={}
-   
-    ## Data record 3 Units
-#    result[data_key]['Units']=data_rec5[data_key]
-    result[data_key]['Cruise']['Units']='Number' 
-    result[data_key]['Depth']['Units']='Meters'
-    result[data_key]['Treatment']['Units']=data_rec3[data_key][13:16]
-    result[data_key]['Carbon']['Units']=data_rec3[data_key][17:24]
-    result[data_key]['Carbon_sd_diff']['Units']=data_rec3[data_key][25:32]
-    result[data_key]['Carbon_n']['Units']=data_rec3[data_key][32:35]
-    result[data_key]['Nitrogen']['Units']=data_rec3[data_key][35:42]
-    result[data_key]['Nitrogen_sd_diff']['Units']=data_rec3[data_key][43:50]
-    result[data_key]['Nitrogen_n']['Units']=data_rec3[data_key][51:52]
-    result[data_key]['Phosphorus']['Units']=data_rec3[data_key][53:60]
-    result[data_key]['Phosphorus_sd_diff']['Units']=data_rec3[data_key][61:68]
-    result[data_key]['Phosphorus_n']['Units']=data_rec3[data_key][68:71]
-    result[data_key]['Mass']['Units']=data_rec3[data_key][71:78]
-    result[data_key]['Mass_sd_diff']['Units']=data_rec3[data_key][78:86]
-    result[data_key]['Mass_n']['Units']=data_rec3[data_key][86:89]
-    result[data_key]['Silica']['Units']=data_rec3[data_key][89:96]
-    result[data_key]['Silica_sd_diff']['Units']=data_rec3[data_key][97:104]
-    result[data_key]['Silica_n']['Units']=data_rec3[data_key][104:107]
-    result[data_key]['Delta_15N']['Units']=data_rec3[data_key][107:114]
-    result[data_key]['Delta_15N_sd_diff']['Units']=data_rec3[data_key][115:122]
-    result[data_key]['Delta_15N_n']['Units']=data_rec3[data_key][122:125]
-    result[data_key]['Delta_13C']['Units']=data_rec3[data_key][125:132]
-    result[data_key]['Delta_13C_sd_diff']['Units']=data_rec3[data_key][133:140]
-    result[data_key]['Delta_13C_n']['Units']=data_rec3[data_key][140:143]
-    result[data_key]['PIC']['Units']=data_rec3[data_key][143:150]
-    result[data_key]['PIC_sd_diff']['Units']=data_rec3[data_key][151:158]
-    result[data_key]['PIC_n']['Units']=data_rec3[data_key][158:161]
-
-    # initialize the 'data' dictionaries
-    for item in vars:
-       result[data_key][item]['data']=[]
-
-    ## Now go get all the data for each file
-    for line in datafile: # iterate through each data line and parse on position
-      result[data_key]['P_flux_filename']['data'].append(filename)
-      result[data_key]['Cruise']['data'].append(line[0:4].replace("\n",""))
-      result[data_key]['Depth']['data'].append(line[8:11].replace("\n",""))
-      result[data_key]['Treatment']['data'].append(line[14:15].replace("\n",""))
-      result[data_key]['Carbon']['data'].append(line[18:23].replace("\n",""))
-      result[data_key]['Carbon_sd_diff']['data'].append(line[25:32].replace("\n",""))
-      result[data_key]['Carbon_n']['data'].append(line[32:35].replace("\n",""))
-      result[data_key]['Nitrogen']['data'].append(line[35:42].replace("\n",""))
-      result[data_key]['Nitrogen_sd_diff']['data'].append(line[43:50].replace("\n",""))
-      result[data_key]['Nitrogen_n']['data'].append(line[51:52].replace("\n",""))
-      result[data_key]['Phosphorus']['data'].append(line[53:60].replace("\n",""))
-      result[data_key]['Phosphorus_sd_diff']['data'].append(line[61:68].replace("\n",""))
-      result[data_key]['Phosphorus_n']['data'].append(line[68:71].replace("\n",""))
-      result[data_key]['Mass']['data'].append(line[71:78].replace("\n",""))
-      result[data_key]['Mass_sd_diff']['data'].append(line[78:86].replace("\n",""))
-      result[data_key]['Mass_n']['data'].append(line[86:89].replace("\n",""))
-      result[data_key]['Silica']['data'].append(line[89:96].replace("\n",""))
-      result[data_key]['Silica_sd_diff']['data'].append(line[97:104].replace("\n",""))
-      result[data_key]['Silica_n']['data'].append(line[104:107].replace("\n",""))
-      result[data_key]['Delta_15N']['data'].append(line[107:114].replace("\n",""))
-      result[data_key]['Delta_15N_sd_diff']['data'].append(line[115:122].replace("\n",""))
-      result[data_key]['Delta_15N_n']['data'].append(line[122:125].replace("\n",""))
-      result[data_key]['Delta_13C']['data'].append(line[125:132].replace("\n",""))
-      result[data_key]['Delta_13C_sd_diff']['data'].append(line[133:140].replace("\n",""))
-      result[data_key]['Delta_13C_n']['data'].append(line[140:143].replace("\n",""))
-      result[data_key]['PIC']['data'].append(line[143:150].replace("\n",""))
-      result[data_key]['PIC_sd_diff']['data'].append(line[151:158].replace("\n",""))
-      result[data_key]['PIC_n']['data'].append(line[158:161].replace("\n",""))
+
+    ## The units and data of every variable, as described in flux_table
+    for var,entry in HOT_functions.read_table(mapped,flux_table,3,typed).items(): # in table order
+      result[data_key][var]=entry
+    result[data_key]['P_flux_filename']['data']=HOT_functions.RunColumn(filename,len(result[data_key]['Cruise']['data']))
 
   return result;
 
@@ -162,6 +179,7 @@ print "Current working directory:",os.getcwd()
 
 ## Get the files to be processed:
 #---------------------------------------------------------#
+metrics.start('discovery')
 if options.test: # subset of the data files
   data_files = ['hot1-12.flux','hot280-288.flux']
   readme='Readme.flux'
@@ -180,16 +198,25 @@ else:
   if options.verbose:
     print "total data file count:",len(data_files)
 #---------------------------------------------------------#
+metrics.count('data_files',len(data_files))
+metrics.count('bytes_read',HOT_functions.file_bytes(data_files))
+
 ## Pull out all the data using the functions defined above
-data_result = process_part_flux(data_files)
+metrics.start('parse')
+data_result = dict(HOT_functions.iter_parsed(data_files,\
+              lambda files: process_part_flux(files,options.typed),\
+              options.cache,HOT_functions.cache_tag('flux-typed' if options.typed else 'flux',\
+              FLUX_PARSE_VERSION,flux_table),changed_files))
 
 ## Now do some post processing
 #---------------------------------------------------------#
 if options.verbose:
   print "Data successfully ingested, now processing...\n"
 
+metrics.start('combine')
 i=0 # start an iterator
 data_combined={}#collections.OrderedDict()
+run_lengths=[] # the number of rows from each data file, in order
 for file_data in data_result: # iterate through data dictionary for each file
   # Do some initial error checking for variable names
   if i == 0: # use the first file as the master variable list
@@ -209,37 +236,42 @@ for file_data in data_result: # iterate through data dictionary for each file
       print '\nProcess exiting.'
       sys.exit() # bail out of script
   i+=1 # increment iterator
+  run_lengths.append(len(data_result[file_data]['Cruise']['data']))
   # Compile the data into a giant dictionary with variables as key and data as values.
   for var in data_result[file_data]: # iterate through data file variables
     if "data" in data_result[file_data][var]: # look for dictionaries with data  
       if var.replace(" ","_") not in data_combined.keys(): # if the variable dictionary is not started replace space w/underscore
-        data_combined.update({var.replace(" ","_"):data_result[file_data][var]["data"]})
-      else: # otherwise append the data to it
-        data_combined[var.replace(" ","_")].extend(data_result[file_data][var]["data"])
+        data_combined.update({var.replace(" ","_"):HOT_functions.extend_column(None,data_result[file_data][var]["data"])})
+      else: # otherwise append the data to it, typed columns stay typed
+        data_combined[var.replace(" ","_")]=HOT_functions.extend_column(\
+          data_combined[var.replace(" ","_")],data_result[file_data][var]["data"])
 
 ## Add latitude and longitude coordinates
-data_combined.update({'lon':[-158.00] * len(data_combined[var],)})
-data_combined.update({'lat':[22.75] * len(data_combined[var],)})
+data_combined.update({'lon':HOT_functions.RunColumn(-158.00,len(data_combined[var]))})
+data_combined.update({'lat':HOT_functions.RunColumn(22.75,len(data_combined[var]))})
 
 if options.out_file:
   ## write out the data to ../HOT_niskin.csv
   print "\nWriting to",options.out_file
+  metrics.start('write')
   import csv
-  zd = zip(*data_combined.values())
   with open(options.out_file, 'wb') as f:
     writer = csv.writer(f, delimiter=',',lineterminator='\n')
     writer.writerow(data_combined.keys())
-    writer.writerows(zd) #will not write data if the row numbers don't match, should add a check
+    writer.writerows(itertools.izip(*data_combined.values())) #will not write data if the row numbers don't match, should add a check
   print '\nSorting the data file for jgofs...'
-  f = open(options.out_file.replace(".csv","_sorted.csv"),"w")
-  #sort -k23,23n -k6,6 -b -t, part_flux.csv > part_flux_sorted.csv
-  #sort by date, then depth
-  subprocess.call(["sort","-k25,25n","-k6,6n","-b","-t,",options.out_file], stdout=f)
+  metrics.start('sort')
+  with open(options.out_file.replace(".csv","_sorted.csv"),'wb') as f:
+    writer = csv.writer(f, delimiter=',',lineterminator='\n')
+    writer.writerow(data_combined.keys())
+    writer.writerows(HOT_functions.merge_rows(data_combined.keys(),\
+                     HOT_functions.column_runs(data_combined.values(),run_lengths),sort_keys))
   print "\nWrote",options.out_file.replace(".csv","_sorted.csv")
 
   ## Update the datacomments file
   dir_path = options.out_file.rsplit('/',1)[0]+'/'
   print "\nUpdating",dir_path+'part_flux.datacomments'
+  metrics.start('datacomments')
   import datetime
   now = datetime.datetime.now()
   f = open(dir_path+'part_flux.datacomments','r')
@@ -249,5 +281,18 @@ if options.out_file:
   f = open(dir_path+'part_flux.datacomments', 'w')
   f.writelines(lines)
   f.close()
+  metrics.stop()
+  metrics.count('bytes_written',HOT_functions.file_bytes([options.out_file,\
+                options.out_file.replace(".csv","_sorted.csv"),dir_path+'part_flux.datacomments']))
+metrics.stop()
+metrics.count('rows_written',sum(run_lengths))
+
+if options.metrics:
+  metrics.write(options.metrics)
+  print '\nWrote the metrics to',options.metrics
+if options.profile:
+  profiler.stop()
+  profiler.write(options.profile)
+  print '\nWrote the profile to',options.profile
 
 print "\nCompleted HOT_part_flux_update.py." 
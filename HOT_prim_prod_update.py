@@ -14,6 +14,38 @@ specified in the -o option, if they exist.'''
 # updated: mbiddle 20180524
 #
 # History:
+# 20261017:
+#   - The --cache is tagged with PP_PARSE_VERSION and pp_table, see
+#     HOT_functions.cache_tag, so it is parsed again when either changes.
+#   - --changed is only a hint, the data files that aren't listed are still checked by
+#     size and modification time instead of being trusted.
+#   - The runs of the sorted output are read from the columns by HOT_functions.column_runs.
+#   - The file name, lat and lon columns are HOT_functions.RunColumns, one value per file
+#     or one for the whole output instead of one per row, and the csv files are written
+#     from the columns with itertools.izip instead of a list of every row.
+#   - Added the --typed option, which keeps the numeric variables as
+#     HOT_functions.TypedColumns, arrays of numbers with the -9 missing values in a mask,
+#     formatted back into their text only when they are written.
+#   - The start and end date times are converted a column at a time by
+#     HOT_functions.normalize_date_times. Times past 2400 now roll over into the next
+#     day of the calendar, instead of adding 1 to the date, which broke at month ends.
+#   - The variables are described by the column table pp_table and decoded by
+#     HOT_functions.read_table, which unpacks each data line in one struct call.
+#   - Added the --changed option, the list of data files that changed since the last run
+#     (see HOT_getData.py); with --cache the other files are not checked for changes.
+#   - Added the --profile option, which samples the running code and writes collapsed
+#     stacks for a flamegraph, see HOT_functions.Profiler.
+#   - Added the --metrics option, a JSON report of the time spent in each stage, the file
+#     and row counts, the bytes read and written and the peak memory of the run.
+#   - process_prim_prod memory maps each file with HOT_functions.MappedFile, the data
+#     variables are MappedColumns that only slice a value out of the file when it is read.
+#   - Added the --cache option, a per file cache of the parsed data files, see
+#     HOT_functions.iter_parsed.
+#   - The sorted output is merged from the rows of each data file, which are mostly in
+#     order already, with HOT_functions.merge_rows instead of a full sort.
+#   - The sorted output file is written by HOT_functions.sort_rows, sorting on the named
+#     columns in sort_keys, instead of running the sort utility over the written file.
+#
 # 20180524:
 #   - Updated script to include the function 'process_prim_prod' from HOT_data_extract.py
 #   - Script deals with newly added date and time fields.
@@ -33,7 +65,8 @@ from optparse import OptionParser # create options for script
 import collections # to keep dictionaries organized
 import re # regular expressions
 import os # operating system
-import subprocess # to make bash calls
+import itertools # to write the rows from the columns
+import HOT_functions # to sort the output and cache the parsed files
 ## The data OSPREY page can be found at https://www.bco-dmo.org/dataset/737163.
 
 ## Create optional flags for execution: 
@@ -47,7 +80,67 @@ parser.add_option("-t", "--test",
 parser.add_option("-o","--out_file",
                   dest="out_file",metavar="FILE",
                   help="write data to FILE")
+parser.add_option("--cache",
+                  dest="cache",metavar="DIR",
+                  help="keep the parsed data files in DIR, files that didn't change since the last run are not parsed again")
+parser.add_option("--metrics",
+                  dest="metrics",metavar="FILE",
+                  help="write a JSON report of the time spent in each stage, the file and row counts, the bytes read and written and the peak memory to FILE")
+parser.add_option("--changed",
+                  dest="changed",metavar="FILE",
+                  help="the files listed in FILE, e.g. the fetch.changed of HOT_getData.py, are hashed again even if their size and time match the --cache, the other files are checked by size and time")
+parser.add_option("--typed",
+                  action="store_true", dest="typed",
+                  help="keep the numeric variables as arrays of numbers, with the -9 missing values in a mask, and only format them when they are written, which takes less memory; the output is the same")
+parser.add_option("--profile",
+                  dest="profile",metavar="FILE",
+                  help="sample the running code and write the samples to FILE as collapsed stacks, the input of flamegraph renderers")
 (options, args) = parser.parse_args()
+metrics = HOT_functions.Metrics('HOT_prim_prod_update.py') # see the --metrics option
+if options.profile:
+  profiler = HOT_functions.Profiler(label=metrics.stage) # see the --profile option
+  profiler.start()
+changed_files = None # the files listed by the --changed option
+if options.changed:
+  changed_files = HOT_functions.read_changed(options.changed)
+
+## The order of the sorted output for jgofs: (column, type) as described in HOT_functions.sort_rows
+sort_keys=[('Cruise','n'),('start_date_time',''),('Depth','n')]
+
+## Bump this when process_prim_prod returns something else, so the --cache is parsed again
+PP_PARSE_VERSION=1
+
+## The variables of the data files as described in Readme.pp, in the order of the output
+# dictionary: HOT_functions.Column(name, start, end, units, type), see
+# HOT_functions.read_table. The units come from the header lines 3 and 4 (2 and 3 in
+# python indexing); the file name and the combined date and times are filled in by
+# process_prim_prod.
+pp_table=[HOT_functions.Column('PrimProd_filename',None,None,None,'s'),
+          HOT_functions.Column('Cruise',0,5,'Number','i'),
+          HOT_functions.Column('Incubation_type',6,10,(3,6,11),'s'),
+          HOT_functions.Column('Time',11,18,(3,11,18),'f'),
+          HOT_functions.Column('Date',18,26,(3,18,26),'i'),
+          HOT_functions.Column('Start_time',26,32,(3,26,32),'i'),
+          HOT_functions.Column('End_time',32,38,(3,32,38),'i'),
+          HOT_functions.Column('Depth',38,43,(3,38,43),'i'),
+          HOT_functions.Column('Chl_a_mean',44,50,(3,44,50),'f'),
+          HOT_functions.Column('Chl_a_sd',51,57,(3,51,57),'f'),
+          HOT_functions.Column('Pheo_mean',58,64,(3,58,64),'f'),
+          HOT_functions.Column('Pheo_sd',65,71,(3,65,71),'f'),
+          HOT_functions.Column('Light_rep1',72,79,(2,72,79),'f'),
+          HOT_functions.Column('Light_rep2',80,87,(2,80,87),'f'),
+          HOT_functions.Column('Light_rep3',88,95,(2,88,95),'f'),
+          HOT_functions.Column('Dark_rep1',96,103,(2,96,103),'f'),
+          HOT_functions.Column('Dark_rep2',104,111,(2,104,111),'f'),
+          HOT_functions.Column('Dark_rep3',112,119,(2,112,119),'f'),
+          HOT_functions.Column('Salt',120,128,(3,120,128),'f'),
+          HOT_functions.Column('Prochl',129,136,(3,129,136),'f'),
+          HOT_functions.Column('Hetero',137,144,(3,137,144),'f'),
+          HOT_functions.Column('Synecho',145,152,(3,145,152),'f'),
+          HOT_functions.Column('Euk',153,160,(3,153,161),'f'),
+          HOT_functions.Column('Flag',162,172,(3,162,172),'s'),
+          HOT_functions.Column('start_date_time',None,None,'YYMMDDHHMM','s'),
+          HOT_functions.Column('end_date_time',None,None,'YYMMDDHHMM','s')]
 
 ## Define some functions
 def reorder_ordereddict(od, new_key_order):
@@ -55,170 +148,39 @@ def reorder_ordereddict(od, new_key_order):
     new_od.update(od)
     return new_od
 
-def process_prim_prod(data_files):
+def process_prim_prod(data_files,typed=False):
   '''## Create a dictionary for the primary productivity data files using the formats as described in Readme.pp 
   # Accepts a list variable containing file names (relative paths are okay).
   #
   # explicitly parses line by line based on how the records are identified in Readme.pp
   # No special processing, outputs a dictionary per file, per variable, with data as strings. All 
-  # information is retained and transferred via the dictionary.
+  # information is retained and transferred via the dictionary. The variables are
+  # described by pp_table and decoded by HOT_functions.read_table, their data is a tuple
+  # of strings. With [typed] the numeric variables are HOT_functions.TypedColumns.
   '''
 #  import collections
   result={}
   data_rec1={}
-  data_rec2={}
-  data_rec3={}
-  data_rec4={}
   for data_key in data_files:
-    datafile = open(data_key,'r') # open the file
+    mapped = HOT_functions.MappedFile(data_key) # map the file
     filename = data_key
-    ## Process the header of the file
-    data_rec1[data_key]=datafile.readline().replace("\n","") # line 1
-    data_rec2[data_key]=datafile.readline().replace("\n","") # line 2
-    data_rec3[data_key]=datafile.readline().replace("\n","") # line 3
-    data_rec4[data_key]=datafile.readline().replace("\n","") # line 4
-    datafile.readline() #skip blank line
+    ## Process the header of the file, line 5 is blank
+    data_rec1[data_key]=mapped.line(0) # line 1
     result[data_key]={}
     result[data_key]['Prim_prod filename']=filename
     ## Data record 1
     result[data_key]['Title']=data_rec1[data_key]
-  
-    vars=['PrimProd_filename','Cruise','Incubation_type','Time',\
-          'Date','Start_time','End_time','Depth',\
-          'Chl_a_mean','Chl_a_sd','Pheo_mean',\
-          'Pheo_sd','Light_rep1','Light_rep2',\
-          'Light_rep3','Dark_rep1','Dark_rep2',\
-          'Dark_rep3','Salt','Prochl','Hetero',\
-          'Synecho','Euk','Flag','start_date_time','end_date_time']
-    for var in vars:
-      result[data_key][var]={}
-   
-    ## Data record 3 Units
-#    result[data_key]['Units']=data_rec5[data_key]
-    result[data_key]['start_date_time']['Units']='YYMMDDHHMM'
-    result[data_key]['end_date_time']['Units']='YYMMDDHHMM' 
-    result[data_key]['Cruise']['Units']='Number' 
-    result[data_key]['Incubation_type']['Units']=data_rec4[data_key][6:11]
-    result[data_key]['Time']['Units']=data_rec4[data_key][11:18]
-    result[data_key]['Date']['Units']=data_rec4[data_key][18:26]
-    result[data_key]['Start_time']['Units']=data_rec4[data_key][26:32]
-    result[data_key]['End_time']['Units']=data_rec4[data_key][32:38]
-    result[data_key]['Depth']['Units']=data_rec4[data_key][38:43]
-    result[data_key]['Chl_a_mean']['Units']=data_rec4[data_key][44:50]
-    result[data_key]['Chl_a_sd']['Units']=data_rec4[data_key][51:57]
-    result[data_key]['Pheo_mean']['Units']=data_rec4[data_key][58:64]
-    result[data_key]['Pheo_sd']['Units']=data_rec4[data_key][65:71]
-    result[data_key]['Light_rep1']['Units']=data_rec3[data_key][72:79]
-    result[data_key]['Light_rep2']['Units']=data_rec3[data_key][80:87]
-    result[data_key]['Light_rep3']['Units']=data_rec3[data_key][88:95]
-    result[data_key]['Dark_rep1']['Units']=data_rec3[data_key][96:103]
-    result[data_key]['Dark_rep2']['Units']=data_rec3[data_key][104:111]
-    result[data_key]['Dark_rep3']['Units']=data_rec3[data_key][112:119]
-    result[data_key]['Salt']['Units']=data_rec4[data_key][120:128]
-    result[data_key]['Prochl']['Units']=data_rec4[data_key][129:136]
-    result[data_key]['Hetero']['Units']=data_rec4[data_key][137:144]
-    result[data_key]['Synecho']['Units']=data_rec4[data_key][145:152]
-    result[data_key]['Euk']['Units']=data_rec4[data_key][153:161]
-    result[data_key]['Flag']['Units']=data_rec4[data_key][162:172]
-
-    # initialize the 'data' dictionaries
-    for item in vars:
-       result[data_key][item]['data']=[]
-
-    ## Now go get all the data for each file
-    for line in datafile: # iterate through each data line and parse on position
-
-      date=line[18:26] # YYMMDD (zeros not included)
-      start_time=line[26:32] # HHMM
-      end_time=line[32:38]  # HHMM
 
-      ## Padding date with zeros and adding century
-      if len(str(date.strip()))==6:
-         date="%06i"%int(date)
-         if int(date[:2]) <=99 and int(date[:2])>=30:
-            date="19"+date
-         else:
-            date="20"+date
-      elif date.strip()==-9:
-         date="%s"%date.strip()
-      else:
-         date="%06i"%int(date)
-         if int(date[:2]) <=99 and int(date[:2])>=30:
-            date="19"+date
-         else:
-            date="20"+date
+    ## The units and data of every variable, as described in pp_table
+    for var,entry in HOT_functions.read_table(mapped,pp_table,5,typed).items(): # in table order
+      result[data_key][var]=entry
 
-      ## Padding time with zeros and combining with date
-      # if time > 2400, recalculate time/date to be in standard
-      if len(str(start_time.strip()))==4: # start
-         start_time="%04i"%int(start_time)
-         if int(start_time) > 2400:
-           start_date_time="%06i"%(int(date)+1)+"%04i"%(int(start_time)-2400)
-         else:
-           start_date_time=date+start_time
-      elif start_time.strip()=="-9":
-         start_time="%s"%start_time.strip()
-         start_date_time=start_time
-      else:
-         start_time="%04i"%int(start_time)
-         if int(start_time) > 2400:
-           start_date_time="%06i"%(int(date)+1)+"%04i"%(int(start_time)-2400)
-         else:
-           start_date_time=date+start_time
-
-      if len(str(end_time.strip()))==4: # end
-         end_time="%04i"%int(end_time)
-         if int(end_time) > 2400:
-           end_date_time="%06i"%(int(date)+1)+"%04i"%(int(end_time)-2400)
-         else:
-           end_date_time=date+end_time
-      elif end_time.strip()=="-9":
-         end_time="%s"%end_time.strip()
-         end_date_time=end_time
-      else:
-         end_time="%04i"%int(end_time)
-         if int(end_time) > 2400:
-           end_date_time="%06i"%(int(date)+1)+"%04i"%(int(end_time)-2400)
-         else:
-           end_date_time=date+end_time
-
-      ## Convert to ISO8601 if its not -9
-      if not start_date_time.strip()=="-9":
-        start_date_time=start_date_time[0:4]+"-"+start_date_time[4:6]+\
-                    "-"+start_date_time[6:8]+"T"+start_date_time[8:10]+\
-                    ":"+start_date_time[10:12]+":00"
-      if not end_date_time.strip()=="-9":
-        end_date_time=end_date_time[0:4]+"-"+end_date_time[4:6]+\
-                  "-"+end_date_time[6:8]+"T"+end_date_time[8:10]+\
-                  ":"+end_date_time[10:12]+":00"
-
-      ## write the data to the dictionary
-      result[data_key]['Date']['data'].append(line[18:26])
-      result[data_key]['Start_time']['data'].append(line[26:32])
-      result[data_key]['End_time']['data'].append(line[32:38])
-      result[data_key]['start_date_time']['data'].append(start_date_time)
-      result[data_key]['end_date_time']['data'].append(end_date_time)
-      result[data_key]['PrimProd_filename']['data'].append(filename)
-      result[data_key]['Cruise']['data'].append(line[0:5].replace("\n",""))
-      result[data_key]['Incubation_type']['data'].append(line[6:10].replace("\n",""))
-      result[data_key]['Time']['data'].append(line[11:18].replace("\n",""))
-      result[data_key]['Depth']['data'].append(line[38:43].replace("\n",""))
-      result[data_key]['Chl_a_mean']['data'].append(line[44:50].replace("\n",""))
-      result[data_key]['Chl_a_sd']['data'].append(line[51:57].replace("\n",""))
-      result[data_key]['Pheo_mean']['data'].append(line[58:64].replace("\n",""))
-      result[data_key]['Pheo_sd']['data'].append(line[65:71].replace("\n",""))
-      result[data_key]['Light_rep1']['data'].append(line[72:79].replace("\n",""))
-      result[data_key]['Light_rep2']['data'].append(line[80:87].replace("\n",""))
-      result[data_key]['Light_rep3']['data'].append(line[88:95].replace("\n",""))
-      result[data_key]['Dark_rep1']['data'].append(line[96:103].replace("\n",""))
-      result[data_key]['Dark_rep2']['data'].append(line[104:111].replace("\n",""))
-      result[data_key]['Dark_rep3']['data'].append(line[112:119].replace("\n",""))
-      result[data_key]['Salt']['data'].append(line[120:128].replace("\n",""))
-      result[data_key]['Prochl']['data'].append(line[129:136].replace("\n",""))
-      result[data_key]['Hetero']['data'].append(line[137:144].replace("\n",""))
-      result[data_key]['Synecho']['data'].append(line[145:152].replace("\n",""))
-      result[data_key]['Euk']['data'].append(line[153:160].replace("\n",""))
-      result[data_key]['Flag']['data'].append(line[162:172].replace("\n",""))
+    ## The date and times combined into ISO 8601, a whole column at a time
+    result[data_key]['start_date_time']['data']=HOT_functions.normalize_date_times(\
+      result[data_key]['Date']['data'],result[data_key]['Start_time']['data'])
+    result[data_key]['end_date_time']['data']=HOT_functions.normalize_date_times(\
+      result[data_key]['Date']['data'],result[data_key]['End_time']['data'])
+    result[data_key]['PrimProd_filename']['data']=HOT_functions.RunColumn(filename,len(result[data_key]['Cruise']['data']))
 
   return result;
 
@@ -227,6 +189,7 @@ print "Current working directory:",os.getcwd()
 
 ## Get the files to be processed:
 #---------------------------------------------------------#
+metrics.start('discovery')
 if options.test: # subset of the data files
   data_files = ['hot1-12.pp','hot280-288.pp']
   readme='Readme.pp'
@@ -246,16 +209,25 @@ else:
     print "total data file count:",len(data_files)
 #---------------------------------------------------------#
 
+metrics.count('data_files',len(data_files))
+metrics.count('bytes_read',HOT_functions.file_bytes(data_files))
+
 ## Pull out all the data using the functions defined above
-data_result = process_prim_prod(data_files)
+metrics.start('parse')
+data_result = dict(HOT_functions.iter_parsed(data_files,\
+              lambda files: process_prim_prod(files,options.typed),\
+              options.cache,HOT_functions.cache_tag('pp-typed' if options.typed else 'pp',\
+              PP_PARSE_VERSION,pp_table),changed_files))
 #---------------------------------------------------------#
 
 ## Now do some post processing
 if options.verbose:
   print "Data successfully ingested, now processing...\n"
 
+metrics.start('combine')
 i=0 # start an iterator
 data_combined={}#collections.OrderedDict()
+run_lengths=[] # the number of rows from each data file, in order
 for file_data in data_result: # iterate through data dictionary for each file
   # Do some initial error checking for variable names
   if i == 0: # use the first file as the master variable list
@@ -275,37 +247,42 @@ for file_data in data_result: # iterate through data dictionary for each file
       print '\nProcess exiting.'
       sys.exit() # bail out of script
   i+=1 # increment iterator
+  run_lengths.append(len(data_result[file_data]['Cruise']['data']))
   # Compile the data into a giant dictionary with variables as key and data as values.
   for var in data_result[file_data]: # iterate through data file variables
     if "data" in data_result[file_data][var]: # look for dictionaries with data  
       if var.replace(" ","_") not in data_combined.keys(): # if the variable dictionary is not started replace space w/underscore
-        data_combined.update({var.replace(" ","_"):data_result[file_data][var]["data"]})
-      else: # otherwise append the data to it
-        data_combined[var.replace(" ","_")].extend(data_result[file_data][var]["data"])
+        data_combined.update({var.replace(" ","_"):HOT_functions.extend_column(None,data_result[file_data][var]["data"])})
+      else: # otherwise append the data to it, typed columns stay typed
+        data_combined[var.replace(" ","_")]=HOT_functions.extend_column(\
+          data_combined[var.replace(" ","_")],data_result[file_data][var]["data"])
 
 ## Add latitude and longitude coordinates
-data_combined.update({'lon':[-158.00] * len(data_combined[var],)})
-data_combined.update({'lat':[22.75] * len(data_combined[var],)})
+data_combined.update({'lon':HOT_functions.RunColumn(-158.00,len(data_combined[var]))})
+data_combined.update({'lat':HOT_functions.RunColumn(22.75,len(data_combined[var]))})
 
 if options.out_file:
   ## write out the data to ../HOT_niskin.csv
   print "\nWriting to",options.out_file
+  metrics.start('write')
   import csv
-  zd = zip(*data_combined.values())
   with open(options.out_file, 'wb') as f:
     writer = csv.writer(f, delimiter=',',lineterminator='\n')
     writer.writerow(data_combined.keys())
-    writer.writerows(zd) #will not write data if the row numbers don't match, should add a check                  
+    writer.writerows(itertools.izip(*data_combined.values())) #will not write data if the row numbers don't match, should add a check                  
   print '\nSorting the data file for jgofs...'
-  f = open(options.out_file.replace(".csv","_sorted.csv"),"w")
-  #sort -k26,26n -k8,8n -b -t, ../../working/prim_prod/prim_prod.csv
-  #sort by Cruise, start time, then depth 
-  subprocess.call(["sort","-k25,25n","-k21,21n","-k8,8n","-b","-t,",options.out_file], stdout=f)
+  metrics.start('sort')
+  with open(options.out_file.replace(".csv","_sorted.csv"),'wb') as f:
+    writer = csv.writer(f, delimiter=',',lineterminator='\n')
+    writer.writerow(data_combined.keys())
+    writer.writerows(HOT_functions.merge_rows(data_combined.keys(),\
+                     HOT_functions.column_runs(data_combined.values(),run_lengths),sort_keys))
   print "\nWrote",options.out_file.replace(".csv","_sorted.csv")
 
   ## Update the datacomments file
   dir_path = options.out_file.rsplit('/',1)[0]+'/'
   print "\nUpdating",dir_path+'prim_prod.datacomments'
+  metrics.start('datacomments')
   import datetime
   now = datetime.datetime.now()
   f = open(dir_path+'prim_prod.datacomments','r')
@@ -315,5 +292,18 @@ if options.out_file:
   f = open(dir_path+'prim_prod.datacomments', 'w')
   f.writelines(lines)
   f.close()
+  metrics.stop()
+  metrics.count('bytes_written',HOT_functions.file_bytes([options.out_file,\
+                options.out_file.replace(".csv","_sorted.csv"),dir_path+'prim_prod.datacomments']))
+metrics.stop()
+metrics.count('rows_written',sum(run_lengths))
+
+if options.metrics:
+  metrics.write(options.metrics)
+  print '\nWrote the metrics to',options.metrics
+if options.profile:
+  profiler.stop()
+  profiler.write(options.profile)
+  print '\nWrote the profile to',options.profile
 
 print "\nCompleted HOT_prim_prod_update.py."                         
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python
+#
+#
+## This script runs the four update scripts end to end on synthetic archives of growing
+# size (see HOT_synthetic.py), to see how each of them scales as the time series grows.
+# For every archive size and script it records:
+#
+# - the wall time
+# - the number of rows written and rows per second
+# - the peak resident memory of the script, from os.wait4
+#
+# Between two sizes the growth of the time and memory is compared with the growth of the
+# rows, as an exponent: 1 is linear, 2 is quadratic. A script whose time or memory grows
+# faster than --limit is flagged as super-linear.
+#
+# For example, 2, 20 and 200 cruises, the default:
+# HOT_scaling.py -c 2 --scales 1,10,100
+#
+# created: 20261017
+# updated: 20261017
+#
+# History:
+# 20261017:
+#   - Initialized the script
+import os # operating system
+import sys # for the python executable
+import math # for the scaling exponents
+import time # to time the scripts
+import glob # to find the output files
+import shutil # to copy and remove the archives
+import tempfile # to write the archives
+import subprocess # to run the update scripts
+from optparse import OptionParser # create options for script
+import HOT_synthetic # to write the synthetic archives
+
+## The directory of the update scripts
+script_dir=os.path.dirname(os.path.abspath(__file__))
+
+## (name, script, data directory, arguments) of each pipeline, the arguments are
+# formatted with the output directory
+pipelines=[('niskin','HOT_niskin_update.py','water',\
+            ['-o','%(out)s/niskin.csv','--sum_index','%(out)s/niskin.index']),
+           ('ctd','HOT_ctd_update.py','ctd',\
+            ['-d','%(out)s/ctd/','--sum_index','%(out)s/ctd.index']),
+           ('prim_prod','HOT_prim_prod_update.py','primary_production',\
+            ['-o','%(out)s/prim_prod.csv']),
+           ('part_flux','HOT_part_flux_update.py','particle_flux',\
+            ['-o','%(out)s/part_flux.csv'])]
+
+def count_rows(out,name):
+  '''## The number of data rows pipeline [name] wrote to the directory [out], without
+  # the header lines.
+  '''
+  if name=='ctd':
+    files=glob.glob(os.path.join(out,'ctd','*','*.csv'))
+  else:
+    files=[os.path.join(out,name+'.csv')]
+  rows=0
+  for path in files:
+    with open(path) as f:
+      rows+=sum(1 for line in f)-1
+  return rows;
+
+def run_pipeline(root,name,script,directory,arguments):
+  '''## Run the update [script] inside [directory] of the archive [root], writing to
+  # root/out. Returns (wall time in seconds, peak resident memory in KB, exit status).
+  # The output of the script goes to root/out/name.log.
+  '''
+  out=os.path.join(root,'out')
+  if name=='ctd': # the ctd script keeps its datacomments with the csv files
+    if not os.path.isdir(os.path.join(out,'ctd')):
+      os.makedirs(os.path.join(out,'ctd'))
+    shutil.copy(os.path.join(out,'ctd.datacomments'),os.path.join(out,'ctd','ctd.datacomments'))
+  command=[sys.executable,os.path.join(script_dir,script)]+[argument % {'out':out} for argument in arguments]
+  with open(os.path.join(out,name+'.log'),'w') as log:
+    start=time.time()
+    process=subprocess.Popen(command,cwd=os.path.join(root,directory),stdout=log,stderr=subprocess.STDOUT)
+    pid,status,usage=os.wait4(process.pid,0) # the resource usage of this script alone
+    elapsed=time.time()-start
+  process.returncode=status # already waited for
+  return elapsed,usage.ru_maxrss,status;
+
+def exponent(small,large,size_small,size_large):
+  '''## The exponent k in large/small = (size_large/size_small)**k, or None when it can't
+  # be measured.
+  '''
+  if small<=0 or large<=0 or size_small<=0 or size_large<=size_small:
+    return None;
+  return math.log(float(large)/small)/math.log(float(size_large)/size_small);
+
+def scaling(cruises,scales,casts,bottles,records,limit=1.3,min_time=0.5,keep=None,only=None):
+  '''## Run the pipelines on an archive of [cruises] times each of [scales] cruises, and
+  # print the measurements and the scaling exponents. Growth above [limit] is flagged,
+  # as long as the larger run takes at least [min_time] seconds, since shorter runs are
+  # mostly start up time. With [keep], the archives are written there and not removed.
+  # With [only], only the pipelines whose name contains it are run. Returns the list of
+  # (name, scale, rows, seconds, KB, time exponent, memory exponent, flagged).
+  '''
+  results=[]
+  previous={}
+  print '%-10s %6s %10s %10s %12s %10s %8s %8s' % \
+        ('pipeline','scale','rows','time (s)','rows/s','peak (KB)','time k','mem k')
+  for scale in scales:
+    if keep:
+      root=os.path.join(keep,'x%i' % scale)
+    else:
+      root=tempfile.mkdtemp(prefix='HOT_scaling_')
+    try:
+      HOT_synthetic.generate(root,cruises*scale,casts,bottles,records)
+      for name,script,directory,arguments in pipelines:
+        if only and only not in name:
+          continue
+        elapsed,peak,status=run_pipeline(root,name,script,directory,arguments)
+        if status!=0:
+          print '%-10s %6s failed, see %s' % (name,'x%i' % scale,os.path.join(root,'out',name+'.log'))
+          continue
+        rows=count_rows(os.path.join(root,'out'),name)
+        time_k=memory_k=None
+        if name in previous:
+          rows_before,elapsed_before,peak_before=previous[name]
+          time_k=exponent(elapsed_before,elapsed,rows_before,rows)
+          memory_k=exponent(peak_before,peak,rows_before,rows)
+        previous[name]=(rows,elapsed,peak)
+        flagged=elapsed>=min_time and any(k is not None and k>limit for k in [time_k,memory_k])
+        print '%-10s %6s %10i %10.2f %12.0f %10i %8s %8s%s' % (name,'x%i' % scale,rows,elapsed,\
+              rows/elapsed if elapsed>0 else 0,peak,\
+              '-' if time_k is None else '%.2f' % time_k,\
+              '-' if memory_k is None else '%.2f' % memory_k,\
+              '  <== super-linear' if flagged else '')
+        results.append((name,scale,rows,elapsed,peak,time_k,memory_k,flagged))
+    finally:
+      if not keep:
+        shutil.rmtree(root)
+  return results;
+
+if __name__=='__main__':
+  usage = "usage: %prog [options]"
+  version = "%prog 1.0"
+  parser = OptionParser(usage=usage,version=version)
+  parser.add_option("-c","--cruises",
+                    dest="cruises",metavar="N",type="int",default=2,
+                    help="number of cruises at scale 1 [default: %default]")
+  parser.add_option("--scales",
+                    dest="scales",metavar="LIST",default="1,10,100",
+                    help="comma separated archive sizes, as multiples of -c [default: %default]")
+  parser.add_option("-s","--casts",
+                    dest="casts",metavar="N",type="int",default=5,
+                    help="number of casts in each cruise [default: %default]")
+  parser.add_option("-b","--bottles",
+                    dest="bottles",metavar="N",type="int",default=24,
+                    help="number of bottles in each niskin cast [default: %default]")
+  parser.add_option("-r","--records",
+                    dest="records",metavar="N",type="int",default=200,
+                    help="number of records in each ctd cast [default: %default]")
+  parser.add_option("--limit",
+                    dest="limit",metavar="K",type="float",default=1.3,
+                    help="flag time or memory that grows faster than rows**K [default: %default]")
+  parser.add_option("--keep",
+                    dest="keep",metavar="DIR",
+                    help="write the archives and outputs to DIR and keep them")
+  parser.add_option("--only",
+                    dest="only",metavar="NAME",
+                    help="only run the pipelines whose name contains NAME")
+  (options, args) = parser.parse_args()
+  scales=[int(scale) for scale in options.scales.split(',')]
+  results=scaling(options.cruises,scales,options.casts,options.bottles,options.records,\
+                  options.limit,keep=options.keep,only=options.only)
+  if any(result[-1] for result in results):
+    sys.exit(1) # something scales super-linearly
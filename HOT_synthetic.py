@@ -0,0 +1,237 @@
+#!/usr/local/bin/python
+#
+#
+## This script writes a synthetic HOT archive, so the update scripts can be run and timed
+# without the SOEST ftp servers. The files follow the layouts the update scripts read:
+#
+# DIR/water/hot*.gof and Readme.water.jgofs      for HOT_niskin_update.py
+# DIR/ctd/hot-*/h*.ctd                           for HOT_ctd_update.py
+# DIR/primary_production/hot*.pp                 for HOT_prim_prod_update.py
+# DIR/particle_flux/hot*.flux                    for HOT_part_flux_update.py
+# DIR/cruise.summaries/hot*.sum                  for all of them
+# DIR/out/*.datacomments                         the datacomments files the scripts update
+#
+# For example, to write 10 cruises of 12 casts with 24 bottles and 2000 CTD records each:
+# HOT_synthetic.py -d test/ -c 10 -s 12 -b 24 -r 2000
+#
+# Then run the update scripts from inside the data directories, e.g.
+# cd test/water; HOT_niskin_update.py -o ../out/niskin.csv
+#
+# The last cast of every cruise is left out of the cruise summary, so the scripts also
+# report identifiers that can't be found. The values are random, but the same for the
+# same --seed.
+#
+# created: 20261017
+# updated: 20261017
+#
+# History:
+# 20261017:
+#   - Added write_ctd_cast, one ctd cast with given data lines, which HOT_benchmark.py
+#     uses for its --check of the numpy decoder.
+#   - Initialized the script
+import os # operating system
+import random # for the data values
+import calendar # to find the last day of a month
+from optparse import OptionParser # create options for script
+
+## The variables of the niskin files: (short name, long name, format, units, flag)
+niskin_vars=[('STNNBR','Station Number','i6','',''),
+             ('CASTNO','Cast Number','i3','',''),
+             ('ROSETTE','Rosette Position','i2','',''),
+             ('PRESSR','CTD Pressure','f7.1','DBAR',''),
+             ('CTDTMP','CTD Temperature','f7.4','ITS-90',''),
+             ('CTDSAL','CTD Salinity','f7.4','PSS-78','*'),
+             ('OXYGEN','Oxygen','f7.1','UMOL/KG','*'),
+             ('CHL','Chlorophyll a','f7.3','UG/L','*')]
+
+def place(width,fields):
+  '''## Build a fixed-width line of [width] characters from [fields], a list of
+  # (start,end,value) with python indexing. Each value is right aligned in its field and
+  # the trailing spaces of the line are removed, like the HOT files.
+  '''
+  line=[' ']*width
+  for start,end,value in fields:
+    line[start:end]=list(str(value)[-(end-start):].rjust(end-start))
+  return ''.join(line).rstrip();
+
+def expocode(cruise):
+  '''## The expocode of synthetic [cruise].
+  '''
+  return '32MW%03d/1' % cruise;
+
+def makedirs(path):
+  '''## Create the directory [path] if it doesn't exist yet.
+  '''
+  if not os.path.isdir(path):
+    os.makedirs(path)
+
+def write_readme(root):
+  '''## Write the Data Record Format section of Readme.water.jgofs, which
+  # HOT_niskin_update.create_formats_dict reads the niskin layout from.
+  '''
+  with open(os.path.join(root,'water','Readme.water.jgofs'),'w') as f:
+    f.write('HOT water readme\n\nData Record Format:\nColumn  Format  Item\n')
+    f.write('\n'.join(['%3d-%4d %-4s %s' % (i*8+1,i*8+8,fmt,long_name)\
+                       for i,(short,long_name,fmt,units,flag) in enumerate(niskin_vars)]))
+
+def write_cruise_sum(root,cruise,casts,bottles):
+  '''## Write the cruise summary of [cruise], with [casts] casts of [bottles] bottles.
+  '''
+  with open(os.path.join(root,'cruise.summaries','hot%d.sum' % cruise),'w') as f:
+    f.write('HOT %d cruise summary\nSHIP SECT STN CAST\n units\n----\n' % cruise)
+    for station in range(1,casts+1):
+      month,day,year=(cruise%12)+1,(station%27)+1,(88+cruise)%100
+      f.write(place(140,[(0,9,expocode(cruise).ljust(9)),(9,15,'PRS2'),(15,20,station),
+                         (20,24,1),(24,30,'ROS'),(30,37,'%02d%02d%02d' % (month,day,year)),
+                         (37,42,'%04d' % (station*37%2400)),(42,46,'BE'),
+                         (46,58,'22 45.00 N'.ljust(11)),(58,71,'158 00.00 W'.ljust(12)),
+                         (71,76,'GPS'),(76,82,4700+station),(82,87,10),(87,92,4800),
+                         (92,99,bottles),(99,112,'1,2,3,4'),
+                         (112,140,'comment, %d' % station if station%3 else '')]).ljust(112)+'\n')
+
+def write_niskin(root,cruise,casts,bottles,rand):
+  '''## Write the niskin file of [cruise], [casts]+1 casts of [bottles] bottles each.
+  '''
+  with open(os.path.join(root,'water','hot%d.gof' % cruise),'w') as f:
+    f.write('EXPOCODE %s x x x WHP-ID PRS2 x x x x DATES 100188 TO 100588\n' % expocode(cruise))
+    f.write(''.join([var[0].rjust(8) for var in niskin_vars])+'\n')
+    f.write(''.join([var[3].rjust(8) for var in niskin_vars])+'\n')
+    f.write(''.join([var[4].rjust(8) for var in niskin_vars])+'\n')
+    f.write('\n')
+    for station in range(1,casts+2):
+      for rosette in range(bottles,0,-1):
+        f.write('%8d%8d%8d%8.1f%8.4f%8.4f%8.1f%8.3f\n' % (station,1,rosette,rosette*10.0,\
+                rand.uniform(2,27),rand.uniform(34,35.5),rand.uniform(100,250),rand.uniform(0,1)))
+
+def write_ctd(root,cruise,casts,records,rand):
+  '''## Write the ctd files of [cruise], [casts]+1 casts of [records] records each.
+  '''
+  cruise_dir=os.path.join(root,'ctd','hot-%d' % cruise)
+  makedirs(cruise_dir)
+  for station in range(1,casts+2):
+    write_ctd_cast(os.path.join(cruise_dir,'h%02da%02d01.ctd' % (cruise,station)),cruise,station,\
+                   ['%8.1f%8.4f%9.4f%8.1f %7.2f%8.3f%8d%8s' % (record*2.0,\
+                    rand.uniform(2,27),rand.uniform(34,35.5),rand.uniform(100,250),\
+                    rand.uniform(90,100),rand.uniform(0,1),10+record%5,'2222')\
+                    for record in range(records)])
+
+def write_ctd_cast(path,cruise,station,lines):
+  '''## Write the ctd file [path] of one cast, [station] of [cruise]: the 6 header lines
+  # and the data [lines], without their newlines.
+  '''
+  with open(path,'w') as f:
+    f.write(place(46,[(8,22,expocode(cruise).ljust(14)),(30,34,'PRS2'),(40,46,'100588')])+'\n')
+    f.write(place(40,[(6,12,station),(19,22,1),(35,40,len(lines))])+'\n')
+    f.write(place(41,[(15,21,'SBE911'),(36,41,'2')])+'\n')
+    f.write(place(65,[(0,8,'CTDPRS'),(8,16,'CTDTMP'),(16,25,'CTDSAL'),(25,33,'CTDOXY'),
+                      (34,41,'XMISS'),(41,49,'CHLPIG'),(49,57,'NUMBER'),(57,65,'QUALT')])+'\n')
+    f.write(place(65,[(0,8,'DBAR'),(8,16,'ITS-90'),(16,25,'PSS-78'),(25,33,'UMOL/KG'),
+                      (34,41,'%TRANS'),(41,49,'UG/L'),(49,57,'OBS'),(57,65,'*')])+'\n')
+    f.write(place(65,[(57,65,'*******')])+'\n')
+    for line in lines:
+      f.write(line+'\n')
+
+def write_prim_prod(root,first,last,rand):
+  '''## Write the primary production file of cruises [first] to [last]. Half the cruises
+  # are on the last day of the month and some incubations end past midnight, so the
+  # date rollover is exercised.
+  '''
+  with open(os.path.join(root,'primary_production','hot%d-%d.pp' % (first,last)),'w') as f:
+    f.write('HOT primary_production cruises %d-%d\n' % (first,last))
+    f.write('header two\n')
+    f.write(place(172,[(72,79,'mgC/m3'),(80,87,'mgC/m3'),(88,95,'mgC/m3'),
+                       (96,103,'mgC/m3'),(104,111,'mgC/m3'),(112,119,'mgC/m3')])+'\n')
+    f.write(place(172,[(6,11,'type'),(11,18,'hrs'),(18,26,'yymmdd'),(26,32,'hhmm'),
+                       (32,38,'hhmm'),(38,43,'m'),(44,50,'mg/m3'),(51,57,'mg/m3'),
+                       (58,64,'mg/m3'),(65,71,'mg/m3'),(120,128,'PSS'),
+                       (129,136,'x1e5/ml'),(137,144,'x1e5/ml'),(145,152,'x1e5/ml'),
+                       (153,161,'x1e3/ml'),(162,172,'flag')])+'\n')
+    f.write('\n')
+    for cruise in range(first,last+1):
+      month,year=(cruise%12)+1,(88+cruise)%100
+      day=calendar.monthrange(1988+cruise,month)[1] if cruise%2 else 15
+      date=int('%02d%02d%02d' % (year,month,day)) # YYMMDD without the leading zeros
+      for depth in [5,25,45,75,100,125]:
+        start=rand.choice([530,600,1930])
+        end=start+rand.choice([1200,1400,-9-start]) # some end times are missing (-9)
+        f.write(place(172,[(0,5,cruise),(6,10,'ISL'),(11,18,'12.0'),(18,26,date),
+                           (26,32,start),(32,38,end),(38,43,depth)]+
+                          [(a,b,'%.3f' % rand.uniform(0,9)) for a,b in
+                           [(44,50),(51,57),(58,64),(65,71),(72,79),(80,87),(88,95),
+                            (96,103),(104,111),(112,119),(120,128),(129,136),
+                            (137,144),(145,152),(153,160)]]+[(162,172,'2222222222')])+'\n')
+
+def write_part_flux(root,first,last,rand):
+  '''## Write the particle flux file of cruises [first] to [last].
+  '''
+  with open(os.path.join(root,'particle_flux','hot%d-%d.flux' % (first,last)),'w') as f:
+    f.write('HOT particle_flux cruises %d-%d\n' % (first,last))
+    f.write('header two\n')
+    f.write(place(161,[(13,16,'trt'),(17,24,'mg/m2/d'),(25,32,'mg'),(32,35,'n'),
+                       (35,42,'mg/m2/d'),(43,50,'mg'),(51,52,'n'),(53,60,'mg/m2/d'),
+                       (61,68,'mg'),(68,71,'n'),(71,78,'mg/m2/d'),(78,86,'mg'),
+                       (86,89,'n'),(89,96,'mg/m2/d'),(97,104,'mg'),(104,107,'n'),
+                       (107,114,'permil'),(115,122,'pm'),(122,125,'n'),
+                       (125,132,'permil'),(133,140,'pm'),(140,143,'n'),
+                       (143,150,'mg/m2/d'),(151,158,'mg'),(158,161,'n')])+'\n')
+    ## (start,end,is a count) of each value after cruise, depth and treatment
+    values=[(18,23,0),(25,32,0),(32,35,1),(35,42,0),(43,50,0),(51,52,1),(53,60,0),
+            (61,68,0),(68,71,1),(71,78,0),(78,86,0),(86,89,1),(89,96,0),(97,104,0),
+            (104,107,1),(107,114,0),(115,122,0),(122,125,1),(125,132,0),(133,140,0),
+            (140,143,1),(143,150,0),(151,158,0),(158,161,1)]
+    for cruise in range(first,last+1):
+      for depth in [150,300,500]:
+        for treatment in [1,2]:
+          f.write(place(161,[(0,4,cruise),(8,11,depth),(14,15,treatment)]+
+                            [(a,b,rand.choice([1,3]) if count else '%.2f' % rand.uniform(0,99))\
+                             for a,b,count in values])+'\n')
+
+def generate(root,cruises,casts,bottles,records,seed=1):
+  '''## Write a synthetic archive of [cruises] cruises to the directory [root]. Every
+  # cruise has [casts] casts in its summary, and one more cast in the data that isn't.
+  # Each niskin cast has [bottles] bottles and each ctd cast [records] records. The
+  # primary production and particle flux files hold 12 cruises each.
+  '''
+  rand=random.Random(seed)
+  for directory in ['water','ctd','cruise.summaries','primary_production','particle_flux','out']:
+    makedirs(os.path.join(root,directory))
+  for name in ['niskin','ctd','prim_prod','part_flux']:
+    with open(os.path.join(root,'out',name+'.datacomments'),'w') as f:
+      f.write('#  version: synthetic\n# comment\n')
+  write_readme(root)
+  for cruise in range(1,cruises+1):
+    write_cruise_sum(root,cruise,casts,bottles)
+    write_niskin(root,cruise,casts,bottles,rand)
+    write_ctd(root,cruise,casts,records,rand)
+  for first in range(1,cruises+1,12):
+    last=min(first+11,cruises)
+    write_prim_prod(root,first,last,rand)
+    write_part_flux(root,first,last,rand)
+
+if __name__=='__main__':
+  usage = "usage: %prog -d DIR [options]"
+  version = "%prog 1.0"
+  parser = OptionParser(usage=usage,version=version)
+  parser.add_option("-d","--dir_path",
+                    dest="dir_path",metavar="DIR",
+                    help="write the synthetic archive to DIR")
+  parser.add_option("-c","--cruises",
+                    dest="cruises",metavar="N",type="int",default=12,
+                    help="number of cruises [default: %default]")
+  parser.add_option("-s","--casts",
+                    dest="casts",metavar="N",type="int",default=10,
+                    help="number of casts in each cruise summary [default: %default]")
+  parser.add_option("-b","--bottles",
+                    dest="bottles",metavar="N",type="int",default=24,
+                    help="number of bottles in each niskin cast [default: %default]")
+  parser.add_option("-r","--records",
+                    dest="records",metavar="N",type="int",default=1000,
+                    help="number of records in each ctd cast [default: %default]")
+  parser.add_option("--seed",
+                    dest="seed",metavar="N",type="int",default=1,
+                    help="seed for the random values [default: %default]")
+  (options, args) = parser.parse_args()
+  if not options.dir_path:
+    parser.error("the -d DIR option is required")
+  generate(options.dir_path,options.cruises,options.casts,options.bottles,options.records,options.seed)
+  print "Wrote a synthetic archive of",options.cruises,"cruises to",options.dir_path